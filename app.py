@@ -1,13 +1,36 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context, url_for
 from flask_cors import CORS
 import pymysql
 from decouple import config
-import yfinance as yf
+import atexit
+import hashlib
+import os
+import json
+import logging
+from urllib.parse import urlencode
+from werkzeug.datastructures import MultiDict
+from db_pool import ConnectionPool
+import risk_engine
+import monte_carlo
+import drawdown
+import performance
+import company_ingest
+import search_index
+import pagination
+import transfers
+import price_index
+import price_store
+import screens
+import instrumentation
+import ingest_prices
+import jobs
+from cache import RedisCache, ResponseCache, TTLCache
 
 app = Flask(__name__)
 CORS(app)
+logger = logging.getLogger(__name__)
 
-def get_db_connection():
+def create_db_connection():
     return pymysql.connect(
         host='localhost',
         user=config('DB_USER'),
@@ -17,23 +40,239 @@ def get_db_connection():
         autocommit=True  # Autocommit changes
     )
 
-# Get all companies
+# Shared connection pool; connections are created lazily on first checkout
+db_pool = ConnectionPool(
+    create_db_connection,
+    max_size=config('DB_POOL_SIZE', default=10, cast=int),
+    timeout=config('DB_POOL_TIMEOUT', default=10.0, cast=float),
+    max_idle=config('DB_POOL_MAX_IDLE', default=300.0, cast=float),
+    health_check_after=config('DB_POOL_HEALTH_CHECK_AFTER', default=30.0, cast=float),
+)
+
+# Per-route latency, DB query counts/time and pool waits, scraped from
+# /metrics. Set PROFILE_SLOW_REQUESTS_MS to dump a sampling profile of
+# every request slower than that into PROFILE_DIR.
+instrumentation.slow_query_threshold = config('SLOW_QUERY_MS', default=500.0, cast=float) / 1000
+instrumentation.metrics.register(instrumentation.pool_collector(db_pool))
+PROFILE_SLOW_REQUESTS_MS = config('PROFILE_SLOW_REQUESTS_MS', default=0.0, cast=float)
+if PROFILE_SLOW_REQUESTS_MS > 0:
+    instrumentation.instrument_flask(
+        app,
+        instrumentation.SamplingProfiler(config('PROFILE_DIR', default='data/profiles'),
+                                         interval=config('PROFILE_INTERVAL_MS', default=5.0, cast=float) / 1000),
+        profile_after=PROFILE_SLOW_REQUESTS_MS / 1000)
+else:
+    instrumentation.instrument_flask(app)
+
+# Columnar price history for the analytics, kept in sync with stock_prices
+if config('PRICE_STORE_PATH', default=''):
+    risk_engine.PRICE_STORE = price_store.PriceStore(
+        config('PRICE_STORE_PATH'), max_age=config('PRICE_STORE_MAX_AGE', default=60.0, cast=float))
+
+# Daily log returns per symbol and for the S&P 500, refreshed incrementally
+returns_cache = performance.ReturnsCache(max_age=config('RETURNS_CACHE_MAX_AGE', default=60.0, cast=float))
+RISK_FREE_RATE = config('RISK_FREE_RATE', default=0.0, cast=float)
+
+# Upper bounds on a Monte Carlo request; larger values are rejected with 400
+MC_MAX_PATHS = config('MC_MAX_PATHS', default=1_000_000, cast=int)
+MC_MAX_CHUNK_SIZE = config('MC_MAX_CHUNK_SIZE', default=100_000, cast=int)
+MC_MAX_WORKERS = config('MC_MAX_WORKERS', default=64, cast=int)
+
+# Background risk jobs, queued in risk_job and run by `python jobs.py`.
+# With JOB_WORKERS > 0 the dev server (and asgi_app.py) also runs that many
+# worker threads. NIGHTLY_AT (local HH:MM, empty to disable) queues price
+# ingestion followed by a full risk recompute.
+JOB_WORKERS = config('JOB_WORKERS', default=0, cast=int)
+JOB_BATCH_SIZE = config('JOB_BATCH_SIZE', default=jobs.BATCH_SIZE, cast=int)
+NIGHTLY_AT = config('NIGHTLY_AT', default='02:00')
+NIGHTLY_PRICE_PROVIDER = config('NIGHTLY_PRICE_PROVIDER', default='none')
+JOB_RETENTION_DAYS = config('JOB_RETENTION_DAYS', default=7, cast=int)
+
+# Sorted per-security snapshot arrays for as-of price lookups
+prices = price_index.PriceIndex(max_age=config('PRICE_INDEX_MAX_AGE', default=5.0, cast=float))
+
+# Company fundamentals provider; tests can swap in an offline source via
+# app.config['COMPANY_INFO_PROVIDER']
+app.config.setdefault('COMPANY_INFO_PROVIDER', company_ingest.CachedInfoProvider(
+    company_ingest.YFinanceInfoProvider(),
+    ttl=config('COMPANY_INFO_TTL', default=3600.0, cast=float)))
+company_rate_limiter = company_ingest.RateLimiter(config('COMPANY_FETCH_RATE', default=5.0, cast=float))
+COMPANY_FETCH_WORKERS = config('COMPANY_FETCH_WORKERS', default=8, cast=int)
+COMPANY_BULK_LIMIT = config('COMPANY_BULK_LIMIT', default=1000, cast=int)
+TRANSFER_BATCH_LIMIT = config('TRANSFER_BATCH_LIMIT', default=10000, cast=int)
+
+def company_provider():
+    return app.config['COMPANY_INFO_PROVIDER']
+
+# Inverted index for company search; built on first use, then kept in
+# step with the company write routes
+company_search = search_index.CompanySearchIndex()
+
+def build_search_index(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT * FROM companies")
+        company_search.build(cursor.fetchall())
+
+# Aggregates behind /api/screens/<name>: industry averages and rolling
+# 52-week windows, refreshed incrementally
+screen_engine = screens.ScreenEngine(max_age=config('SCREENS_MAX_AGE', default=60.0, cast=float))
+
+def reindex_companies(connection, symbols):
+    """Re-reads the given companies into the search index and screens after a write."""
+    if not symbols or not (company_search.built or screen_engine.companies):
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT * FROM companies WHERE symbol IN (%s)" % ', '.join(['%s'] * len(symbols)), list(symbols))
+        found = {row['symbol']: row for row in cursor.fetchall()}
+    for symbol in symbols:
+        if symbol in found:
+            if company_search.built:
+                company_search.add(found[symbol])
+            screen_engine.upsert_company(found[symbol])
+        else:
+            company_search.remove(symbol)
+            screen_engine.remove_company(symbol)
+
+# Read-through cache for company and portfolio reads. Set CACHE_REDIS_URL to
+# share it between workers through a Redis-compatible server.
+def create_response_cache():
+    ttl = config('CACHE_TTL', default=60.0, cast=float)
+    redis_url = config('CACHE_REDIS_URL', default='')
+    if redis_url:
+        import redis
+        return ResponseCache(RedisCache(redis.Redis.from_url(redis_url), ttl=ttl))
+    return ResponseCache(TTLCache(maxsize=config('CACHE_MAX_ENTRIES', default=10000, cast=int), ttl=ttl))
+
+response_cache = create_response_cache()
+CACHED_HEADERS = ('X-Next-Cursor', 'Link')
+
+def cached_response(name, tags, build):
+    """Serves a GET through response_cache, answering If-None-Match with 304.
+
+    ``build`` produces the uncached response; only plain 200 responses are
+    stored, together with their ETag.
+    """
+    key = response_cache.key(name, tags)
+    entry = response_cache.get(key)
+    status = 'HIT'
+    if entry is None:
+        response = build()
+        if isinstance(response, tuple) or response.status_code != 200 or response.is_streamed:
+            return response
+        entry = cache_entry(response.get_data(as_text=True), response.headers)
+        response_cache.set(key, entry)
+        status = 'MISS'
+    response = app.response_class(entry['body'], mimetype='application/json', headers=entry['headers'])
+    response.set_etag(entry['etag'])
+    response.headers['X-Cache'] = status
+    return response.make_conditional(request)
+
+def cache_entry(body, headers):
+    return {
+        'body': body,
+        'etag': hashlib.sha1(body.encode()).hexdigest(),
+        'headers': {h: headers[h] for h in CACHED_HEADERS if h in headers},
+    }
+
+def query_key(name, args):
+    """Cache name for a list request: the endpoint plus its sorted query arguments."""
+    return f"{name}?{urlencode(sorted(args.items(multi=True)))}"
+
+def invalidate_companies(symbols):
+    response_cache.invalidate('companies', *(f"company:{s.upper()}" for s in symbols))
+
+def invalidate_accounts(*account_ids):
+    response_cache.invalidate(*(f"account:{a}" for a in account_ids))
+
+def holdings_changed(*account_ids):
+    """Invalidates cached reads and queues a risk recompute for the accounts."""
+    invalidate_accounts(*account_ids)
+    if not account_ids:
+        return
+    try:
+        with get_db_connection() as connection:
+            for kind in RECOMPUTE_JOBS:
+                jobs.enqueue_many(connection, kind, account_ids, default_job_options(kind))
+    except Exception:
+        # The holdings are already written; the nightly run recomputes them
+        logger.exception("Could not queue a risk recompute for accounts %s", account_ids)
+
+def get_db_connection():
+    """Checks a connection out of the pool; leaving the `with` block returns it.
+
+    The connection's cursors are timed for /metrics and the slow-query log.
+    """
+    return instrumentation.instrumented_checkout(db_pool)
+
+def list_response(query, args):
+    """Serves a list endpoint as a full list, a keyset page or a stream.
+
+    With ?limit= (and ?cursor= from the previous page's X-Next-Cursor header)
+    one page is returned; ?stream=ndjson|json streams every row from a
+    server-side cursor. The JSON shape of each row is unchanged.
+    """
+    fields = query.parse_fields(args.get('fields'))
+    token = args.get('cursor')
+    after = pagination.decode_cursor(token) if token else None
+    stream = args.get('stream')
+    if stream:
+        if stream not in ('ndjson', 'json'):
+            raise ValueError("stream must be 'ndjson' or 'json'")
+        rows = pagination.stream_rows(get_db_connection, query, fields, app.json.dumps, stream, after)
+        mimetype = 'application/x-ndjson' if stream == 'ndjson' else 'application/json'
+        return Response(stream_with_context(rows), mimetype=mimetype)
+
+    limit = args.get('limit', type=int)
+    if token and limit is None:
+        limit = pagination.MAX_PAGE_SIZE
+    with get_db_connection() as connection:
+        rows, next_cursor = pagination.fetch_page(connection, query, fields, after, limit)
+    response = jsonify(rows)
+    if next_cursor:
+        params = args.to_dict()
+        params.update(cursor=next_cursor, limit=limit)
+        response.headers['X-Next-Cursor'] = next_cursor
+        response.headers['Link'] = f'<{request.base_url}?{urlencode(params)}>; rel="next"'
+    return response
+
+# Prometheus metrics: per-route latency, DB queries and pool usage
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(instrumentation.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Connection pool metrics
+@app.route('/api/health/db-pool', methods=['GET'])
+def get_db_pool_stats():
+    return jsonify(db_pool.stats())
+
+# Response cache hit/miss/eviction counters
+@app.route('/api/health/cache', methods=['GET'])
+def get_cache_stats():
+    return jsonify(response_cache.stats())
+
+# Get all companies; supports ?limit=&cursor= paging, ?fields= and ?stream=ndjson|json
+COMPANY_LIST = pagination.ListQuery(
+    "companies", key="symbol",
+    columns={c: c for c in company_ingest.COMPANY_COLUMNS},
+    default_fields=['symbol', 'long_name', 'sector', 'industry', 'market_cap', 'current_price'])
+
 @app.route('/api/companies', methods=['GET'])
 def get_companies():
     try:
-        with get_db_connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute("SELECT symbol, long_name, sector, industry, market_cap, current_price FROM companies")
-                companies = cursor.fetchall()
-                return jsonify(companies)
+        if request.args.get('stream'):
+            return list_response(COMPANY_LIST, request.args)
+        return cached_response(query_key('companies', request.args), ['companies'],
+                               lambda: list_response(COMPANY_LIST, request.args))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        print(f"Error in get_companies: {e}")
+        logger.exception("Error in get_companies")
         return jsonify({"error": "An error occurred while fetching companies."}), 500
 
 # Get a single company by symbol
 @app.route('/api/companies/<string:symbol>', methods=['GET'])
 def get_company(symbol):
-    try:
+    def load():
         with get_db_connection() as connection:
             with connection.cursor() as cursor:
                 cursor.execute("SELECT * FROM companies WHERE symbol = %s", (symbol,))
@@ -42,6 +281,9 @@ def get_company(symbol):
                     return jsonify(company)
                 else:
                     return jsonify({"error": "Company not found"}), 404
+    try:
+        tag = f"company:{symbol.upper()}"
+        return cached_response(tag, [tag], load)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -55,57 +297,50 @@ def create_company():
     ticker_symbol = data['ticker']
     
     try:
-        # Fetch data from yfinance
-        ticker = yf.Ticker(ticker_symbol)
-        info = ticker.info
-
-        if not info or info.get('trailingPegRatio') is None:
-             return jsonify({"error": f"Could not find data for ticker: {ticker_symbol}"}), 404
-
-        # Prepare data for insertion
-        company_data = {
-            'exchange': info.get('exchange'),
-            'symbol': info.get('symbol'),
-            'short_name': info.get('shortName'),
-            'long_name': info.get('longName'),
-            'sector': info.get('sector'),
-            'industry': info.get('industry'),
-            'current_price': info.get('currentPrice'),
-            'market_cap': info.get('marketCap'),
-            'ebitda': info.get('ebitda'),
-            'revenue_growth': info.get('revenueGrowth'),
-            'city': info.get('city'),
-            'state': info.get('state'),
-            'country': info.get('country'),
-            'full_time_employees': info.get('fullTimeEmployees'),
-            'long_business_summary': info.get('longBusinessSummary'),
-            'weight': info.get('weight')
-        }
+        # Fetch data from the (cached) provider
+        try:
+            company_data = company_ingest.company_row(company_provider().fetch_info(ticker_symbol))
+        except company_ingest.TickerNotFound:
+            return jsonify({"error": f"Could not find data for ticker: {ticker_symbol}"}), 404
 
         with get_db_connection() as connection:
             with connection.cursor() as cursor:
-                sql = """
-                INSERT INTO companies (exchange, symbol, short_name, long_name, sector, industry, 
-                                     current_price, market_cap, ebitda, revenue_growth, city, state, 
-                                     country, full_time_employees, long_business_summary, weight)
-                VALUES (%(exchange)s, %(symbol)s, %(short_name)s, %(long_name)s, %(sector)s, %(industry)s,
-                        %(current_price)s, %(market_cap)s, %(ebitda)s, %(revenue_growth)s, %(city)s,
-                        %(state)s, %(country)s, %(full_time_employees)s, %(long_business_summary)s, %(weight)s)
-                ON DUPLICATE KEY UPDATE
-                    exchange=VALUES(exchange), short_name=VALUES(short_name), long_name=VALUES(long_name),
-                    sector=VALUES(sector), industry=VALUES(industry), current_price=VALUES(current_price),
-                    market_cap=VALUES(market_cap), ebitda=VALUES(ebitda), revenue_growth=VALUES(revenue_growth),
-                    city=VALUES(city), state=VALUES(state), country=VALUES(country),
-                    full_time_employees=VALUES(full_time_employees), 
-                    long_business_summary=VALUES(long_business_summary), weight=VALUES(weight);
-                """
-                cursor.execute(sql, company_data)
+                company_ingest.upsert_companies(cursor, [company_data])
+            reindex_companies(connection, [company_data['symbol']])
+        invalidate_companies([company_data['symbol']])
         
         return jsonify({"message": f"Company {ticker_symbol} added/updated successfully"}), 201
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Bulk add/update companies: fetches tickers concurrently and upserts them in one statement
+@app.route('/api/companies/bulk', methods=['POST'])
+def create_companies_bulk():
+    data = request.get_json()
+    tickers = data.get('tickers') if data else None
+    if not isinstance(tickers, list) or not tickers:
+        return jsonify({"error": "A non-empty 'tickers' list is required"}), 400
+    if len(tickers) > COMPANY_BULK_LIMIT:
+        return jsonify({"error": f"At most {COMPANY_BULK_LIMIT} tickers per request"}), 400
+
+    try:
+        rows, errors = company_ingest.fetch_companies(
+            company_provider(), tickers,
+            max_workers=COMPANY_FETCH_WORKERS, rate_limiter=company_rate_limiter)
+        if rows:
+            with get_db_connection() as connection:
+                with connection.cursor() as cursor:
+                    company_ingest.upsert_companies(cursor, rows)
+                reindex_companies(connection, [row['symbol'] for row in rows])
+            invalidate_companies([row['symbol'] for row in rows])
+        return jsonify({
+            "upserted": sorted(row['symbol'] for row in rows),
+            "failed": errors,
+        }), 207 if errors and rows else (201 if rows else 404)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 # Update a company
 @app.route('/api/companies/<string:symbol>', methods=['PUT'])
 def update_company(symbol):
@@ -115,6 +350,8 @@ def update_company(symbol):
             with connection.cursor() as cursor:
                 sql = "UPDATE companies SET short_name = %s, long_name = %s, sector = %s, industry = %s WHERE symbol = %s"
                 cursor.execute(sql, (data['short_name'], data['long_name'], data['sector'], data['industry'], symbol))
+            reindex_companies(connection, [symbol])
+            invalidate_companies([symbol])
             return jsonify({"message": "Company updated successfully"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -126,21 +363,37 @@ def delete_company(symbol):
         with get_db_connection() as connection:
             with connection.cursor() as cursor:
                 cursor.execute("DELETE FROM companies WHERE symbol = %s", (symbol,))
+            company_search.remove(symbol)
+            screen_engine.remove_company(symbol)
+            invalidate_companies([symbol])
             return jsonify({"message": "Company deleted successfully"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-# Keyword search for companies
+# Ranked keyword/typeahead search over symbol, names, sector, industry and summary
 @app.route('/api/companies/search', methods=['GET'])
 def search_companies():
     try:
-        keyword = request.args.get('keyword', '')
+        keyword = request.args.get('q', request.args.get('keyword', ''))
+        limit = max(1, min(request.args.get('limit', default=20, type=int), 200))
+        fields = request.args.get('fields')
+        fields = tuple(fields.split(',')) if fields else search_index.DEFAULT_FIELDS
+        unknown = set(fields) - set(company_ingest.COMPANY_COLUMNS)
+        if unknown:
+            return jsonify({"error": f"Unknown fields: {', '.join(sorted(unknown))}"}), 400
         with get_db_connection() as connection:
-            with connection.cursor() as cursor:
-                sql = "SELECT * FROM companies WHERE long_name LIKE %s OR short_name LIKE %s"
-                cursor.execute(sql, (f"%{keyword}%", f"%{keyword}%"))
-                companies = cursor.fetchall()
-                return jsonify(companies)
+            if not company_search.built:
+                build_search_index(connection)
+            ranked = company_search.rank(keyword, limit=limit,
+                                         prefix=request.args.get('prefix', default=1, type=int) == 1)
+            # Prices and market caps come from the table, not the cached documents
+            live = {}
+            query = search_index.live_query(ranked, fields)
+            if query:
+                with connection.cursor() as cursor:
+                    cursor.execute(*query)
+                    live = {row['symbol']: row for row in cursor.fetchall()}
+        return jsonify(company_search.project(ranked, fields, live))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
@@ -167,8 +420,8 @@ def update_portfolio_asset(ticker):
                     SET quantity = %s 
                     WHERE account_id = %s AND security_id = %s
                 """, (quantity, account_id, security_id))
-                
-                return jsonify({"message": "Asset updated successfully"})
+        holdings_changed(account_id)
+        return jsonify({"message": "Asset updated successfully"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -177,32 +430,39 @@ def update_portfolio_asset(ticker):
 def transfer_security():
     try:
         data = request.get_json()
-        from_account = data['from_account']
-        to_account = data['to_account']
-        security_id = data['security_id']
-        quantity = data['quantity']
-        
+        leg = {key: data[key] for key in ('from_account', 'to_account', 'security_id', 'quantity')}
+
         with get_db_connection() as connection:
-            with connection.cursor() as cursor:
-                try:
-                    connection.begin()
-                    # Check if the 'from' account has the security
-                    cursor.execute("SELECT quantity FROM portfolio_holding WHERE account_id = %s AND security_id = %s", (from_account, security_id))
-                    holding = cursor.fetchone()
-                    if not holding or holding['quantity'] < quantity:
-                        raise Exception("Insufficient quantity to transfer")
-
-                    # Debit from the 'from' account
-                    cursor.execute("UPDATE portfolio_holding SET quantity = quantity - %s WHERE account_id = %s AND security_id = %s", (quantity, from_account, security_id))
-
-                    # Credit to the 'to' account
-                    cursor.execute("INSERT INTO portfolio_holding (account_id, security_id, quantity, book_cost) VALUES (%s, %s, %s, 0) ON DUPLICATE KEY UPDATE quantity = quantity + %s", (to_account, security_id, quantity, quantity))
-                    
-                    connection.commit()
-                    return jsonify({"message": "Transfer successful"})
-                except Exception as e:
-                    connection.rollback()
-                    return jsonify({"error": str(e)}), 500
+            results, summary = transfers.apply_transfers(connection, [leg])
+        holdings_changed(*summary['accounts'])
+        if results[0]['status'] != 'applied':
+            return jsonify({"error": results[0]['error']}), 500
+        return jsonify({"message": "Transfer successful"})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Batch transfers/holding adjustments: all legs run in one transaction with
+# the involved holdings locked in a fixed order
+@app.route('/api/transactions/batch', methods=['POST'])
+def transfer_batch():
+    data = request.get_json()
+    legs = data.get('legs') if data else None
+    if not isinstance(legs, list) or not legs:
+        return jsonify({"error": "A non-empty 'legs' list is required"}), 400
+    if len(legs) > TRANSFER_BATCH_LIMIT:
+        return jsonify({"error": f"At most {TRANSFER_BATCH_LIMIT} legs per request"}), 400
+
+    try:
+        with get_db_connection() as connection:
+            results, summary = transfers.apply_transfers(connection, legs, atomic=bool(data.get('atomic')))
+        holdings_changed(*summary['accounts'])
+        if summary['applied'] == len(legs):
+            status = 200
+        elif summary['applied']:
+            status = 207
+        else:
+            status = 409
+        return jsonify({"summary": summary, "results": results}), status
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -218,45 +478,52 @@ def get_portfolio_holdings(account_id):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+SECURITY_LIST = pagination.ListQuery(
+    "security", key="security_id",
+    columns={'security_id': 'security_id', 'ticker': 'ticker', 'asset_class': 'asset_class'},
+    default_fields=['security_id', 'ticker', 'asset_class'])
+
 @app.route('/api/securities', methods=['GET'])
 def get_securities():
     try:
-        with get_db_connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute("SELECT * FROM security")
-                securities = cursor.fetchall()
-                return jsonify(securities)
+        return list_response(SECURITY_LIST, request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def portfolio_list(account_id):
+    return pagination.ListQuery(
+        """portfolio_holding ph
+           JOIN security s ON ph.security_id = s.security_id
+           JOIN companies c ON s.ticker = c.symbol
+           LEFT JOIN latest_price lp ON lp.security_id = ph.security_id""",
+        key="ph.holding_id",
+        columns={
+            'ticker': 's.ticker',
+            'name': 'c.short_name',
+            'quantity': 'ph.quantity',
+            # Same latest snapshot price the portfolio summary is valued at
+            'price': 'COALESCE(lp.price, c.current_price)',
+            'value': '(ph.quantity * COALESCE(lp.price, c.current_price))',
+        },
+        default_fields=['ticker', 'name', 'quantity', 'price', 'value'],
+        where="ph.account_id = %s", params=(account_id,))
+
 @app.route('/api/portfolio', methods=['GET'])
 def get_portfolio():
     try:
         # Assuming a fixed account_id for now
         account_id = 1
-        with get_db_connection() as connection:
-            with connection.cursor() as cursor:
-                sql = """
-                    SELECT 
-                        s.ticker, 
-                        c.short_name as name,
-                        ph.quantity,
-                        c.current_price as price,
-                        (ph.quantity * c.current_price) as value
-                    FROM 
-                        portfolio_holding ph
-                    JOIN 
-                        security s ON ph.security_id = s.security_id
-                    JOIN
-                        companies c ON s.ticker = c.symbol
-                    WHERE 
-                        ph.account_id = %s
-                """
-                cursor.execute(sql, (account_id,))
-                portfolio = cursor.fetchall()
-                return jsonify(portfolio)
+        if request.args.get('stream'):
+            return list_response(portfolio_list(account_id), request.args)
+        return cached_response(query_key(f"portfolio:{account_id}", request.args),
+                               ['companies', f"account:{account_id}"],
+                               lambda: list_response(portfolio_list(account_id), request.args))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        print(f"Error in get_portfolio: {e}")
+        logger.exception("Error in get_portfolio")
         return jsonify({"error": str(e)}), 500
 
 
@@ -281,8 +548,8 @@ def add_portfolio_asset():
                     INSERT INTO portfolio_holding (account_id, security_id, quantity, book_cost)
                     VALUES (1, %s, %s, 0)
                 """, (security_id, quantity))
-                
-                return jsonify({"message": "Asset added successfully"}), 201
+        holdings_changed(1)
+        return jsonify({"message": "Asset added successfully"}), 201
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -300,18 +567,19 @@ def delete_portfolio_asset(ticker):
 
                 # Delete the holding, assuming account_id = 1
                 result = cursor.execute("DELETE FROM portfolio_holding WHERE account_id = 1 AND security_id = %s", (security_id,))
-                
-                if result > 0:
-                    return jsonify({"message": "Asset deleted successfully"}), 200
-                else:
-                    return jsonify({"error": "Asset not found in portfolio"}), 404
+        holdings_changed(1)
+
+        if result > 0:
+            return jsonify({"message": "Asset deleted successfully"}), 200
+        else:
+            return jsonify({"error": "Asset not found in portfolio"}), 404
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/portfolio/summary/<int:account_id>', methods=['GET'])
 def get_portfolio_summary(account_id):
-    try:
+    def load():
         with get_db_connection() as connection:
             with connection.cursor() as cursor:
                 cursor.execute("SELECT * FROM portfolio_summary WHERE account_id = %s", (account_id,))
@@ -320,40 +588,395 @@ def get_portfolio_summary(account_id):
                     return jsonify(summary)
                 else:
                     return jsonify({"error": "No summary data found for this account."}), 404
+    try:
+        return cached_response(f"summary:{account_id}", [f"account:{account_id}"], load)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Stock screens served from precomputed aggregates; thresholds come from
+# query parameters (see screens.SCREENS for the defaults)
+@app.route('/api/screens', methods=['GET'])
+def list_screens():
+    return jsonify({name: defaults for name, (_, defaults) in screens.SCREENS.items()})
+
+@app.route('/api/screens/<string:name>', methods=['GET'])
+def run_screen(name):
+    if name not in screens.SCREENS:
+        return jsonify({"error": f"Unknown screen: {name}"}), 404
+    try:
+        with get_db_connection() as connection:
+            screen_engine.refresh(connection)
+        result = screen_engine.run(name, request.args)
+        if result is None:
+            return jsonify({"error": "No data available for this screen."}), 404
+        return jsonify(result)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Price of a security at a point in time (latest without ?as_of=)
+@app.route('/api/prices/<int:security_id>', methods=['GET'])
+def get_price_as_of(security_id):
+    try:
+        as_of = request.args.get('as_of')
+        if as_of:
+            price_index.parse_timestamp(as_of)
+        with get_db_connection() as connection:
+            prices.refresh(connection)
+        found = prices.as_of(security_id, as_of)
+        if found is None:
+            return jsonify({"error": "No price found for this security."}), 404
+        price, snapshot_ts = found
+        return jsonify({"security_id": security_id, "as_of": as_of, "price": price, "snapshot_ts": snapshot_ts})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Point-in-time valuation of an account from as-of snapshot prices
+@app.route('/api/portfolio/value/<int:account_id>', methods=['GET'])
+def get_portfolio_value(account_id):
+    try:
+        as_of = request.args.get('as_of')
+        if as_of:
+            price_index.parse_timestamp(as_of)
+        with get_db_connection() as connection:
+            prices.refresh(connection)
+            positions = price_index.load_positions(connection, account_id)
+        if not positions:
+            return jsonify({"error": "No holdings found for this account."}), 404
+        valuation = price_index.value_positions(prices, positions, as_of)
+        return jsonify(dict(valuation, account_id=account_id, as_of=as_of))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def parse_var_options(args):
+    """Reads VaR settings from query parameters."""
+    levels = args.get('confidence')
+    methods = args.get('method')
+    return {
+        'confidence_levels': tuple(float(c) for c in levels.split(',')) if levels else risk_engine.DEFAULT_CONFIDENCE_LEVELS,
+        'horizon': args.get('horizon', default=1, type=int),
+        'lookback': args.get('lookback', default=risk_engine.DEFAULT_LOOKBACK_DAYS, type=int),
+        'methods': tuple(methods.split(',')) if methods else risk_engine.METHODS,
+    }
+
+def parse_simulation_options(args):
+    """Reads Monte Carlo settings from query parameters, rejecting values outside the configured bounds."""
+    shrinkage = args.get('shrinkage')
+    options = {
+        'paths': args.get('paths', default=min(monte_carlo.DEFAULT_PATHS, MC_MAX_PATHS), type=int),
+        'chunk_size': args.get('chunk_size', default=min(monte_carlo.DEFAULT_CHUNK_SIZE, MC_MAX_CHUNK_SIZE), type=int),
+        'seed': args.get('seed', type=int),
+        'shrinkage': shrinkage if shrinkage in (None, 'auto') else float(shrinkage),
+        'workers': args.get('workers', type=int),
+    }
+    limits = {'paths': MC_MAX_PATHS, 'chunk_size': MC_MAX_CHUNK_SIZE, 'workers': MC_MAX_WORKERS}
+    for name, limit in limits.items():
+        if options[name] is not None and not 1 <= options[name] <= limit:
+            raise ValueError(f"{name} must be between 1 and {limit}")
+    return options
+
+def simulation_requested(args):
+    methods = args.get('method')
+    return bool(methods) and 'monte_carlo' in methods.split(',')
+
+def parse_var_request(args):
+    """Normalized VaR job options: the VaR settings, plus the simulation ones for monte_carlo.
+
+    Jobs are deduplicated and batched on these, so requests differing only
+    in ignored or defaulted parameters share one job.
+    """
+    options = parse_var_options(args)
+    unknown = set(options['methods']) - set(risk_engine.METHODS) - {'monte_carlo'}
+    if unknown:
+        raise ValueError(f"Unknown VaR method: {', '.join(sorted(unknown))}")
+    options['confidence_levels'] = sorted(set(options['confidence_levels']))
+    options['methods'] = sorted(set(options['methods']))
+    if 'monte_carlo' in options['methods']:
+        options.update(parse_simulation_options(args))
+    return options
+
+def run_var(account_ids, options):
+    """Computes, persists and returns VaR rows for the given (or all) accounts."""
+    options = dict(options)
+    methods = options.pop('methods')
+    simulated = 'monte_carlo' in methods
+    methods = tuple(m for m in methods if m != 'monte_carlo')
+    options['confidence_levels'] = tuple(options['confidence_levels'])
+
+    results = []
+    with get_db_connection() as connection:
+        if methods:
+            var_options = {k: options[k] for k in ('confidence_levels', 'horizon', 'lookback')}
+            results += risk_engine.compute_var(connection, account_ids, methods=methods, **var_options)
+        if simulated:
+            results += monte_carlo.final_results(monte_carlo.simulate_var(connection, account_ids, **options))
+        risk_engine.save_var_results(connection, results)
+    return results
+
+def stream_var(account_ids, args):
+    """Streams running Monte Carlo estimates as NDJSON, persisting the final ones."""
+    options = parse_var_options(args)
+    if set(options.pop('methods')) != {'monte_carlo'}:
+        raise ValueError("stream=1 only supports method=monte_carlo")
+    options.update(parse_simulation_options(args))
+    with get_db_connection() as connection:
+        progress = monte_carlo.simulate_var(connection, account_ids, **options)
+    # Run the first chunk before answering, so no holdings or bad input is
+    # an error status rather than an empty or truncated stream
+    first = next(progress, None)
+    if first is None:
+        message = "No holdings found for this account." if account_ids else "No holdings found."
+        return jsonify({"error": message}), 404
+
+    def generate():
+        last = first
+        yield json.dumps(first) + "\n"
+        for last in progress:
+            yield json.dumps(last) + "\n"
+        with get_db_connection() as connection:
+            risk_engine.save_var_results(connection, last['results'])
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def queue_job(kind, account_id, options):
+    """Queues a background job and answers 202 with the URL to poll."""
+    with get_db_connection() as connection:
+        job_id, created = jobs.enqueue(connection, kind, account_id, options)
+    status_url = url_for('get_job', job_id=job_id)
+    response = jsonify({"job_id": job_id, "status": "queued", "deduplicated": not created,
+                        "status_url": status_url})
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return response
+
+# Queue VaR/CVaR for one account; method=historical,parametric,monte_carlo.
+# Monte Carlo with ?stream=1 runs in the request and streams its estimates.
 @app.route('/api/risk/var/<int:account_id>', methods=['POST'])
 def calculate_var_route(account_id):
     try:
-        with get_db_connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.callproc('CalculateVaR', (account_id,))
-        return jsonify({"message": "VaR calculation initiated."}), 202
+        if simulation_requested(request.args) and request.args.get('stream', type=int):
+            return stream_var([account_id], request.args)
+        return queue_job('var', account_id, parse_var_request(request.args))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Queue batch VaR for every account in one pass
+@app.route('/api/risk/var', methods=['POST'])
+def calculate_var_all_route():
+    try:
+        if simulation_requested(request.args) and request.args.get('stream', type=int):
+            return stream_var(None, request.args)
+        return queue_job('var', None, parse_var_request(request.args))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def parse_performance_options(args):
+    """Reads performance settings from query parameters."""
+    windows = args.get('windows')
+    return {
+        'lookback': args.get('lookback', default=performance.TRADING_DAYS, type=int),
+        'windows': sorted({int(w) for w in windows.split(',')}) if windows else list(performance.DEFAULT_WINDOWS),
+        'risk_free_rate': args.get('risk_free_rate', default=RISK_FREE_RATE, type=float),
+        'include_series': args.get('series', default=0, type=int) == 1,
+    }
+
+def run_performance(account_ids, options):
+    """Refreshes the returns cache and computes performance metrics for accounts."""
+    with get_db_connection() as connection:
+        returns_cache.refresh(connection)
+        holdings = risk_engine.load_holdings(connection, account_ids)
+    if not holdings:
+        return []
+    return performance.compute_performance(returns_cache, holdings, **options)
+
+# Queue Sharpe/Sortino/beta/alpha for one account; the Sharpe ratio is
+# stored in risk_metric and the full metrics are the job's result
 @app.route('/api/risk/sharpe/<int:account_id>', methods=['POST'])
 def calculate_sharpe_route(account_id):
     try:
-        with get_db_connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.callproc('CalculateSharpeRatio', (account_id,))
-        return jsonify({"message": "Sharpe Ratio calculation initiated."}), 202
+        return queue_job('sharpe', account_id, parse_performance_options(request.args))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Queue the Sharpe ratio for every account in one pass
+@app.route('/api/risk/sharpe', methods=['POST'])
+def calculate_sharpe_all_route():
+    try:
+        return queue_job('sharpe', None, parse_performance_options(request.args))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Sharpe, Sortino, beta and alpha vs the S&P 500, with rolling windows
+@app.route('/api/analytics/performance/<int:account_id>', methods=['GET'])
+def get_performance_route(account_id):
+    try:
+        results = run_performance([account_id], parse_performance_options(request.args))
+        if not results:
+            return jsonify({"error": "No holdings found for this account."}), 404
+        return jsonify(results[0])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/analytics/performance', methods=['GET'])
+def get_performance_all_route():
+    try:
+        return jsonify(run_performance(None, parse_performance_options(request.args)))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Drawdown and underwater curve for one account; optional ?start=&end= window
 @app.route('/api/risk/drawdown/<int:account_id>', methods=['GET'])
 def get_drawdown_route(account_id):
     try:
         with get_db_connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.callproc('CalculateDrawdown', (account_id,))
-                result = cursor.fetchall()
-                return jsonify(result)
+            results = drawdown.compute_drawdowns(
+                connection, [account_id],
+                start=request.args.get('start'), end=request.args.get('end'),
+                include_curve=request.args.get('curve', default=1, type=int) == 1)
+        if not results:
+            return jsonify({"error": "No holdings found for this account."}), 404
+        return jsonify(results[0])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Batch drawdowns for every account; curves only with ?curve=1
+@app.route('/api/risk/drawdown', methods=['GET'])
+def get_drawdown_all_route():
+    try:
+        with get_db_connection() as connection:
+            results = drawdown.compute_drawdowns(
+                connection,
+                start=request.args.get('start'), end=request.args.get('end'),
+                include_curve=request.args.get('curve', default=0, type=int) == 1)
+        return jsonify(results)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Jobs queued when an account's holdings change, and by the nightly run
+RECOMPUTE_JOBS = ('var', 'sharpe')
+
+def default_job_options(kind):
+    """Options of a request without query parameters, so recomputes batch with plain requests."""
+    if kind == 'var':
+        return parse_var_request(MultiDict())
+    return parse_performance_options(MultiDict())
+
+@jobs.register('var')
+def var_job(account_ids, options):
+    results = run_var(account_ids, options)
+    if account_ids is None:
+        return {'accounts': len({r['account_id'] for r in results}), 'rows': len(results)}
+    by_account = {}
+    for row in results:
+        by_account.setdefault(row['account_id'], []).append(row)
+    return by_account
+
+@jobs.register('sharpe')
+def sharpe_job(account_ids, options):
+    results = run_performance(account_ids, options)
+    with get_db_connection() as connection:
+        performance.save_sharpe_results(connection, results)
+    if account_ids is None:
+        return {'accounts': len(results)}
+    return {r['account_id']: r for r in results}
+
+def nightly_price_provider():
+    if NIGHTLY_PRICE_PROVIDER == 'yfinance':
+        return ingest_prices.YFinancePriceProvider()
+    if NIGHTLY_PRICE_PROVIDER == 'csv':
+        return ingest_prices.CsvPriceProvider(config('NIGHTLY_STOCKS_CSV', default='data/sp500_stocks.csv'),
+                                              config('NIGHTLY_INDEX_CSV', default='data/sp500_index.csv'))
+    return None
+
+@jobs.register('nightly')
+def nightly_job(account_ids, options):
+    """Ingests new bars, then queues VaR and Sharpe for every account.
+
+    A failed ingestion is recorded in the result; the recompute is queued
+    either way, over whatever prices are stored.
+    """
+    summary = {}
+    provider = nightly_price_provider()
+    if provider is not None:
+        try:
+            summary['ingest'] = ingest_prices.ingest(provider)
+            invalidate_companies(summary['ingest']['symbols'])
+        except Exception as e:
+            logger.exception("Nightly price ingestion failed")
+            summary['ingest_error'] = str(e) or type(e).__name__
+    with get_db_connection() as connection:
+        if risk_engine.PRICE_STORE is not None:
+            summary['price_store'] = risk_engine.PRICE_STORE.sync(connection, force=True)
+        summary['jobs'] = {kind: jobs.enqueue(connection, kind, options=default_job_options(kind))[0]
+                           for kind in RECOMPUTE_JOBS}
+        summary['purged_jobs'] = jobs.purge(connection, JOB_RETENTION_DAYS)
+    return summary
+
+# Status and result of a background job
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+def get_job(job_id):
+    try:
+        with get_db_connection() as connection:
+            job = jobs.get_job(connection, job_id)
+        if job is None:
+            return jsonify({"error": "Job not found"}), 404
+        return jsonify(job)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Recent jobs, newest first, without results; ?status=&kind=&account_id=&limit=
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    try:
+        with get_db_connection() as connection:
+            return jsonify(jobs.list_jobs(
+                connection,
+                status=request.args.get('status'),
+                kind=request.args.get('kind'),
+                account_id=request.args.get('account_id', type=int),
+                limit=min(request.args.get('limit', default=50, type=int), 1000)))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+instrumentation.metrics.register(jobs.queue_collector(get_db_connection))
+
+def start_background_jobs():
+    """Starts JOB_WORKERS job workers and the nightly scheduler in this process.
+
+    Returns the function that stops them, or None when JOB_WORKERS is 0.
+    """
+    if JOB_WORKERS <= 0:
+        return None
+    return jobs.start(get_db_connection, JOB_WORKERS, NIGHTLY_AT, batch_size=JOB_BATCH_SIZE)
+
 
 if __name__ == '__main__':
+    logging.basicConfig(level=config('LOG_LEVEL', default='INFO'),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    # Only the reloader's serving child runs jobs, not the watching parent
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        stop_background_jobs = start_background_jobs()
+        if stop_background_jobs:
+            atexit.register(stop_background_jobs)
     app.run(debug=True)
@@ -0,0 +1,430 @@
+"""Async (ASGI) serving mode.
+
+The read-heavy endpoints are served natively on an event loop with an
+aiomysql pool; every other route is handed to the Flask app in app.py,
+which runs on a thread pool, so the URL surface and JSON shapes are
+unchanged. Run with:
+
+    python asgi_app.py
+    # or: hypercorn asgi_app:application --bind 0.0.0.0:8000
+"""
+import asyncio
+import functools
+import signal
+import time
+from urllib.parse import urlencode
+
+import aiomysql
+from decouple import config
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from quart import Quart, Response, g, request
+from quart.wrappers.response import DataBody
+from werkzeug.exceptions import HTTPException
+
+import app as flask_app
+import company_ingest
+from cache import RedisCache
+import instrumentation
+import pagination
+import search_index
+
+MAX_CONCURRENCY = config('ASGI_MAX_CONCURRENCY', default=1000, cast=int)
+QUEUE_TIMEOUT = config('ASGI_QUEUE_TIMEOUT', default=1.0, cast=float)
+ROUTE_TIMEOUT = config('ASGI_ROUTE_TIMEOUT', default=10.0, cast=float)
+STREAM_TIMEOUT = config('ASGI_STREAM_TIMEOUT', default=300.0, cast=float)
+SHUTDOWN_TIMEOUT = config('ASGI_SHUTDOWN_TIMEOUT', default=30.0, cast=float)
+
+app = Quart(__name__)
+db_pool = None
+limiter = asyncio.Semaphore(MAX_CONCURRENCY)
+in_flight = 0
+stop_background_jobs = None
+
+
+@app.before_serving
+async def open_pool():
+    global db_pool, stop_background_jobs
+    stop_background_jobs = flask_app.start_background_jobs()
+    db_pool = await aiomysql.create_pool(
+        host='localhost',
+        user=config('DB_USER'),
+        password=config('DB_PASS'),
+        db='track1_stage3',
+        minsize=config('ASGI_DB_POOL_MIN', default=1, cast=int),
+        maxsize=config('ASGI_DB_POOL_SIZE', default=20, cast=int),
+        pool_recycle=config('DB_POOL_MAX_IDLE', default=300.0, cast=float),
+        autocommit=True,
+        cursorclass=aiomysql.DictCursor,
+    )
+
+
+@app.after_serving
+async def close_pool():
+    # Let in-flight requests finish before the pool goes away
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    while in_flight and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    db_pool.close()
+    await db_pool.wait_closed()
+    if stop_background_jobs is not None:
+        await asyncio.get_running_loop().run_in_executor(None, stop_background_jobs)
+
+
+@app.before_request
+async def start_request_timer():
+    rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    g.instrumentation = instrumentation.start_request(rule, request.method)
+
+
+@app.after_request
+async def allow_cors(response):
+    # Same open policy as CORS(app) in app.py; preflights are answered there
+    response.headers.setdefault('Access-Control-Allow-Origin', '*')
+    g.instrumentation_status = response.status_code
+    return response
+
+
+@app.teardown_request
+async def finish_request_timer(exc):
+    stats = g.pop('instrumentation', None)
+    if stats is not None:
+        instrumentation.finish_request(stats, g.pop('instrumentation_status', 500))
+
+
+async def acquire():
+    started = time.perf_counter()
+    connection = await db_pool.acquire()
+    instrumentation.record_acquire(time.perf_counter() - started)
+    return connection
+
+
+async def fetch_all(sql, params=()):
+    connection = await acquire()
+    try:
+        async with connection.cursor() as cursor:
+            started = time.perf_counter()
+            await cursor.execute(sql, params)
+            rows = list(await cursor.fetchall())
+            instrumentation.record_query(sql, params, time.perf_counter() - started)
+            return rows
+    except asyncio.CancelledError:
+        # A query cut off by a timeout leaves the connection mid-result
+        connection.close()
+        raise
+    finally:
+        db_pool.release(connection)
+
+
+async def fetch_one(sql, params=()):
+    rows = await fetch_all(sql, params)
+    return rows[0] if rows else None
+
+
+def json_response(obj, status=200, headers=None):
+    return Response(flask_app.app.json.dumps(obj) + "\n", status=status,
+                    mimetype='application/json', headers=headers)
+
+
+def error(message, status):
+    return json_response({"error": message}, status)
+
+
+def release_slot():
+    global in_flight
+    in_flight -= 1
+    limiter.release()
+
+
+def limited(timeout=ROUTE_TIMEOUT):
+    """Caps concurrent requests and bounds the route's run time.
+
+    Requests that cannot get a slot within QUEUE_TIMEOUT get 503 and
+    handlers running longer than ``timeout`` seconds get 504. A handler
+    returning ``stream_response`` hands its slot to the stream, which
+    releases it when the body is done.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            global in_flight
+            try:
+                await asyncio.wait_for(limiter.acquire(), QUEUE_TIMEOUT)
+            except asyncio.TimeoutError:
+                response = error("Server busy, retry shortly.", 503)
+                response.headers['Retry-After'] = '1'
+                return response
+            in_flight += 1
+            try:
+                return await asyncio.wait_for(handler(*args, **kwargs), timeout)
+            except asyncio.TimeoutError:
+                return error("Request timed out.", 504)
+            except ValueError as e:
+                return error(str(e), 400)
+            except Exception as e:
+                return error(str(e), 500)
+            finally:
+                if not g.pop('slot_handed_off', False):
+                    release_slot()
+        return wrapper
+    return decorator
+
+
+async def stream_response(body, mimetype, timeout=STREAM_TIMEOUT):
+    """Streams ``body`` while holding the request's limiter slot, for at most ``timeout`` seconds.
+
+    The first chunk is produced before answering, so a failing query is
+    still an error status rather than a broken stream.
+    """
+    guarded = hold_slot(body, timeout)
+    # From here hold_slot releases the slot, however the stream ends
+    g.slot_handed_off = True
+    try:
+        first = await guarded.__anext__()
+    except StopAsyncIteration:
+        return Response('', mimetype=mimetype)
+    return Response(resume(first, guarded), mimetype=mimetype)
+
+
+async def hold_slot(body, timeout):
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(body.__anext__(), max(deadline - time.monotonic(), 0))
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                # Headers are sent by now, so the only signal left is a truncated body
+                break
+            yield chunk
+    finally:
+        try:
+            await body.aclose()
+        finally:
+            release_slot()
+
+
+async def resume(first, rest):
+    try:
+        yield first
+        async for chunk in rest:
+            yield chunk
+    finally:
+        await rest.aclose()
+
+
+async def cache_call(method, *args):
+    """Runs a response cache call, off the event loop when the backend is Redis."""
+    if isinstance(flask_app.response_cache.backend, RedisCache):
+        return await asyncio.get_running_loop().run_in_executor(None, method, *args)
+    return method(*args)
+
+
+async def cached(name, tags, build):
+    """Async counterpart of app.cached_response, sharing its cache and entries."""
+    cache = flask_app.response_cache
+    key = await cache_call(cache.key, name, tags)
+    entry = await cache_call(cache.get, key)
+    status = 'HIT'
+    if entry is None:
+        response = await build()
+        # Streamed bodies are not cached; reading one here would consume it
+        if response.status_code != 200 or not isinstance(response.response, DataBody):
+            return response
+        entry = flask_app.cache_entry(await response.get_data(as_text=True), response.headers)
+        await cache_call(cache.set, key, entry)
+        status = 'MISS'
+    etag = entry['etag']
+    if request.if_none_match.contains(etag):
+        response = Response('', status=304)
+    else:
+        response = Response(entry['body'], mimetype='application/json', headers=entry['headers'])
+    response.headers['ETag'] = f'"{etag}"'
+    response.headers['X-Cache'] = status
+    return response
+
+
+async def list_response(query, args):
+    """Async counterpart of app.list_response."""
+    fields = query.parse_fields(args.get('fields'))
+    token = args.get('cursor')
+    after = pagination.decode_cursor(token) if token else None
+    stream = args.get('stream')
+    if stream:
+        if stream not in ('ndjson', 'json'):
+            raise ValueError("stream must be 'ndjson' or 'json'")
+        mimetype = 'application/x-ndjson' if stream == 'ndjson' else 'application/json'
+        return await stream_response(stream_rows(query, fields, stream, after), mimetype)
+
+    limit = args.get('limit', type=int)
+    if token and limit is None:
+        limit = pagination.MAX_PAGE_SIZE
+    sql, params, limit = pagination.page_query(query, fields, after, limit)
+    rows, next_cursor = pagination.finish_page(await fetch_all(sql, params), limit)
+    headers = {}
+    if next_cursor:
+        params = args.to_dict()
+        params.update(cursor=next_cursor, limit=limit)
+        headers['X-Next-Cursor'] = next_cursor
+        headers['Link'] = f'<{request.base_url}?{urlencode(params)}>; rel="next"'
+    return json_response(rows, headers=headers)
+
+
+async def stream_rows(query, fields, fmt, after):
+    sql, params = query.sql(fields, after)
+    dumps = flask_app.app.json.dumps
+    connection = await acquire()
+    try:
+        cursor = await connection.cursor(aiomysql.SSDictCursor)
+        started = time.perf_counter()
+        await cursor.execute(sql, params)
+        instrumentation.record_query(sql, params, time.perf_counter() - started)
+        if fmt == 'json':
+            yield '['
+        first = True
+        while True:
+            rows = await cursor.fetchmany(pagination.STREAM_BATCH_SIZE)
+            if not rows:
+                break
+            chunk, first = pagination.encode_rows(rows, dumps, fmt, first)
+            yield chunk
+        if fmt == 'json':
+            yield ']'
+        await cursor.close()
+    except BaseException:
+        # A client that stops reading (or a timeout) leaves an unread result
+        # on the connection; closing the cursor would drain it, so drop both
+        connection.close()
+        raise
+    finally:
+        db_pool.release(connection)
+
+
+@app.route('/api/companies', methods=['GET'])
+@limited()
+async def get_companies():
+    if request.args.get('stream'):
+        return await list_response(flask_app.COMPANY_LIST, request.args)
+    return await cached(flask_app.query_key('companies', request.args), ['companies'],
+                        lambda: list_response(flask_app.COMPANY_LIST, request.args))
+
+
+@app.route('/api/companies/<string:symbol>', methods=['GET'])
+@limited()
+async def get_company(symbol):
+    async def load():
+        company = await fetch_one("SELECT * FROM companies WHERE symbol = %s", (symbol,))
+        if company:
+            return json_response(company)
+        return error("Company not found", 404)
+    tag = f"company:{symbol.upper()}"
+    return await cached(tag, [tag], load)
+
+
+@app.route('/api/companies/search', methods=['GET'])
+@limited(timeout=config('ASGI_SEARCH_TIMEOUT', default=2.0, cast=float))
+async def search_companies():
+    keyword = request.args.get('q', request.args.get('keyword', ''))
+    limit = max(1, min(request.args.get('limit', default=20, type=int), 200))
+    fields = request.args.get('fields')
+    fields = tuple(fields.split(',')) if fields else search_index.DEFAULT_FIELDS
+    unknown = set(fields) - set(company_ingest.COMPANY_COLUMNS)
+    if unknown:
+        return error(f"Unknown fields: {', '.join(sorted(unknown))}", 400)
+    if not flask_app.company_search.built:
+        flask_app.company_search.build(await fetch_all("SELECT * FROM companies"))
+    ranked = flask_app.company_search.rank(keyword, limit=limit,
+                                           prefix=request.args.get('prefix', default=1, type=int) == 1)
+    # Prices and market caps come from the table, not the cached documents
+    live = {}
+    query = search_index.live_query(ranked, fields)
+    if query:
+        live = {row['symbol']: row for row in await fetch_all(*query)}
+    return json_response(flask_app.company_search.project(ranked, fields, live))
+
+
+@app.route('/api/securities', methods=['GET'])
+@limited()
+async def get_securities():
+    return await list_response(flask_app.SECURITY_LIST, request.args)
+
+
+@app.route('/api/portfolio', methods=['GET'])
+@limited()
+async def get_portfolio():
+    # Assuming a fixed account_id for now, as in app.py
+    account_id = 1
+    query = flask_app.portfolio_list(account_id)
+    if request.args.get('stream'):
+        return await list_response(query, request.args)
+    return await cached(flask_app.query_key(f"portfolio:{account_id}", request.args),
+                        ['companies', f"account:{account_id}"],
+                        lambda: list_response(query, request.args))
+
+
+@app.route('/api/portfolio/summary/<int:account_id>', methods=['GET'])
+@limited()
+async def get_portfolio_summary(account_id):
+    async def load():
+        summary = await fetch_one("SELECT * FROM portfolio_summary WHERE account_id = %s", (account_id,))
+        if summary:
+            return json_response(summary)
+        return error("No summary data found for this account.", 404)
+    return await cached(f"summary:{account_id}", [f"account:{account_id}"], load)
+
+
+@app.route('/api/health/async', methods=['GET'])
+async def get_async_stats():
+    return json_response({
+        'in_flight': in_flight,
+        'max_concurrency': MAX_CONCURRENCY,
+        'db_pool_size': db_pool.size if db_pool else 0,
+        'db_pool_free': db_pool.freesize if db_pool else 0,
+    })
+
+
+class Dispatcher:
+    """Routes requests matching an async route to Quart and the rest to the Flask app."""
+
+    def __init__(self, asgi_app, wsgi_app):
+        self.asgi_app = asgi_app
+        self.wsgi_app = AsyncioWSGIMiddleware(wsgi_app)
+        self.adapter = asgi_app.url_map.bind('')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] != 'OPTIONS':
+            try:
+                self.adapter.match(scope['path'], method=scope['method'])
+            except HTTPException:
+                return await self.wsgi_app(scope, receive, send)
+            return await self.asgi_app(scope, receive, send)
+        if scope['type'] == 'http':
+            return await self.wsgi_app(scope, receive, send)
+        return await self.asgi_app(scope, receive, send)
+
+
+application = Dispatcher(app, flask_app.app)
+
+
+def main():
+    hypercorn_config = Config()
+    hypercorn_config.bind = [config('ASGI_BIND', default='0.0.0.0:8000')]
+    hypercorn_config.graceful_timeout = SHUTDOWN_TIMEOUT
+    hypercorn_config.keep_alive_timeout = config('ASGI_KEEP_ALIVE', default=75.0, cast=float)
+
+    # SIGINT/SIGTERM stop accepting connections, then drain in-flight requests
+    shutdown = asyncio.Event()
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, shutdown.set)
+        await serve(application, hypercorn_config, shutdown_trigger=shutdown.wait)
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
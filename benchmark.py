@@ -0,0 +1,390 @@
+import argparse
+import datetime
+import http.client
+import itertools
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+from collections import Counter
+from urllib.parse import quote, urlsplit
+
+import numpy as np
+import pandas as pd
+import pymysql
+
+DEFAULT_CONCURRENCY = '1,8,32'
+DEFAULT_REQUESTS = 200
+DEFAULT_LOADER_ROWS = 50000
+REQUEST_TIMEOUT = 120.0
+# First day of the synthetic bars written by the loader benchmark; far
+# enough back that they never overlap real history, and deleted afterwards
+LOADER_START_DATE = '1900-01-01'
+LOADER_SYMBOLS = 100
+
+# name -> (method, path, body, group). Paths and bodies are filled from the
+# fixtures picked out of the seeded database. 'read' endpoints run by
+# default, 'write' ones with --include-writes; 'skipped' ones call yfinance
+# or delete data and are only listed in the results.
+ENDPOINTS = {
+    'metrics': ('GET', '/metrics', None, 'read'),
+    'health-db-pool': ('GET', '/api/health/db-pool', None, 'read'),
+    'health-cache': ('GET', '/api/health/cache', None, 'read'),
+    'companies': ('GET', '/api/companies', None, 'read'),
+    'companies-page': ('GET', '/api/companies?limit=100', None, 'read'),
+    'companies-stream': ('GET', '/api/companies?stream=ndjson', None, 'read'),
+    'company': ('GET', '/api/companies/{symbol}', None, 'read'),
+    'company-search': ('GET', '/api/companies/search?q={search}', None, 'read'),
+    'securities': ('GET', '/api/securities', None, 'read'),
+    'portfolio': ('GET', '/api/portfolio', None, 'read'),
+    'portfolio-summary': ('GET', '/api/portfolio/summary/{account_id}', None, 'read'),
+    'portfolio-holdings-proc': ('GET', '/api/procedures/portfolio-holdings/{account_id}', None, 'read'),
+    'portfolio-value': ('GET', '/api/portfolio/value/{account_id}', None, 'read'),
+    'price-as-of': ('GET', '/api/prices/{security_id}?as_of={as_of}', None, 'read'),
+    'screens': ('GET', '/api/screens', None, 'read'),
+    'screen-tech-leaders': ('GET', '/api/screens/tech-leaders', None, 'read'),
+    'screen-high-momentum': ('GET', '/api/screens/high-momentum', None, 'read'),
+    'screen-undervalued': ('GET', '/api/screens/undervalued', None, 'read'),
+    'screen-sp500-vs-52w': ('GET', '/api/screens/sp500-vs-52w', None, 'read'),
+    'performance': ('GET', '/api/analytics/performance/{account_id}', None, 'read'),
+    'performance-all': ('GET', '/api/analytics/performance', None, 'read'),
+    'drawdown': ('GET', '/api/risk/drawdown/{account_id}', None, 'read'),
+    'drawdown-all': ('GET', '/api/risk/drawdown', None, 'read'),
+    'jobs': ('GET', '/api/jobs', None, 'read'),
+    'company-update': ('PUT', '/api/companies/{symbol}', 'company', 'write'),
+    'portfolio-update': ('PUT', '/api/portfolio/{ticker}', 'position', 'write'),
+    'portfolio-add': ('POST', '/api/portfolio/add', 'position', 'write'),
+    'transfer': ('POST', '/api/transactions/transfer', 'transfer', 'write'),
+    'transfer-batch': ('POST', '/api/transactions/batch', 'batch', 'write'),
+    'var': ('POST', '/api/risk/var/{account_id}', None, 'write'),
+    'var-all': ('POST', '/api/risk/var', None, 'write'),
+    'sharpe': ('POST', '/api/risk/sharpe/{account_id}', None, 'write'),
+    'sharpe-all': ('POST', '/api/risk/sharpe', None, 'write'),
+    'company-create': ('POST', '/api/companies', None, 'skipped'),
+    'company-bulk': ('POST', '/api/companies/bulk', None, 'skipped'),
+    'company-delete': ('DELETE', '/api/companies/{symbol}', None, 'skipped'),
+    'portfolio-delete': ('DELETE', '/api/portfolio/{ticker}', None, 'skipped'),
+}
+SKIP_REASONS = {
+    'company-create': "fetches from yfinance",
+    'company-bulk': "fetches from yfinance",
+    'company-delete': "deletes seeded data",
+    'portfolio-delete': "deletes seeded data",
+}
+TRANSFER_QUANTITY = 0.0001
+BATCH_LEGS = 10
+
+
+def load_fixtures(connection):
+    """Picks ids for the parameterised endpoints out of the seeded database."""
+    with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+        # The portfolio routes use account 1; transfers move between it and another account
+        cursor.execute("""
+            SELECT ph.account_id, ph.security_id, s.ticker, ph.quantity
+            FROM portfolio_holding ph JOIN security s ON ph.security_id = s.security_id
+            WHERE ph.account_id = 1 AND ph.quantity > 1
+            ORDER BY ph.quantity DESC LIMIT 1
+        """)
+        holding = cursor.fetchone()
+        if holding is None:
+            raise RuntimeError("Account 1 has no holdings; seed the database first (--seed-db).")
+        cursor.execute("SELECT MIN(account_id) AS account_id FROM broker_account WHERE account_id <> 1")
+        other = cursor.fetchone()
+        cursor.execute("SELECT symbol, short_name, long_name, sector, industry FROM companies WHERE symbol = %s",
+                       (holding['ticker'],))
+        company = cursor.fetchone()
+        cursor.execute("SELECT MAX(snapshot_ts) AS ts FROM price_snapshot WHERE security_id = %s",
+                       (holding['security_id'],))
+        latest = cursor.fetchone()
+    return {
+        'account_id': holding['account_id'],
+        'account_id2': other['account_id'],
+        'security_id': holding['security_id'],
+        'ticker': holding['ticker'],
+        'quantity': float(holding['quantity']),
+        'symbol': company['symbol'],
+        'search': (company['long_name'] or company['symbol']).split()[0],
+        'as_of': (latest['ts'] or datetime.datetime.now()).isoformat(),
+        'company': {k: company[k] for k in ('short_name', 'long_name', 'sector', 'industry')},
+    }
+
+
+def request_body(kind, fixtures):
+    if kind == 'company':
+        return fixtures['company']
+    if kind == 'position':
+        return {'ticker': fixtures['ticker'], 'quantity': fixtures['quantity']}
+    transfer = {'from_account': fixtures['account_id'], 'to_account': fixtures['account_id2'],
+                'security_id': fixtures['security_id'], 'quantity': TRANSFER_QUANTITY}
+    if kind == 'transfer':
+        return transfer
+    if kind == 'batch':
+        # Alternating directions, so a batch nets to zero
+        back = dict(transfer, from_account=transfer['to_account'], to_account=transfer['from_account'])
+        return {'legs': [transfer if i % 2 == 0 else back for i in range(BATCH_LEGS)]}
+    return None
+
+
+def percentiles(latencies):
+    values = np.asarray(latencies) * 1000
+    if not len(values):
+        return {}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {'mean': round(float(values.mean()), 3), 'p50': round(float(p50), 3), 'p90': round(float(p90), 3),
+            'p99': round(float(p99), 3), 'max': round(float(values.max()), 3)}
+
+
+def run_endpoint(base_url, method, path, body, concurrency, requests, warmup=0):
+    """Sends ``requests`` requests over ``concurrency`` keep-alive connections; returns latency and status stats."""
+    target = urlsplit(base_url)
+    payload = json.dumps(body) if body is not None else None
+    headers = {'Content-Type': 'application/json'} if payload else {}
+    latencies, statuses, lock = [], Counter(), threading.Lock()
+
+    def worker(tickets, total, record):
+        # http.client reopens the connection itself when the server closes it
+        connection = http.client.HTTPConnection(target.hostname, target.port, timeout=REQUEST_TIMEOUT)
+        while next(tickets) < total:
+            started = time.perf_counter()
+            try:
+                connection.request(method, target.path.rstrip('/') + path, body=payload, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                status = 'error'
+            elapsed = time.perf_counter() - started
+            if record:
+                with lock:
+                    latencies.append(elapsed)
+                    statuses[status] += 1
+        connection.close()
+
+    def run(total, record):
+        tickets = itertools.count()
+        threads = [threading.Thread(target=worker, args=(tickets, total, record)) for _ in range(min(concurrency, total))]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+    if warmup:
+        run(warmup, False)
+    elapsed = run(requests, True)
+    errors = sum(n for status, n in statuses.items() if status == 'error' or status >= 500)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'status': {str(status): n for status, n in sorted(statuses.items(), key=str)},
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'latency_ms': percentiles(latencies),
+    }
+
+
+def benchmark_endpoints(base_url, fixtures, concurrency_levels, requests, warmup, include_writes=False, only=None):
+    results, skipped = [], []
+    for name, (method, path, body, group) in ENDPOINTS.items():
+        if only and name not in only:
+            continue
+        url_path = path.format(**{k: quote(str(v)) for k, v in fixtures.items() if not isinstance(v, dict)})
+        if group == 'skipped' or (group == 'write' and not include_writes):
+            skipped.append({'name': name, 'method': method, 'path': url_path,
+                            'reason': SKIP_REASONS.get(name, "write endpoint; pass --include-writes")})
+            continue
+        for concurrency in concurrency_levels:
+            stats = run_endpoint(base_url, method, url_path, request_body(body, fixtures),
+                                 concurrency, requests, warmup)
+            results.append(dict({'name': name, 'method': method, 'path': url_path, 'concurrency': concurrency}, **stats))
+            latency = stats['latency_ms']
+            print(f"{name:<26} c={concurrency:<4} {stats['throughput_rps'] or 0:>9,.1f} req/s  "
+                  f"p50 {latency.get('p50', 0):>8.2f} ms  p99 {latency.get('p99', 0):>8.2f} ms  errors {stats['errors']}")
+    return results, skipped
+
+
+def write_stock_csv(path, symbols, rows, seed=None):
+    """Writes ``rows`` synthetic bars in the sp500_stocks.csv layout."""
+    rng = np.random.default_rng(seed)
+    days = pd.bdate_range(LOADER_START_DATE, periods=-(-rows // len(symbols)))
+    frame = pd.DataFrame({
+        'Date': np.repeat(days.strftime('%Y-%m-%d'), len(symbols)),
+        'Symbol': np.tile(symbols, len(days)),
+    }).iloc[:rows]
+    close = rng.uniform(10, 500, len(frame)).round(2)
+    frame['Adj Close'] = close
+    frame['Close'] = close
+    frame['High'] = (close * 1.01).round(2)
+    frame['Low'] = (close * 0.99).round(2)
+    frame['Open'] = close
+    frame['Volume'] = rng.integers(10 ** 5, 10 ** 7, len(frame)).astype(float)
+    frame.to_csv(path, index=False)
+    return frame['Date'].iloc[-1]
+
+
+def benchmark_loaders(rows, methods, seed=None, chunksize=None):
+    """Times load_data.load_csv_to_table on synthetic stock bars; the rows are deleted afterwards."""
+    import load_data
+
+    connection = load_data.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT symbol FROM companies ORDER BY symbol LIMIT %s", (LOADER_SYMBOLS,))
+            symbols = [row[0] for row in cursor.fetchall()]
+        if not symbols:
+            raise RuntimeError("No companies to attach benchmark bars to; seed the database first.")
+
+        results = []
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench_stocks.csv')
+            last_date = write_stock_csv(path, symbols, rows, seed)
+            for method in methods:
+                started = time.perf_counter()
+                loaded = load_data.load_csv_to_table(path, 'stock_prices', method=method, restart=True,
+                                                     chunksize=chunksize or load_data.CHUNK_SIZE, connection=connection)
+                elapsed = time.perf_counter() - started
+                results.append({'table': 'stock_prices', 'method': method, 'rows': loaded,
+                                'seconds': round(elapsed, 3), 'rows_per_sec': round(loaded / elapsed, 1)})
+                with connection.cursor() as cursor:
+                    cursor.execute("DELETE FROM stock_prices WHERE date BETWEEN %s AND %s",
+                                   (LOADER_START_DATE, last_date))
+                connection.commit()
+        return results
+    finally:
+        connection.close()
+
+
+def compare(results, baseline, tolerance):
+    """Endpoint and loader results more than ``tolerance`` worse than ``baseline``."""
+    regressions = []
+    previous = {(r['name'], r['concurrency']): r for r in baseline.get('endpoints', [])}
+    for result in results['endpoints']:
+        old = previous.get((result['name'], result['concurrency']))
+        if old is None:
+            continue
+        for metric in ('p50', 'p99'):
+            before, after = old['latency_ms'].get(metric), result['latency_ms'].get(metric)
+            if before and after and after > before * (1 + tolerance):
+                regressions.append({'name': result['name'], 'concurrency': result['concurrency'],
+                                    'metric': f'{metric}_ms', 'baseline': before, 'current': after})
+        before, after = old.get('throughput_rps'), result.get('throughput_rps')
+        if before and after and after < before * (1 - tolerance):
+            regressions.append({'name': result['name'], 'concurrency': result['concurrency'],
+                                'metric': 'throughput_rps', 'baseline': before, 'current': after})
+    previous = {(r['table'], r['method']): r for r in baseline.get('loaders', [])}
+    for result in results['loaders']:
+        old = previous.get((result['table'], result['method']))
+        if old and result['rows_per_sec'] < old['rows_per_sec'] * (1 - tolerance):
+            regressions.append({'name': f"load:{result['table']}", 'method': result['method'], 'metric': 'rows_per_sec',
+                                'baseline': old['rows_per_sec'], 'current': result['rows_per_sec']})
+    return regressions
+
+
+def start_local_server():
+    """Serves app.py on a free local port from a background thread; returns (base_url, server)."""
+    from werkzeug.serving import make_server
+    import app
+
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the API endpoints and data loaders against a seeded database.")
+    parser.add_argument('--base-url', help="server to load-test (default: serve app.py in-process)")
+    parser.add_argument('--concurrency', default=DEFAULT_CONCURRENCY, help="comma-separated concurrency levels")
+    parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS, help="requests per endpoint and level")
+    parser.add_argument('--warmup', type=int, default=20, help="unrecorded requests before each run")
+    parser.add_argument('--endpoints', help="comma-separated endpoint names to run (default: all)")
+    parser.add_argument('--include-writes', action='store_true', help="also run the write and risk endpoints")
+    parser.add_argument('--loader-rows', type=int, default=DEFAULT_LOADER_ROWS, help="0 skips the loader benchmark")
+    parser.add_argument('--loader-methods', default='executemany,infile')
+    parser.add_argument('--seed-db', action='store_true', help="populate the database before benchmarking")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--accounts', type=int, default=200)
+    parser.add_argument('--holdings', type=int, default=20000)
+    parser.add_argument('--snapshots', type=int, default=30, help="price snapshots per security")
+    parser.add_argument('--companies', type=int, default=0, help="synthetic companies to add")
+    parser.add_argument('--years', type=int, default=0, help="years of daily bars for the synthetic companies")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="results file (default: data/benchmarks/benchmark-<timestamp>.json)")
+    parser.add_argument('--baseline', help="earlier results file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative slowdown before a regression")
+    args = parser.parse_args()
+
+    scale = {k: getattr(args, k) for k in ('users', 'accounts', 'holdings', 'snapshots', 'companies', 'years', 'seed')}
+    if args.seed_db:
+        import populate_new_tables
+        populate_new_tables.populate_data(**scale)
+
+    import load_data
+    connection = load_data.get_connection()
+    try:
+        fixtures = load_fixtures(connection)
+    finally:
+        connection.close()
+
+    server = None
+    base_url = args.base_url
+    if base_url is None:
+        base_url, server = start_local_server()
+    started_at = datetime.datetime.now().isoformat(timespec='seconds')
+    try:
+        endpoints, skipped = benchmark_endpoints(
+            base_url, fixtures, [int(c) for c in args.concurrency.split(',')], args.requests, args.warmup,
+            include_writes=args.include_writes, only=set(args.endpoints.split(',')) if args.endpoints else None)
+    finally:
+        if server is not None:
+            server.shutdown()
+    loaders = benchmark_loaders(args.loader_rows, args.loader_methods.split(','), args.seed) if args.loader_rows else []
+    for result in loaders:
+        print(f"load {result['table']} ({result['method']}): {result['rows']:,} rows at {result['rows_per_sec']:,.0f} rows/sec")
+
+    results = {
+        'version': git_version(),
+        'started_at': started_at,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'base_url': args.base_url or 'in-process',
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'scale': scale if args.seed_db else None,
+        },
+        'endpoints': endpoints,
+        'skipped': skipped,
+        'loaders': loaders,
+    }
+    if args.baseline:
+        with open(args.baseline) as handle:
+            results['regressions'] = compare(results, json.load(handle), args.tolerance)
+        for regression in results['regressions']:
+            print(f"REGRESSION {regression['name']} {regression['metric']}: "
+                  f"{regression['baseline']} -> {regression['current']}")
+
+    output = args.output or os.path.join('data', 'benchmarks', f"benchmark-{started_at.replace(':', '')}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as handle:
+        json.dump(results, handle, indent=2, default=str)
+    print(f"Results written to {output}")
+    if results.get('regressions'):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire ``ttl`` seconds after being set.
+
+    Hit, miss and eviction counters are kept for monitoring.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._counters = {}
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                    self.evictions += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._counters.clear()
+
+    def counter(self, name):
+        """Current value of a named counter; counters never expire."""
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def incr(self, name):
+        with self._lock:
+            value = self._counters[name] = self._counters.get(name, 0) + 1
+            return value
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class RedisCache:
+    """TTLCache-compatible backend on a Redis (or Redis-protocol) client.
+
+    Values are stored as JSON, so they must be JSON-serializable. Expiry
+    and eviction are left to the server; ``stats()`` reports the server's
+    counters where available.
+    """
+
+    def __init__(self, client, ttl=300.0, prefix='cache:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        raw = self.client.get(self.prefix + key)
+        with self._lock:
+            if raw is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+        return json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.client.set(self.prefix + key, json.dumps(value), px=max(1, int(ttl * 1000)))
+
+    def delete(self, key):
+        return bool(self.client.delete(self.prefix + key))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+    def counter(self, name):
+        return int(self.client.get(self.prefix + 'counter:' + name) or 0)
+
+    def incr(self, name):
+        return self.client.incr(self.prefix + 'counter:' + name)
+
+    def stats(self):
+        try:
+            info = self.client.info('stats')
+            evictions = info.get('evicted_keys', 0) + info.get('expired_keys', 0)
+        except Exception:
+            evictions = None
+        with self._lock:
+            return {
+                'backend': 'redis',
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': evictions,
+            }
+
+
+class ResponseCache:
+    """Read-through cache of rendered responses with tag-based invalidation.
+
+    A key is a name plus the current generation of each of its tags, e.g.
+    ``account:1``. Invalidating a tag bumps its generation, so every entry
+    built under the old one becomes unreachable and ages out of the backend.
+    Readers take the key before querying the database, so a read racing a
+    write can only store its result under the superseded generation.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def key(self, name, tags=()):
+        return '|'.join([name] + [f"{tag}@{self.backend.counter('gen:' + tag)}" for tag in tags])
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, entry):
+        self.backend.set(key, entry)
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self.backend.incr('gen:' + tag)
+
+    def stats(self):
+        return self.backend.stats()
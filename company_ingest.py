@@ -0,0 +1,131 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import TTLCache
+
+COMPANY_COLUMNS = [
+    'exchange', 'symbol', 'short_name', 'long_name', 'sector', 'industry',
+    'current_price', 'market_cap', 'ebitda', 'revenue_growth', 'city', 'state',
+    'country', 'full_time_employees', 'long_business_summary', 'weight',
+]
+
+# yfinance `info` keys for each companies column
+INFO_KEYS = {
+    'exchange': 'exchange',
+    'symbol': 'symbol',
+    'short_name': 'shortName',
+    'long_name': 'longName',
+    'sector': 'sector',
+    'industry': 'industry',
+    'current_price': 'currentPrice',
+    'market_cap': 'marketCap',
+    'ebitda': 'ebitda',
+    'revenue_growth': 'revenueGrowth',
+    'city': 'city',
+    'state': 'state',
+    'country': 'country',
+    'full_time_employees': 'fullTimeEmployees',
+    'long_business_summary': 'longBusinessSummary',
+    'weight': 'weight',
+}
+
+UPSERT_BATCH_SIZE = 500
+
+
+class TickerNotFound(LookupError):
+    """Raised when the provider has no usable data for a ticker."""
+
+
+class YFinanceInfoProvider:
+    """Fetches company fundamentals from Yahoo Finance."""
+
+    def fetch_info(self, symbol):
+        import yfinance as yf
+        return yf.Ticker(symbol).info
+
+
+class CachedInfoProvider:
+    """Wraps a provider so repeated lookups within ``ttl`` seconds skip the network."""
+
+    def __init__(self, provider, ttl=3600.0, maxsize=5000):
+        self.provider = provider
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def fetch_info(self, symbol):
+        key = symbol.upper()
+        info = self.cache.get(key)
+        if info is None:
+            info = self.provider.fetch_info(symbol)
+            self.cache.set(key, info)
+        return info
+
+
+class RateLimiter:
+    """Token bucket allowing ``rate`` calls per second with bursts up to ``burst``."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def company_row(info):
+    """Maps a provider ``info`` dict to a companies row, or raises TickerNotFound."""
+    if not info or info.get('trailingPegRatio') is None or not info.get('symbol'):
+        raise TickerNotFound("Could not find data for ticker")
+    return {column: info.get(key) for column, key in INFO_KEYS.items()}
+
+
+def fetch_companies(provider, tickers, max_workers=8, rate_limiter=None):
+    """Fetches many tickers concurrently on a bounded thread pool.
+
+    Returns (rows, errors): companies rows for the tickers that resolved and a
+    {ticker: message} dict for the ones that did not.
+    """
+    tickers = list(dict.fromkeys(t.strip().upper() for t in tickers if t and t.strip()))
+
+    def fetch(ticker):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        return company_row(provider.fetch_info(ticker))
+
+    rows, errors = [], {}
+    if not tickers:
+        return rows, errors
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(tickers))) as executor:
+        futures = {ticker: executor.submit(fetch, ticker) for ticker in tickers}
+        for ticker, future in futures.items():
+            try:
+                rows.append(future.result())
+            except TickerNotFound:
+                errors[ticker] = f"Could not find data for ticker: {ticker}"
+            except Exception as e:
+                errors[ticker] = str(e)
+    return rows, errors
+
+
+def upsert_companies(cursor, rows, batch_size=UPSERT_BATCH_SIZE):
+    """Upserts company rows with multi-row INSERT ... ON DUPLICATE KEY UPDATE statements."""
+    updates = ', '.join(f"{c}=VALUES({c})" for c in COMPANY_COLUMNS if c != 'symbol')
+    placeholder = '(' + ', '.join(['%s'] * len(COMPANY_COLUMNS)) + ')'
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        sql = "INSERT INTO companies ({}) VALUES {} ON DUPLICATE KEY UPDATE {}".format(
+            ', '.join(COMPANY_COLUMNS), ', '.join([placeholder] * len(batch)), updates)
+        cursor.execute(sql, [row[c] for row in batch for c in COMPANY_COLUMNS])
+    return len(rows)
@@ -0,0 +1,246 @@
+import threading
+import time
+from collections import deque
+
+import pymysql
+
+SERVER_STATUS_IN_TRANS = 1
+# Errors after which a connection may be unusable (lost connection, server
+# gone away, command out of sync); the pool discards instead of reusing it
+BROKEN_ERRORS = (pymysql.err.OperationalError, pymysql.err.InterfaceError)
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out before the timeout."""
+
+
+class PooledConnection:
+    """Proxy around a pooled DB-API connection.
+
+    Behaves like the underlying connection, but leaving a ``with`` block (or
+    calling ``close()``) hands the connection back to the pool instead of
+    tearing it down. Any open transaction is rolled back on release. A
+    block that exits with a ``BROKEN_ERRORS`` error (or a non-``Exception``
+    such as ``KeyboardInterrupt``) discards the connection instead.
+    """
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+
+    @property
+    def raw(self):
+        return self._raw
+
+    def __getattr__(self, name):
+        if self._raw is None:
+            raise AttributeError(f"Connection already returned to pool: {name}")
+        return getattr(self._raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(broken=exc_type is not None and (not isinstance(exc, Exception) or isinstance(exc, BROKEN_ERRORS)))
+
+    def close(self, broken=False):
+        if self._raw is not None:
+            raw, self._raw = self._raw, None
+            self._pool.release(raw, broken=broken)
+
+
+class _Idle:
+    __slots__ = ('conn', 'last_used')
+
+    def __init__(self, conn, last_used):
+        self.conn = conn
+        self.last_used = last_used
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of DB-API connections.
+
+    ``creator`` is a zero-argument callable returning a new connection, so the
+    pool works the same against pymysql or an sqlite3 stand-in. Connections
+    idle for longer than ``max_idle`` seconds are evicted, and connections idle
+    for longer than ``health_check_after`` seconds are pinged before reuse.
+    """
+
+    def __init__(self, creator, max_size=10, min_idle=0, timeout=30.0,
+                 max_idle=300.0, health_check_after=30.0, health_check=None):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self._creator = creator
+        self.max_size = max_size
+        self.min_idle = min_idle
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_check_after = health_check_after
+        self._health_check = health_check or default_health_check
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._idle = deque()
+        self._size = 0
+        self._in_use = 0
+        self._waiters = 0
+        self._closed = False
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._created = 0
+        self._evicted = 0
+        self._failed_checks = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+
+    def connection(self, timeout=None):
+        """Checks out a connection, waiting up to ``timeout`` seconds."""
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        with self._lock:
+            if self._closed:
+                raise PoolTimeout("Connection pool is closed")
+            self._evict_idle_locked()
+            while True:
+                if self._idle:
+                    slot = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    slot = None
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(
+                        f"Timed out after {timeout:.1f}s waiting for a connection "
+                        f"({self._in_use}/{self.max_size} in use)")
+                self._waiters += 1
+                try:
+                    self._available.wait(remaining)
+                finally:
+                    self._waiters -= 1
+            self._in_use += 1
+
+        try:
+            conn = self._prepare(slot)
+        except Exception:
+            with self._lock:
+                self._in_use -= 1
+                self._size -= 1
+                self._available.notify()
+            raise
+
+        waited = time.monotonic() - start
+        with self._lock:
+            self._checkouts += 1
+            self._wait_time_total += waited
+            self._wait_time_max = max(self._wait_time_max, waited)
+        return PooledConnection(self, conn)
+
+    def _prepare(self, slot):
+        if slot is not None:
+            if time.monotonic() - slot.last_used < self.health_check_after:
+                return slot.conn
+            if self._health_check(slot.conn):
+                return slot.conn
+            _close_quietly(slot.conn)
+            with self._lock:
+                self._failed_checks += 1
+        conn = self._creator()
+        with self._lock:
+            self._created += 1
+        return conn
+
+    def release(self, conn, broken=False):
+        """Returns a checked-out connection to the pool."""
+        if not broken:
+            try:
+                if _in_transaction(conn):
+                    conn.rollback()
+            except Exception:
+                broken = True
+        with self._lock:
+            self._in_use -= 1
+            if broken or self._closed:
+                self._size -= 1
+            else:
+                self._idle.append(_Idle(conn, time.monotonic()))
+                conn = None
+            self._available.notify()
+        if conn is not None:
+            _close_quietly(conn)
+
+    def evict_idle(self):
+        """Closes connections that have been idle for longer than ``max_idle``."""
+        with self._lock:
+            self._evict_idle_locked()
+
+    def _evict_idle_locked(self):
+        if self.max_idle is None:
+            return
+        cutoff = time.monotonic() - self.max_idle
+        # Oldest connections sit at the left end of the deque.
+        while len(self._idle) > self.min_idle and self._idle[0].last_used < cutoff:
+            slot = self._idle.popleft()
+            self._size -= 1
+            self._evicted += 1
+            _close_quietly(slot.conn)
+
+    def close(self):
+        """Closes all idle connections and refuses further checkouts."""
+        with self._lock:
+            self._closed = True
+            while self._idle:
+                slot = self._idle.popleft()
+                self._size -= 1
+                _close_quietly(slot.conn)
+            self._available.notify_all()
+
+    def stats(self):
+        """Returns a snapshot of pool-level metrics."""
+        with self._lock:
+            return {
+                'max_size': self.max_size,
+                'size': self._size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiters': self._waiters,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'created': self._created,
+                'evicted': self._evicted,
+                'failed_health_checks': self._failed_checks,
+                'wait_time_total': round(self._wait_time_total, 6),
+                'wait_time_max': round(self._wait_time_max, 6),
+                'wait_time_avg': round(self._wait_time_total / self._checkouts, 6) if self._checkouts else 0.0,
+            }
+
+
+def default_health_check(conn):
+    """Pings a pymysql connection, or runs ``SELECT 1`` on anything else."""
+    try:
+        if hasattr(conn, 'ping'):
+            conn.ping(reconnect=False)
+        else:
+            conn.execute("SELECT 1")
+        return True
+    except Exception:
+        return False
+
+
+def _in_transaction(conn):
+    # pymysql exposes the server status flags; sqlite3 tracks it directly.
+    status = getattr(conn, 'server_status', None)
+    if status is not None:
+        return bool(status & SERVER_STATUS_IN_TRANS)
+    return getattr(conn, 'in_transaction', True)
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+import risk_engine
+
+
+def portfolio_values(holdings, symbols, prices):
+    """Daily value of each account's current holdings as a (dates x accounts) matrix.
+
+    Gaps are forward-filled by the loader; a symbol's value before its first
+    bar is held at its first price so listings don't show up as jumps.
+    """
+    account_ids, quantities, unpriced = risk_engine.quantity_matrix(holdings, symbols)
+    filled = pd.DataFrame(prices).bfill().to_numpy(dtype=np.float64)
+    return account_ids, np.nan_to_num(filled) @ quantities.T, unpriced
+
+
+def drawdown_stats(values):
+    """Computes drawdown statistics for every column of a (dates x portfolios) matrix.
+
+    Everything is derived from running-maximum arrays in one pass; returns a
+    dict of per-portfolio arrays plus the full underwater curve.
+    """
+    n = values.shape[0]
+    steps = np.arange(n)[:, None]
+    peaks = np.maximum.accumulate(values, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        underwater = np.where(peaks > 0, values / peaks - 1.0, 0.0)
+
+    # Index of the most recent peak at each date
+    peak_steps = np.maximum.accumulate(np.where(values >= peaks, steps, 0), axis=0)
+    cols = np.arange(values.shape[1])
+    trough = np.argmin(underwater, axis=0)
+    peak = peak_steps[trough, cols]
+
+    max_drawdown = underwater[trough, cols]
+    in_drawdown = max_drawdown < 0
+    recovered = (values >= peaks[trough, cols]) & (steps > trough)
+    has_recovery = recovered.any(axis=0) & in_drawdown
+    recovery = np.where(has_recovery, np.argmax(recovered, axis=0), -1)
+    duration = np.where(has_recovery, recovery, n - 1) - peak
+
+    return {
+        'underwater': underwater,
+        'max_drawdown': max_drawdown,
+        'peak': peak,
+        'trough': trough,
+        'recovery': recovery,
+        'duration': np.where(in_drawdown, duration, 0),
+        'longest_underwater': (steps - peak_steps).max(axis=0),
+    }
+
+
+def compute_drawdowns(connection, account_ids=None, start=None, end=None, include_curve=True):
+    """Returns drawdown summaries (and optionally underwater curves) for accounts."""
+    holdings = risk_engine.load_holdings(connection, account_ids)
+    if not holdings:
+        return []
+    symbols = {ticker for positions in holdings.values() for ticker in positions}
+    dates, symbols, prices = risk_engine.load_price_matrix(connection, symbols, start=start, end=end)
+    if len(dates) == 0:
+        raise ValueError("No price history in the requested window")
+
+    account_ids, values, unpriced = portfolio_values(holdings, symbols, prices)
+    stats = drawdown_stats(values)
+    labels = [str(d) for d in dates]
+
+    def label(step):
+        return labels[step] if step >= 0 else None
+
+    results = []
+    for col, account_id in enumerate(account_ids):
+        peak, trough, recovery = stats['peak'][col], stats['trough'][col], stats['recovery'][col]
+        result = {
+            'account_id': account_id,
+            'start': labels[0],
+            'end': labels[-1],
+            'max_drawdown': round(float(stats['max_drawdown'][col]), 6),
+            'peak_date': label(peak),
+            'trough_date': label(trough),
+            'recovery_date': label(recovery),
+            'drawdown_duration_days': int(stats['duration'][col]),
+            'longest_underwater_days': int(stats['longest_underwater'][col]),
+            'current_drawdown': round(float(stats['underwater'][-1, col]), 6),
+            'unpriced_symbols': unpriced.get(account_id, []),
+        }
+        if include_curve:
+            result['underwater'] = [
+                {'date': d, 'value': round(float(v), 4), 'drawdown': round(float(u), 6)}
+                for d, v, u in zip(labels, values[:, col], stats['underwater'][:, col])
+            ]
+        results.append(result)
+    return results
@@ -0,0 +1,192 @@
+import argparse
+import time
+
+import pandas as pd
+
+import load_data
+import price_store
+
+BATCH_SIZE = 20000
+PRICE_COLUMNS = ['date', 'symbol', 'adj_close', 'close', 'high', 'low', 'open', 'volume']
+
+
+class CsvPriceProvider:
+    """Local-file price source in the layout of data/sp500_stocks.csv and data/sp500_index.csv.
+
+    Files are streamed in chunks and only bars newer than the given
+    per-symbol dates are yielded.
+    """
+
+    def __init__(self, stocks_path=None, index_path=None, chunksize=load_data.CHUNK_SIZE):
+        self.stocks_path = stocks_path
+        self.index_path = index_path
+        self.chunksize = chunksize
+
+    def stock_bars(self, since):
+        """Yields DataFrames of bars newer than ``since[symbol]`` (all bars for unseen symbols)."""
+        if not self.stocks_path:
+            return
+        spec = load_data.TABLES['stock_prices']
+        for chunk in pd.read_csv(self.stocks_path, chunksize=self.chunksize, dtype=spec['dtypes']):
+            chunk = chunk.rename(columns=spec['rename'])[PRICE_COLUMNS]
+            yield newer_than(chunk, since)
+
+    def index_bars(self, since):
+        """Yields DataFrames of S&P 500 index values dated after ``since``."""
+        if not self.index_path:
+            return
+        spec = load_data.TABLES['sp500_index']
+        for chunk in pd.read_csv(self.index_path, chunksize=self.chunksize, dtype=spec['dtypes']):
+            chunk = chunk.rename(columns=spec['rename'])
+            if since is not None:
+                chunk = chunk[pd.to_datetime(chunk['date']) > pd.Timestamp(since)]
+            yield chunk
+
+
+class YFinancePriceProvider:
+    """Downloads daily bars from Yahoo Finance for symbols already in the database."""
+
+    def __init__(self, index_ticker='^GSPC'):
+        self.index_ticker = index_ticker
+
+    def _download(self, tickers, start):
+        import yfinance as yf
+        return yf.download(tickers, start=start, auto_adjust=False, group_by='ticker', progress=False)
+
+    def stock_bars(self, since):
+        known = [s for s, d in since.items() if d is not None]
+        if not known:
+            return
+        start = (min(pd.Timestamp(since[s]) for s in known) + pd.Timedelta(days=1)).date().isoformat()
+        data = self._download(known, start)
+        if data is None or data.empty:
+            return
+        frame = data.stack(level=0, future_stack=True).reset_index()
+        frame.columns = [str(c) for c in frame.columns]
+        frame = frame.rename(columns={'Date': 'date', 'Ticker': 'symbol', 'level_1': 'symbol'})
+        frame = frame.rename(columns=load_data.TABLES['stock_prices']['rename'])
+        frame['date'] = pd.to_datetime(frame['date']).dt.strftime('%Y-%m-%d')
+        yield newer_than(frame[PRICE_COLUMNS].dropna(subset=['close']), since)
+
+    def index_bars(self, since):
+        start = None if since is None else (pd.Timestamp(since) + pd.Timedelta(days=1)).date().isoformat()
+        data = self._download(self.index_ticker, start)
+        if data is None or data.empty:
+            return
+        close = data[self.index_ticker]['Close'] if self.index_ticker in data.columns.get_level_values(0) else data['Close']
+        yield pd.DataFrame({
+            'date': pd.to_datetime(close.index).strftime('%Y-%m-%d'),
+            'sp500_value': close.to_numpy(),
+        }).dropna()
+
+
+def newer_than(bars, since):
+    """Keeps rows whose date is after ``since[symbol]``; unseen symbols keep every row."""
+    cutoff = pd.to_datetime(bars['symbol'].map(since))
+    dates = pd.to_datetime(bars['date'])
+    return bars[cutoff.isna() | (dates > cutoff)]
+
+
+def latest_stock_dates(cursor):
+    """MAX(date) per symbol in one grouped query, for every symbol in companies."""
+    cursor.execute("""
+        SELECT c.symbol, MAX(sp.date)
+        FROM companies c
+        LEFT JOIN stock_prices sp ON sp.symbol = c.symbol
+        GROUP BY c.symbol
+    """)
+    return dict(_values(row) for row in cursor.fetchall())
+
+
+def ingest(provider, connection=None, batch_size=BATCH_SIZE):
+    """Appends bars newer than what is stored and refreshes companies.current_price.
+
+    Returns a summary with the number of stock and index rows written and
+    the symbols that received new bars.
+    """
+    own_connection = connection is None
+    connection = connection or load_data.get_connection()
+    started = time.monotonic()
+    summary = {'stock_rows': 0, 'index_rows': 0, 'symbols': []}
+    latest_close = {}
+    try:
+        with connection.cursor() as cursor:
+            since = latest_stock_dates(cursor)
+            pending = []
+            for bars in provider.stock_bars(since):
+                # Foreign key: only symbols present in companies can be stored
+                bars = bars[bars['symbol'].isin(since.keys())]
+                if bars.empty:
+                    continue
+                closes = bars.dropna(subset=['close']).sort_values('date').groupby('symbol').tail(1)
+                for symbol, date, close in closes[['symbol', 'date', 'close']].itertuples(index=False):
+                    if symbol not in latest_close or str(date) >= latest_close[symbol][0]:
+                        latest_close[symbol] = (str(date), float(close))
+                pending.append(bars)
+                if sum(len(b) for b in pending) >= batch_size:
+                    summary['stock_rows'] += _write_stock_bars(cursor, pending)
+                    connection.commit()
+                    pending = []
+            if pending:
+                summary['stock_rows'] += _write_stock_bars(cursor, pending)
+
+            if latest_close:
+                cursor.executemany("UPDATE companies SET current_price = %s WHERE symbol = %s",
+                                   [(close, symbol) for symbol, (_, close) in latest_close.items()])
+
+            cursor.execute("SELECT MAX(date) FROM sp500_index")
+            index_since = _values(cursor.fetchone())[0]
+            for bars in provider.index_bars(index_since):
+                if not bars.empty:
+                    columns, rows = load_data.prepare_chunk(bars, 'sp500_index')
+                    summary['index_rows'] += load_data.upsert_rows(cursor, 'sp500_index', columns, rows)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        if own_connection:
+            connection.close()
+
+    summary['symbols'] = sorted(latest_close)
+    summary['seconds'] = round(time.monotonic() - started, 3)
+    return summary
+
+
+def _values(row):
+    # Works with both tuple and dict cursors
+    return tuple(row.values()) if isinstance(row, dict) else row
+
+
+def _write_stock_bars(cursor, frames):
+    columns, rows = load_data.prepare_chunk(pd.concat(frames, ignore_index=True), 'stock_prices')
+    return load_data.upsert_rows(cursor, 'stock_prices', columns, rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Append new daily bars to stock_prices and sp500_index.")
+    parser.add_argument('--provider', choices=['csv', 'yfinance'], default='csv')
+    parser.add_argument('--stocks', default='data/sp500_stocks.csv', help="stock bars CSV (csv provider)")
+    parser.add_argument('--index', default='data/sp500_index.csv', help="S&P 500 index CSV (csv provider)")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--price-store', help="columnar price store directory to append the new bars to")
+    args = parser.parse_args()
+
+    if args.provider == 'yfinance':
+        provider = YFinancePriceProvider()
+    else:
+        provider = CsvPriceProvider(args.stocks, args.index)
+    summary = ingest(provider, batch_size=args.batch_size)
+    print(f"Ingested {summary['stock_rows']:,} stock bars for {len(summary['symbols'])} symbols "
+          f"and {summary['index_rows']:,} index values in {summary['seconds']}s.")
+    if args.price_store:
+        connection = load_data.get_connection()
+        try:
+            synced = price_store.PriceStore(args.price_store).sync(connection, force=True)
+        finally:
+            connection.close()
+        print(f"Appended {synced['dates']:,} dates to the price store at {args.price_store}.")
+
+
+if __name__ == "__main__":
+    main()
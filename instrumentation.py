@@ -0,0 +1,416 @@
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+MAX_LOGGED_SQL = 2000
+MAX_LOGGED_PARAMS = 500
+
+
+class Metrics:
+    """Thread-safe counters and histograms rendered in the Prometheus text format.
+
+    Collectors registered with ``register`` are called at scrape time and
+    return (name, type, help, {labels: value}) tuples, for gauges that are
+    read from elsewhere (e.g. the connection pool).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+
+    def counter(self, name, help):
+        self._meta[name] = ('counter', help, None)
+        self._counters.setdefault(name, {})
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ('histogram', help, tuple(buckets))
+        self._histograms.setdefault(name, {})
+
+    def register(self, collector):
+        self._collectors.append(collector)
+
+    def inc(self, name, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters[name]
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        buckets = self._meta[name][2]
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms[name]
+            state = series.get(key)
+            if state is None:
+                # Per-bucket counts (not cumulative), plus +Inf, sum
+                state = series[key] = [[0] * (len(buckets) + 1), 0.0]
+            state[0][bisect_left(buckets, value)] += 1
+            state[1] += value
+
+    def value(self, name, **labels):
+        """Current counter value, or (count, sum) for a histogram."""
+        key = _label_key(labels)
+        with self._lock:
+            if name in self._counters:
+                return self._counters[name].get(key, 0)
+            state = self._histograms[name].get(key)
+            return (sum(state[0]), state[1]) if state else (0, 0.0)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (kind, help, buckets) in self._meta.items():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == 'counter':
+                    for key, value in sorted(self._counters[name].items()):
+                        lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+                    continue
+                for key, (counts, total) in sorted(self._histograms[name].items()):
+                    cumulative = 0
+                    for bound, count in zip(buckets + ('+Inf',), counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(key + (('le', _format_value(bound)),))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {_format_value(total)}")
+                    lines.append(f"{name}_count{_format_labels(key)} {cumulative}")
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception:
+                logger.exception("Metrics collector failed")
+                continue
+            for name, kind, help, series in families:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in series.items():
+                    lines.append(f"{name}{_format_labels(_label_key(dict(labels)))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in key)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(key, escaped)) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, str):
+        return value
+    return repr(value) if isinstance(value, float) else str(int(value))
+
+
+metrics = Metrics()
+metrics.counter('http_requests_total', "Requests served, by route, method and status.")
+metrics.histogram('http_request_duration_seconds', "Request latency, by route and method.")
+metrics.histogram('http_request_db_queries', "Database queries issued per request, by route.", COUNT_BUCKETS)
+metrics.histogram('http_request_db_seconds', "Time spent in database queries per request, by route.")
+metrics.counter('db_queries_total', "Database statements executed, by operation.")
+metrics.histogram('db_query_duration_seconds', "Database statement latency, by operation.")
+metrics.counter('db_slow_queries_total', "Statements slower than the slow-query threshold, by operation.")
+metrics.counter('db_query_errors_total', "Statements that raised, by operation.")
+metrics.histogram('db_pool_acquire_seconds', "Time spent waiting for a pooled connection.")
+metrics.counter('profiles_written_total', "Sampling profiles dumped for slow requests.")
+
+
+class RequestStats:
+    """Per-request totals, reachable from any cursor through a context variable."""
+
+    __slots__ = ('route', 'method', 'started', 'queries', 'db_time', 'acquire_time', 'samples', 'thread')
+
+    def __init__(self, route, method):
+        self.route = route
+        self.method = method
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.acquire_time = 0.0
+        self.samples = None
+        self.thread = threading.get_ident()
+
+
+current_request = contextvars.ContextVar('current_request', default=None)
+# Set by instrument_flask: finds the stats of a request whose streamed body
+# runs outside the context it started in
+_request_stats = None
+
+# Statements slower than this are logged with their SQL and parameters
+slow_query_threshold = 0.5
+
+
+def current_stats():
+    stats = current_request.get()
+    if stats is None and _request_stats is not None:
+        stats = _request_stats()
+    return stats
+
+
+def record_query(sql, params, seconds, operation=None, error=False):
+    """Records one statement against the global metrics and the current request."""
+    operation = operation or statement_type(sql)
+    metrics.inc('db_queries_total', operation=operation)
+    metrics.observe('db_query_duration_seconds', seconds, operation=operation)
+    if error:
+        metrics.inc('db_query_errors_total', operation=operation)
+    stats = current_stats()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += seconds
+    if seconds >= slow_query_threshold:
+        metrics.inc('db_slow_queries_total', operation=operation)
+        where = f" in {stats.method} {stats.route}" if stats is not None else ""
+        logger.warning("Slow query (%.1f ms)%s: %s; params=%s", seconds * 1000, where,
+                       _truncate(' '.join(str(sql).split()), MAX_LOGGED_SQL), _truncate(repr(params), MAX_LOGGED_PARAMS))
+
+
+def record_acquire(seconds):
+    metrics.observe('db_pool_acquire_seconds', seconds)
+    stats = current_stats()
+    if stats is not None:
+        stats.acquire_time += seconds
+
+
+def statement_type(sql):
+    words = str(sql).split(None, 1)
+    return words[0].upper() if words else 'UNKNOWN'
+
+
+def _truncate(text, limit):
+    return text if len(text) <= limit else text[:limit] + f"... ({len(text) - limit} more chars)"
+
+
+class InstrumentedCursor:
+    """Cursor proxy that times execute, executemany and callproc."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._cursor.__exit__(exc_type, exc, tb)
+
+    def execute(self, query, args=None):
+        return self._timed(self._cursor.execute, query, args, None)
+
+    def executemany(self, query, args):
+        return self._timed(self._cursor.executemany, query, args, None)
+
+    def callproc(self, procname, args=()):
+        return self._timed(self._cursor.callproc, procname, args, 'CALL')
+
+    def _timed(self, method, query, args, operation):
+        started = time.perf_counter()
+        try:
+            result = method(query) if args is None else method(query, args)
+        except Exception:
+            record_query(query, args, time.perf_counter() - started, operation, error=True)
+            raise
+        record_query(query, args, time.perf_counter() - started, operation)
+        return result
+
+
+class InstrumentedConnection:
+    """Connection proxy whose cursors are InstrumentedCursors; works with ``with`` like the pooled connection."""
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __enter__(self):
+        self._connection.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._connection.__exit__(exc_type, exc, tb)
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._connection.cursor(*args, **kwargs))
+
+
+def instrumented_checkout(pool):
+    """Checks a connection out of ``pool``, recording the wait, and wraps it."""
+    started = time.perf_counter()
+    connection = pool.connection()
+    record_acquire(time.perf_counter() - started)
+    return InstrumentedConnection(connection)
+
+
+def pool_collector(pool, prefix='db_pool'):
+    """Collector exposing ConnectionPool.stats() as gauges and counters."""
+    gauges = ('max_size', 'size', 'in_use', 'idle', 'waiters')
+    counters = ('checkouts', 'timeouts', 'created', 'evicted', 'failed_health_checks')
+
+    def collect():
+        stats = pool.stats()
+        families = [(f"{prefix}_{name}", 'gauge', f"Connection pool {name.replace('_', ' ')}.", {(): stats[name]})
+                    for name in gauges]
+        families += [(f"{prefix}_{name}_total", 'counter', f"Connection pool {name.replace('_', ' ')}.", {(): stats[name]})
+                     for name in counters]
+        return families
+    return collect
+
+
+class SamplingProfiler:
+    """Samples the stacks of threads serving requests at a fixed interval.
+
+    One daemon thread reads ``sys._current_frames()`` every ``interval``
+    seconds and adds each watched thread's stack to its request's samples,
+    so the cost does not grow with the request rate. ``dump`` writes the
+    samples of a slow request in the collapsed-stack format understood by
+    flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, directory, interval=0.005):
+        self.directory = directory
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._watched = {}
+        self._thread = None
+
+    def watch(self, stats):
+        stats.samples = Counter()
+        with self._lock:
+            self._watched[stats.thread] = stats
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+                self._thread.start()
+
+    def unwatch(self, stats):
+        with self._lock:
+            if self._watched.get(stats.thread) is stats:
+                del self._watched[stats.thread]
+
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                watched = dict(self._watched)
+            if not watched:
+                continue
+            frames = sys._current_frames()
+            for ident, stats in watched.items():
+                frame = frames.get(ident)
+                if frame is None or ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stats.samples[';'.join(reversed(stack))] += 1
+
+    def dump(self, stats, duration):
+        if not stats.samples:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        route = ''.join(c if c.isalnum() else '_' for c in stats.route).strip('_') or 'root'
+        path = os.path.join(self.directory, f"{time.strftime('%Y%m%dT%H%M%S')}_{stats.method}_{route}_{int(duration * 1000)}ms.folded")
+        with open(path, 'w') as handle:
+            for stack, count in stats.samples.most_common():
+                handle.write(f"{stack} {count}\n")
+        metrics.inc('profiles_written_total', route=stats.route)
+        return path
+
+
+def start_request(route, method, profiler=None):
+    stats = RequestStats(route, method)
+    current_request.set(stats)
+    if profiler is not None:
+        profiler.watch(stats)
+    return stats
+
+
+def finish_request(stats, status, profiler=None, profile_after=None):
+    """Records the request's latency and DB totals, dumping a profile if it ran slow."""
+    duration = time.perf_counter() - stats.started
+    if current_request.get() is stats:
+        current_request.set(None)
+    metrics.inc('http_requests_total', route=stats.route, method=stats.method, status=status)
+    metrics.observe('http_request_duration_seconds', duration, route=stats.route, method=stats.method)
+    metrics.observe('http_request_db_queries', stats.queries, route=stats.route)
+    metrics.observe('http_request_db_seconds', stats.db_time, route=stats.route)
+    if status >= 500:
+        logger.warning("%s %s returned %s in %.1f ms", stats.method, stats.route, status, duration * 1000)
+    if profiler is not None:
+        profiler.unwatch(stats)
+        if profile_after is not None and duration >= profile_after:
+            path = profiler.dump(stats, duration)
+            if path:
+                logger.info("Slow request %s %s (%.1f ms, %d queries); profile written to %s",
+                            stats.method, stats.route, duration * 1000, stats.queries, path)
+    return duration
+
+
+def server_timing(stats, duration):
+    """Value for a Server-Timing header breaking the request down for browser devtools."""
+    return (f"db;dur={stats.db_time * 1000:.1f};desc=\"{stats.queries} queries\", "
+            f"pool;dur={stats.acquire_time * 1000:.1f}, total;dur={duration * 1000:.1f}")
+
+
+def instrument_flask(app, profiler=None, profile_after=None):
+    """Times every request of a Flask app and records its DB totals.
+
+    Requests are labelled by URL rule (``/api/companies/<string:symbol>``)
+    so labels stay bounded; unmatched paths share the ``unmatched`` label.
+    Streamed responses are timed until the stream closes.
+    """
+    global _request_stats
+    from flask import g, has_request_context, request
+
+    _request_stats = lambda: g.get('_instrumentation') if has_request_context() else None
+
+    @app.before_request
+    def _start_request_timer():
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        g._instrumentation = start_request(route, request.method, profiler)
+
+    @app.after_request
+    def _record_status(response):
+        stats = g.get('_instrumentation')
+        if stats is None:
+            return response
+        if response.is_streamed:
+            # Teardown runs before the body is sent; finish when the stream closes
+            g._instrumentation_streamed = True
+            status = response.status_code
+            response.call_on_close(lambda: finish_request(stats, status, profiler, profile_after))
+        else:
+            g._instrumentation_status = response.status_code
+            response.headers['Server-Timing'] = server_timing(stats, time.perf_counter() - stats.started)
+        return response
+
+    @app.teardown_request
+    def _finish_request_timer(exc):
+        if g.get('_instrumentation_streamed'):
+            return
+        stats = g.pop('_instrumentation', None)
+        if stats is not None:
+            finish_request(stats, g.pop('_instrumentation_status', 500), profiler, profile_after)
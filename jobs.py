@@ -0,0 +1,532 @@
+"""Background jobs for the risk recalculations.
+
+Jobs are rows in ``risk_job`` (schema_updates_v2.sql), so the queue
+survives restarts and is shared by every API and worker process. Workers
+claim jobs with ``SELECT ... FOR UPDATE SKIP LOCKED`` and hold a lease,
+renewed while the job runs, so a crashed worker's jobs are picked up
+again. Queued per-account jobs of the same kind and options are claimed
+together and computed in one batched pass. Run a dedicated worker with:
+
+    python jobs.py --workers 4
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+import pymysql
+from decouple import config
+
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+LEASE_SECONDS = 300
+POLL_INTERVAL = 1.0
+MAX_ATTEMPTS = 3
+RETRY_BACKOFF = 30.0  # seconds before the first retry, doubled for each further one
+MAX_ERROR_LENGTH = 2000
+NO_RESULT = "No holdings found for this account."
+JOB_COLUMNS = ('job_id', 'kind', 'account_id', 'options', 'status', 'attempts', 'result', 'error',
+               'worker', 'run_after', 'created_at', 'started_at', 'finished_at')
+DURATION_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+# Errors caused by one account's data. A batch failing with one of these is
+# re-run job by job; anything else (lost connections, lock wait timeouts,
+# deadlocks) would hit every job alike, so the whole batch is retried.
+DATA_ERRORS = (ValueError, LookupError, ArithmeticError, TypeError,
+               pymysql.err.DataError, pymysql.err.IntegrityError)
+
+# kind -> handler(account_ids, options), filled in with ``register``
+HANDLERS = {}
+
+instrumentation.metrics.counter('jobs_enqueued_total', "Jobs enqueued, by kind and whether a queued duplicate was reused.")
+instrumentation.metrics.counter('jobs_finished_total', "Job attempts finished, by kind and outcome (done, retry, failed).")
+instrumentation.metrics.histogram('job_batch_duration_seconds', "Handler run time per claimed batch, by kind.", DURATION_BUCKETS)
+
+
+def register(kind):
+    """Decorator registering the handler for a job kind.
+
+    The handler is called as ``handler(account_ids, options)``. For a batch
+    of per-account jobs it gets the sorted account ids and returns
+    ``{account_id: result}``; accounts missing from the mapping fail with
+    NO_RESULT. For a job without an account it gets None and returns the
+    job's result. A ValueError fails the job without a retry.
+    """
+    def decorator(handler):
+        HANDLERS[kind] = handler
+        return handler
+    return decorator
+
+
+def options_key(options):
+    return hashlib.sha1(json.dumps(options, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def job_dedupe_key(kind, account_id, key):
+    """Key shared by queued jobs of one kind, account and options."""
+    return f"{kind}:{'all' if account_id is None else account_id}:{key}"
+
+
+def enqueue(connection, kind, account_id=None, options=None, delay=0, dedupe_key=None):
+    """Queues a job and returns (job_id, created).
+
+    A queued job with the same kind, account and options (or the same
+    explicit ``dedupe_key``) is returned instead of adding a second one.
+    """
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    options = options or {}
+    key = options_key(options)
+    if dedupe_key is None:
+        dedupe_key = job_dedupe_key(kind, account_id, key)
+    with connection.cursor() as cursor:
+        # LAST_INSERT_ID(job_id) makes lastrowid the existing job on a duplicate
+        cursor.execute("""
+            INSERT INTO risk_job (kind, account_id, options, options_key, queue_key, dedupe_key, run_after)
+            VALUES (%s, %s, %s, %s, %s, %s, NOW() + INTERVAL %s SECOND)
+            ON DUPLICATE KEY UPDATE job_id = LAST_INSERT_ID(job_id)
+        """, (kind, account_id, json.dumps(options, sort_keys=True), key, dedupe_key, dedupe_key, int(delay)))
+        created = cursor.rowcount == 1
+        job_id = cursor.lastrowid
+    connection.commit()
+    instrumentation.metrics.inc('jobs_enqueued_total', kind=kind, deduplicated=str(not created).lower())
+    return job_id, created
+
+
+def enqueue_many(connection, kind, account_ids, options=None):
+    """Queues one job per account with the same options, skipping queued duplicates.
+
+    Returns the number of jobs created.
+    """
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    options = options or {}
+    key = options_key(options)
+    encoded = json.dumps(options, sort_keys=True)
+    rows = [(kind, account_id, encoded, key, *[job_dedupe_key(kind, account_id, key)] * 2)
+            for account_id in dict.fromkeys(account_ids)]
+    with connection.cursor() as cursor:
+        created = 0
+        for row in rows:
+            cursor.execute("""
+                INSERT INTO risk_job (kind, account_id, options, options_key, queue_key, dedupe_key, run_after)
+                VALUES (%s, %s, %s, %s, %s, %s, NOW())
+                ON DUPLICATE KEY UPDATE job_id = job_id
+            """, row)
+            created += cursor.rowcount == 1
+    connection.commit()
+    instrumentation.metrics.inc('jobs_enqueued_total', created, kind=kind, deduplicated='false')
+    instrumentation.metrics.inc('jobs_enqueued_total', len(rows) - created, kind=kind, deduplicated='true')
+    return created
+
+
+def claim(connection, worker, batch_size=BATCH_SIZE, lease=LEASE_SECONDS):
+    """Locks the oldest runnable job, plus up to ``batch_size - 1`` queued
+    per-account jobs of the same kind and options, and marks them running.
+
+    A running job gives up its dedupe key, so a request arriving meanwhile
+    queues a fresh job instead of getting a result computed before it.
+    """
+    columns = "job_id, kind, account_id, options, options_key, attempts"
+    connection.begin()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT {columns} FROM risk_job
+                WHERE status = 'queued' AND run_after <= NOW()
+                ORDER BY run_after, job_id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            """)
+            first = cursor.fetchone()
+            if first is None:
+                connection.commit()
+                return []
+            jobs = [first]
+            if first['account_id'] is not None and batch_size > 1:
+                cursor.execute(f"""
+                    SELECT {columns} FROM risk_job
+                    WHERE status = 'queued' AND kind = %s AND options_key = %s
+                      AND account_id IS NOT NULL AND run_after <= NOW() AND job_id <> %s
+                    ORDER BY job_id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                """, (first['kind'], first['options_key'], first['job_id'], batch_size - 1))
+                jobs += cursor.fetchall()
+            ids = [job['job_id'] for job in jobs]
+            cursor.execute(f"""
+                UPDATE risk_job
+                SET status = 'running', dedupe_key = NULL, attempts = attempts + 1, worker = %s,
+                    started_at = NOW(), locked_until = NOW() + INTERVAL %s SECOND
+                WHERE job_id IN ({', '.join(['%s'] * len(ids))})
+            """, (worker, int(lease), *ids))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    for job in jobs:
+        job['options'] = _decode(job['options']) or {}
+        job['attempts'] += 1
+        job['worker'] = worker
+    return jobs
+
+
+def execute(jobs):
+    """Runs a claimed batch through its handler.
+
+    Returns {job_id: (result, error, retry)}. When a batch fails on a data
+    error its jobs are re-run one at a time, so a single bad account fails
+    alone; other errors send the whole batch back to the queue.
+    """
+    first = jobs[0]
+    handler = HANDLERS.get(first['kind'])
+    if handler is None:
+        return {job['job_id']: (None, f"Unknown job kind: {first['kind']}", False) for job in jobs}
+    try:
+        if first['account_id'] is None:
+            return {first['job_id']: (handler(None, first['options']), None, False)}
+        results = handler(sorted({job['account_id'] for job in jobs}), first['options'])
+    except Exception as e:
+        if len(jobs) > 1 and isinstance(e, DATA_ERRORS):
+            outcomes = {}
+            for job in jobs:
+                outcomes.update(execute([job]))
+            return outcomes
+        if not isinstance(e, ValueError):
+            logger.exception("Jobs %s (%s) failed", [job['job_id'] for job in jobs], first['kind'])
+        outcome = (None, str(e) or type(e).__name__, not isinstance(e, ValueError))
+        return {job['job_id']: outcome for job in jobs}
+    return {job['job_id']: (results[job['account_id']], None, False) if job['account_id'] in results
+            else (None, NO_RESULT, False) for job in jobs}
+
+
+def record_outcomes(connection, jobs, outcomes):
+    """Stores results, and requeues retryable failures with exponential backoff.
+
+    Only jobs still running under the worker that claimed them are updated,
+    so a worker whose lease expired cannot overwrite a newer attempt. A
+    requeued job takes its dedupe key back; if a duplicate was queued while
+    it ran, that job does the work and this one fails as superseded.
+    """
+    done, retry, failed = [], [], []
+    for job in jobs:
+        result, error, retryable = outcomes[job['job_id']]
+        if error is None:
+            done.append((json.dumps(result, default=str), job['job_id'], job['worker']))
+            outcome = 'done'
+        elif retryable and job['attempts'] < MAX_ATTEMPTS:
+            retry.append((error[:MAX_ERROR_LENGTH], int(RETRY_BACKOFF * 2 ** (job['attempts'] - 1)),
+                          job['job_id'], job['worker']))
+            outcome = 'retry'
+        else:
+            failed.append((error[:MAX_ERROR_LENGTH], job['job_id'], job['worker']))
+            outcome = 'failed'
+        instrumentation.metrics.inc('jobs_finished_total', kind=job['kind'], outcome=outcome)
+    with connection.cursor() as cursor:
+        if done:
+            cursor.executemany("""
+                UPDATE risk_job SET status = 'done', result = %s, error = NULL,
+                    locked_until = NULL, finished_at = NOW()
+                WHERE job_id = %s AND status = 'running' AND worker = %s
+            """, done)
+        if retry:
+            # IGNORE leaves a job whose key was taken by a newer duplicate running
+            cursor.executemany("""
+                UPDATE IGNORE risk_job SET status = 'queued', error = %s, locked_until = NULL,
+                    dedupe_key = queue_key, run_after = NOW() + INTERVAL %s SECOND
+                WHERE job_id = %s AND status = 'running' AND worker = %s
+            """, retry)
+            failed += [(f"{error} (superseded by a queued duplicate)"[:MAX_ERROR_LENGTH], job_id, worker)
+                       for error, _, job_id, worker in retry]
+        if failed:
+            cursor.executemany("""
+                UPDATE risk_job SET status = 'failed', error = %s, locked_until = NULL, finished_at = NOW()
+                WHERE job_id = %s AND status = 'running' AND worker = %s
+            """, failed)
+    connection.commit()
+
+
+def renew_leases(connection, worker, job_ids, lease=LEASE_SECONDS):
+    """Extends the leases of the jobs ``worker`` is still running."""
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            UPDATE risk_job SET locked_until = NOW() + INTERVAL %s SECOND
+            WHERE status = 'running' AND worker = %s AND job_id IN ({', '.join(['%s'] * len(job_ids))})
+        """, (int(lease), worker, *job_ids))
+    connection.commit()
+
+
+def requeue_expired(connection):
+    """Requeues running jobs whose worker stopped renewing its lease,
+    or fails them once they are out of attempts or superseded by a queued duplicate."""
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE IGNORE risk_job
+            SET status = 'queued', dedupe_key = queue_key, finished_at = NULL,
+                error = 'Worker lease expired', locked_until = NULL
+            WHERE status = 'running' AND locked_until < NOW() AND attempts < %s
+        """, (MAX_ATTEMPTS,))
+        requeued = cursor.rowcount
+        cursor.execute("""
+            UPDATE risk_job
+            SET status = 'failed', finished_at = NOW(), locked_until = NULL,
+                error = IF(attempts >= %s, 'Worker lease expired',
+                           'Worker lease expired (superseded by a queued duplicate)')
+            WHERE status = 'running' AND locked_until < NOW()
+        """, (MAX_ATTEMPTS,))
+    connection.commit()
+    return requeued
+
+
+def get_job(connection, job_id):
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM risk_job WHERE job_id = %s", (job_id,))
+        job = cursor.fetchone()
+    return _job(job) if job else None
+
+
+def list_jobs(connection, status=None, kind=None, account_id=None, limit=50):
+    """Most recent jobs first, without their results."""
+    filters, params = [], []
+    for column, value in (('status', status), ('kind', kind), ('account_id', account_id)):
+        if value is not None:
+            filters.append(f"{column} = %s")
+            params.append(value)
+    where = f"WHERE {' AND '.join(filters)}" if filters else ""
+    columns = ', '.join(c for c in JOB_COLUMNS if c != 'result')
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT {columns} FROM risk_job {where} ORDER BY job_id DESC LIMIT %s", (*params, limit))
+        return [_job(row) for row in cursor.fetchall()]
+
+
+def purge(connection, older_than_days):
+    """Deletes finished jobs older than ``older_than_days``."""
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            DELETE FROM risk_job
+            WHERE status IN ('done', 'failed') AND finished_at < NOW() - INTERVAL %s DAY
+        """, (int(older_than_days),))
+        deleted = cursor.rowcount
+    connection.commit()
+    return deleted
+
+
+def queue_collector(connect):
+    """Collector exposing the number of queued and running jobs per kind."""
+    def collect():
+        with connect() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    SELECT status, kind, COUNT(*) AS jobs FROM risk_job
+                    WHERE status IN ('queued', 'running')
+                    GROUP BY status, kind
+                """)
+                rows = cursor.fetchall()
+        return [('jobs_in_queue', 'gauge', "Queued and running jobs, by status and kind.",
+                 {(('status', r['status']), ('kind', r['kind'])): r['jobs'] for r in rows})]
+    return collect
+
+
+def _job(row):
+    job = dict(row)
+    for column in ('options', 'result'):
+        if column in job:
+            job[column] = _decode(job[column])
+    return job
+
+
+def _decode(value):
+    if isinstance(value, (bytes, str)):
+        return json.loads(value)
+    return value
+
+
+class WorkerPool:
+    """Worker threads that claim and run queued jobs until ``stop`` is called.
+
+    ``connect`` returns a connection with dict rows that can be used as a
+    context manager (e.g. app.get_db_connection). Workers only hold one
+    while claiming or recording jobs, not while a handler runs. A
+    housekeeping thread renews the leases of running jobs and requeues
+    jobs abandoned by other workers.
+    """
+
+    def __init__(self, connect, workers=2, batch_size=BATCH_SIZE, poll_interval=POLL_INTERVAL,
+                 lease=LEASE_SECONDS):
+        self.connect = connect
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._running = {}
+        self._threads = []
+
+    def start(self):
+        if self._threads:
+            return self
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._work, args=(f"{self.name}:{i}",),
+                                          name=f"job-worker-{i}", daemon=True)
+                         for i in range(self.workers)]
+        self._threads.append(threading.Thread(target=self._housekeeping, name="job-housekeeping", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stops claiming jobs and waits for the running ones to finish."""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def run_once(self, worker=None):
+        """Claims and runs one batch; returns the claimed jobs (empty if none was ready)."""
+        with self.connect() as connection:
+            jobs = claim(connection, worker or self.name, self.batch_size, self.lease)
+        if not jobs:
+            return jobs
+        ids = [job['job_id'] for job in jobs]
+        with self._lock:
+            self._running.update((job['job_id'], job['worker']) for job in jobs)
+        try:
+            started = time.perf_counter()
+            outcomes = execute(jobs)
+            instrumentation.metrics.observe('job_batch_duration_seconds', time.perf_counter() - started,
+                                            kind=jobs[0]['kind'])
+            with self.connect() as connection:
+                record_outcomes(connection, jobs, outcomes)
+        finally:
+            with self._lock:
+                for job_id in ids:
+                    self._running.pop(job_id, None)
+        return jobs
+
+    def _work(self, worker):
+        while not self._stop.is_set():
+            try:
+                jobs = self.run_once(worker)
+            except Exception:
+                logger.exception("Job worker %s failed", worker)
+                jobs = None
+            if not jobs:
+                self._stop.wait(self.poll_interval)
+
+    def _housekeeping(self):
+        while not self._stop.wait(self.lease / 3):
+            with self._lock:
+                running = {}
+                for job_id, worker in self._running.items():
+                    running.setdefault(worker, []).append(job_id)
+            try:
+                with self.connect() as connection:
+                    for worker, job_ids in running.items():
+                        renew_leases(connection, worker, job_ids, self.lease)
+                    requeue_expired(connection)
+            except Exception:
+                logger.exception("Job housekeeping failed")
+
+
+def next_run(at, now=None):
+    """The next local datetime at ``at`` (HH:MM) after ``now``."""
+    now = now or datetime.datetime.now()
+    hour, minute = (int(part) for part in at.split(':'))
+    run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return run if run > now else run + datetime.timedelta(days=1)
+
+
+class Scheduler:
+    """Enqueues a ``kind`` job every day at ``at`` (local HH:MM).
+
+    The job is queued ahead of time with a per-day dedupe key, so every
+    process can run a scheduler and they still share one job per day.
+    """
+
+    def __init__(self, connect, kind, at, options=None):
+        next_run(at)  # validates the time
+        self.connect = connect
+        self.kind = kind
+        self.at = at
+        self.options = options or {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=f"job-scheduler-{self.kind}", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            run = next_run(self.at)
+            delay = (run - datetime.datetime.now()).total_seconds()
+            try:
+                with self.connect() as connection:
+                    enqueue(connection, self.kind, options=self.options, delay=delay,
+                            dedupe_key=f"{self.kind}:{run:%Y-%m-%d}")
+            except Exception:
+                logger.exception("Could not schedule the %s job", self.kind)
+                self._stop.wait(60)
+                continue
+            self._stop.wait(delay + 1)
+
+
+def start(connect, workers, nightly_at=None, **options):
+    """Starts a WorkerPool and, with ``nightly_at``, the nightly Scheduler.
+
+    Returns a function that stops both, waiting for running jobs to finish.
+    """
+    pool = WorkerPool(connect, workers=workers, **options).start()
+    scheduler = Scheduler(connect, 'nightly', nightly_at).start() if nightly_at else None
+    logger.info("Running %d job workers as %s", workers, pool.name)
+
+    def stop():
+        logger.info("Stopping job workers; waiting for running jobs to finish")
+        if scheduler is not None:
+            scheduler.stop()
+        pool.stop()
+    return stop
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run background job workers against the risk_job queue.")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL)
+    parser.add_argument('--no-schedule', action='store_true', help="do not queue the nightly job from this process")
+    args = parser.parse_args()
+
+    import app as api  # registers the handlers
+
+    logging.basicConfig(level=config('LOG_LEVEL', default='INFO'),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    stop = start(api.get_db_connection, args.workers, None if args.no_schedule else api.NIGHTLY_AT,
+                 batch_size=args.batch_size, poll_interval=args.poll_interval)
+    stopping = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stopping.set())
+    stopping.wait()
+    stop()
+
+
+if __name__ == "__main__":
+    main()
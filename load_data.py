@@ -1,8 +1,12 @@
+import argparse
+import json
+import os
+import tempfile
+import time
 
 import pandas as pd
 import pymysql
 from decouple import config
-from sqlalchemy import create_engine
 
 # Database configuration
 DB_USER = config('DB_USER')
@@ -10,46 +14,263 @@ DB_PASS = config('DB_PASS')
 DB_HOST = 'localhost'
 DB_NAME = 'track1_stage3'
 
-# Create a database engine
-engine = create_engine(f'mysql+pymysql://{DB_USER}:{DB_PASS}@{DB_HOST}/{DB_NAME}')
+CHUNK_SIZE = config('LOAD_CHUNK_SIZE', default=50000, cast=int)
+CHECKPOINT_FILE = config('LOAD_CHECKPOINT_FILE', default='.load_progress.json')
 
-def load_csv_to_table(filepath, table_name):
-    """Loads a CSV file into a database table."""
+# CSV layout per table: column renames, CSV dtypes and the primary key used
+# for idempotent upserts.
+TABLES = {
+    'companies': {
+        'rename': {
+            'Exchange': 'exchange',
+            'Symbol': 'symbol',
+            'Shortname': 'short_name',
+            'Longname': 'long_name',
+            'Sector': 'sector',
+            'Industry': 'industry',
+            'Currentprice': 'current_price',
+            'Marketcap': 'market_cap',
+            'Ebitda': 'ebitda',
+            'Revenuegrowth': 'revenue_growth',
+            'City': 'city',
+            'State': 'state',
+            'Country': 'country',
+            'Fulltimeemployees': 'full_time_employees',
+            'Longbusinesssummary': 'long_business_summary',
+            'Weight': 'weight',
+        },
+        'dtypes': {
+            'Currentprice': 'float64', 'Marketcap': 'Int64', 'Ebitda': 'Int64',
+            'Revenuegrowth': 'float64', 'Fulltimeemployees': 'Int64', 'Weight': 'float64',
+        },
+        'key': ('symbol',),
+    },
+    'sp500_index': {
+        'rename': {'Date': 'date', 'S&P500': 'sp500_value'},
+        'dtypes': {'Date': 'string', 'S&P500': 'float64'},
+        'key': ('date',),
+    },
+    'stock_prices': {
+        'rename': {
+            'Date': 'date',
+            'Symbol': 'symbol',
+            'Adj Close': 'adj_close',
+            'Close': 'close',
+            'High': 'high',
+            'Low': 'low',
+            'Open': 'open',
+            'Volume': 'volume',
+        },
+        'dtypes': {
+            'Date': 'string', 'Symbol': 'string', 'Adj Close': 'float64', 'Close': 'float64',
+            'High': 'float64', 'Low': 'float64', 'Open': 'float64', 'Volume': 'float64',
+        },
+        'integer_columns': ('volume',),
+        'key': ('date', 'symbol'),
+    },
+}
+
+# CSV each table is loaded from by default, in load order (companies first,
+# as stock_prices references it)
+DEFAULT_FILES = {
+    'companies': 'data/sp500_companies.csv',
+    'sp500_index': 'data/sp500_index.csv',
+    'stock_prices': 'data/sp500_stocks.csv',
+}
+
+
+def get_connection():
+    """Opens a loader connection with LOAD DATA LOCAL INFILE enabled."""
+    return pymysql.connect(
+        host=DB_HOST,
+        user=DB_USER,
+        password=DB_PASS,
+        database=DB_NAME,
+        local_infile=True,
+        autocommit=False,
+    )
+
+
+def upsert_sql(table_name, columns, key):
+    """INSERT ... ON DUPLICATE KEY UPDATE statement for ``columns``."""
+    updates = ', '.join(f"{c} = VALUES({c})" for c in columns if c not in key) or f"{key[0]} = {key[0]}"
+    return "INSERT INTO {} ({}) VALUES ({}) ON DUPLICATE KEY UPDATE {}".format(
+        table_name, ', '.join(columns), ', '.join(['%s'] * len(columns)), updates)
+
+
+def upsert_rows(cursor, table_name, columns, rows, key=None):
+    """Upserts ``rows`` with a multi-row executemany; returns the row count."""
+    key = key or TABLES[table_name]['key']
+    cursor.executemany(upsert_sql(table_name, columns, key), rows)
+    return len(rows)
+
+
+def prepare_chunk(df, table_name):
+    """Renames CSV columns and converts a chunk into DB-ready tuples."""
+    spec = TABLES[table_name]
+    df = df.rename(columns=spec['rename'])
+    df = df[[c for c in spec['rename'].values() if c in df.columns]]
+    for column in spec.get('integer_columns', ()):
+        df[column] = df[column].round().astype('Int64')
+    values = df.astype(object).where(df.notna(), None)
+    return list(df.columns), list(values.itertuples(index=False, name=None))
+
+
+def infile_rows(cursor, table_name, columns, rows):
+    """Loads rows through LOAD DATA LOCAL INFILE, replacing existing keys."""
+    with tempfile.NamedTemporaryFile('w', suffix='.tsv', delete=False, encoding='utf-8') as handle:
+        for row in rows:
+            handle.write('\t'.join('\\N' if v is None else _escape_infile(v) for v in row))
+            handle.write('\n')
+        path = handle.name
     try:
-        df = pd.read_csv(filepath)
-        # Rename columns to match the database schema
-        if table_name == 'sp500_index':
-            df = df.rename(columns={'S&P500': 'sp500_value'})
-        elif table_name == 'stock_prices':
-            df = df.rename(columns={
-                'Adj Close': 'adj_close',
-                'Close': 'close',
-                'High': 'high',
-                'Low': 'low',
-                'Open': 'open',
-                'Volume': 'volume'
-            })
-        elif table_name == 'companies':
-            df = df.rename(columns={
-                'Shortname': 'short_name',
-                'Longname': 'long_name',
-                'Currentprice': 'current_price',
-                'Marketcap': 'market_cap',
-                'Ebitda': 'ebitda',
-                'Revenuegrowth': 'revenue_growth',
-                'Fulltimeemployees': 'full_time_employees',
-                'Longbusinesssummary': 'long_business_summary',
-                'Weight': 'weight'
-            })
-
-
-        df.to_sql(table_name, con=engine, if_exists='append', index=False)
-        print(f"Successfully loaded {len(df)} rows into '{table_name}'.")
+        cursor.execute(
+            "LOAD DATA LOCAL INFILE %s REPLACE INTO TABLE {} "
+            "FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' ({})".format(table_name, ', '.join(columns)),
+            (path,))
+    finally:
+        os.unlink(path)
+    return len(rows)
+
+
+def _escape_infile(value):
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def secondary_indexes(cursor, table_name):
+    """Non-unique secondary indexes on ``table_name`` that are safe to drop.
+
+    Indexes whose leading column backs a foreign key are kept because
+    InnoDB refuses to drop them.
+    """
+    cursor.execute("""
+        SELECT COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND REFERENCED_TABLE_NAME IS NOT NULL
+    """, (table_name,))
+    fk_columns = {row[0] for row in cursor.fetchall()}
+    cursor.execute("""
+        SELECT INDEX_NAME, GROUP_CONCAT(COLUMN_NAME ORDER BY SEQ_IN_INDEX)
+        FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+          AND INDEX_NAME <> 'PRIMARY' AND NON_UNIQUE = 1
+        GROUP BY INDEX_NAME
+    """, (table_name,))
+    return {name: columns.split(',') for name, columns in cursor.fetchall()
+            if columns.split(',')[0] not in fk_columns}
+
+
+def drop_indexes(cursor, table_name, indexes):
+    if indexes:
+        cursor.execute("ALTER TABLE {} {}".format(
+            table_name, ', '.join(f"DROP INDEX {name}" for name in indexes)))
+
+
+def create_indexes(cursor, table_name, indexes):
+    existing = secondary_indexes(cursor, table_name)
+    indexes = {name: cols for name, cols in indexes.items() if name not in existing}
+    if indexes:
+        cursor.execute("ALTER TABLE {} {}".format(
+            table_name, ', '.join(f"ADD INDEX {name} ({', '.join(cols)})" for name, cols in indexes.items())))
+
+
+def read_checkpoint():
+    if os.path.exists(CHECKPOINT_FILE):
+        with open(CHECKPOINT_FILE) as handle:
+            return json.load(handle)
+    return {}
+
+
+def write_checkpoint(state):
+    tmp = CHECKPOINT_FILE + '.tmp'
+    with open(tmp, 'w') as handle:
+        json.dump(state, handle)
+    os.replace(tmp, CHECKPOINT_FILE)
+
+
+def load_csv_to_table(filepath, table_name, chunksize=CHUNK_SIZE, method='executemany',
+                      rebuild_indexes=True, restart=False, connection=None):
+    """Streams a CSV file into a database table in committed chunks.
+
+    Rows are upserted, so re-running a load is safe. Progress is recorded in
+    a checkpoint file after every chunk and a failed load resumes after the
+    last committed row. Secondary indexes are dropped for the load and
+    rebuilt in one ALTER at the end.
+    """
+    spec = TABLES[table_name]
+    state = read_checkpoint()
+    job_key = f"{table_name}:{os.path.abspath(filepath)}"
+    job = state.get(job_key, {})
+    if restart:
+        job['rows'] = 0
+    done = job.get('rows', 0)
+    own_connection = connection is None
+    connection = connection or get_connection()
+    write = infile_rows if method == 'infile' else upsert_rows
+    try:
+        with connection.cursor() as cursor:
+            # Index definitions are checkpointed so a crashed load can rebuild them
+            dropped = job.get('dropped_indexes')
+            if dropped is None:
+                dropped = secondary_indexes(cursor, table_name) if rebuild_indexes else {}
+                job.update(rows=done, dropped_indexes=dropped)
+                state[job_key] = job
+                write_checkpoint(state)
+                drop_indexes(cursor, table_name, dropped)
+
+            started = time.monotonic()
+            loaded = 0
+            reader = pd.read_csv(filepath, chunksize=chunksize, dtype=spec['dtypes'],
+                                 skiprows=range(1, done + 1) if done else None)
+            for chunk in reader:
+                columns, rows = prepare_chunk(chunk, table_name)
+                write(cursor, table_name, columns, rows)
+                connection.commit()
+                loaded += len(rows)
+                done += len(rows)
+                job['rows'] = done
+                write_checkpoint(state)
+                elapsed = max(time.monotonic() - started, 1e-9)
+                print(f"'{table_name}': {done:,} rows committed ({loaded / elapsed:,.0f} rows/sec)")
+
+            create_indexes(cursor, table_name, dropped)
+            connection.commit()
+
+        state.pop(job_key, None)
+        write_checkpoint(state)
+        elapsed = max(time.monotonic() - started, 1e-9)
+        print(f"Successfully loaded {done:,} rows into '{table_name}' ({loaded / elapsed:,.0f} rows/sec).")
+        return done
     except Exception as e:
-        print(f"Error loading data into '{table_name}': {e}")
+        connection.rollback()
+        print(f"Error loading data into '{table_name}' after {done:,} rows: {e}")
+        print("Re-run the same command to resume from the last committed chunk.")
+        raise
+    finally:
+        if own_connection:
+            connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load the S&P 500 CSV files into MySQL.")
+    parser.add_argument('--table', choices=sorted(TABLES), help="load a single table")
+    parser.add_argument('--file', help="CSV file for --table")
+    parser.add_argument('--method', choices=['executemany', 'infile'], default='executemany',
+                        help="multi-row INSERT ... ON DUPLICATE KEY UPDATE, or LOAD DATA LOCAL INFILE ... REPLACE")
+    parser.add_argument('--chunksize', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--keep-indexes', action='store_true', help="don't drop secondary indexes during the load")
+    parser.add_argument('--restart', action='store_true', help="ignore any checkpoint and start from the first row")
+    args = parser.parse_args()
+
+    if args.table:
+        jobs = [(args.file or DEFAULT_FILES[args.table], args.table)]
+    else:
+        jobs = [(filepath, table_name) for table_name, filepath in DEFAULT_FILES.items()]
+    for filepath, table_name in jobs:
+        # LOAD DATA ... REPLACE deletes parent rows, so companies always upsert
+        method = 'executemany' if table_name == 'companies' else args.method
+        load_csv_to_table(filepath, table_name, chunksize=args.chunksize, method=method,
+                          rebuild_indexes=not args.keep_indexes, restart=args.restart)
+
 
 if __name__ == "__main__":
-    # Load the data
-    load_csv_to_table('data/sp500_companies.csv', 'companies')
-    load_csv_to_table('data/sp500_index.csv', 'sp500_index')
-    load_csv_to_table('data/sp500_stocks.csv', 'stock_prices') 
\ No newline at end of file
+    main()
@@ -0,0 +1,226 @@
+import math
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+import risk_engine
+
+DEFAULT_PATHS = 100_000
+DEFAULT_CHUNK_SIZE = 10_000
+
+# Size of the process pool shared by every simulation in this process
+MAX_WORKERS = os.cpu_count() or 1
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def estimate_covariance(returns, shrinkage=None):
+    """Estimates the covariance of a (days x symbols) returns matrix.
+
+    ``shrinkage`` may be a weight in [0, 1] toward a scaled identity target,
+    ``'auto'`` for the Ledoit-Wolf optimal weight, or None for the sample
+    covariance. Returns (covariance, shrinkage_used).
+    """
+    n, p = returns.shape
+    if n < 2:
+        raise ValueError("Need at least two return observations for a covariance estimate")
+    centered = returns - returns.mean(axis=0)
+    sample = centered.T @ centered / n
+    if shrinkage is None:
+        return sample * n / (n - 1), 0.0
+
+    target_scale = np.trace(sample) / p
+    target = np.eye(p) * target_scale
+    if shrinkage == 'auto':
+        # Ledoit & Wolf (2004), shrinkage toward mu * I
+        d2 = np.sum((sample - target) ** 2)
+        sq = centered ** 2
+        b2 = np.sum((sq.T @ sq) / n - sample ** 2) / n
+        weight = 0.0 if d2 == 0 else min(max(b2 / d2, 0.0), 1.0)
+    else:
+        weight = float(shrinkage)
+        if not 0.0 <= weight <= 1.0:
+            raise ValueError("shrinkage must be between 0 and 1")
+    return weight * target + (1.0 - weight) * sample, weight
+
+
+def cholesky_factor(covariance):
+    """Cholesky factor of ``covariance``, adding jitter if it is only semi-definite."""
+    jitter = 0.0
+    scale = max(np.mean(np.diag(covariance)), 1e-12)
+    for _ in range(10):
+        try:
+            return np.linalg.cholesky(covariance + np.eye(len(covariance)) * jitter)
+        except np.linalg.LinAlgError:
+            jitter = scale * 1e-10 if jitter == 0.0 else jitter * 10
+    raise ValueError("Covariance matrix is not positive definite")
+
+
+def _get_pool():
+    """The process pool shared by every simulation, started on first use.
+
+    Workers are spawned rather than forked, so they do not inherit the
+    threads and locks of a running server.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=MAX_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _simulate_chunk(inputs, seed, n_paths):
+    chol, mu, exposures, horizon = inputs
+    rng = np.random.default_rng(seed)
+    z = rng.standard_normal((n_paths, chol.shape[0]))
+    scenario_returns = mu * horizon + math.sqrt(horizon) * (z @ chol.T)
+    return scenario_returns @ exposures.T
+
+
+class TailAccumulator:
+    """Keeps the worst simulated P&L per portfolio for running quantile estimates.
+
+    Only the ``ceil((1 - min_level) * total_paths)`` worst outcomes can ever
+    matter for the requested confidence levels, so memory stays bounded no
+    matter how many paths are simulated.
+    """
+
+    def __init__(self, n_portfolios, confidence_levels, total_paths):
+        self.confidence_levels = tuple(confidence_levels)
+        self.keep = risk_engine.tail_count(min(self.confidence_levels), total_paths)
+        self.tail = np.empty((0, n_portfolios))
+        self.paths = 0
+
+    def add(self, pnl):
+        self.paths += pnl.shape[0]
+        merged = np.vstack([self.tail, pnl])
+        if merged.shape[0] > self.keep:
+            merged = np.partition(merged, self.keep - 1, axis=0)[:self.keep]
+        self.tail = np.sort(merged, axis=0)
+
+    def estimates(self):
+        """Returns (var, cvar) as (levels x portfolios) arrays of positive losses."""
+        var = np.empty((len(self.confidence_levels), self.tail.shape[1]))
+        cvar = np.empty_like(var)
+        tail_means = np.cumsum(self.tail, axis=0) / np.arange(1, self.tail.shape[0] + 1)[:, None]
+        for i, level in enumerate(self.confidence_levels):
+            k = min(risk_engine.tail_count(level, self.paths), self.tail.shape[0])
+            var[i] = -self.tail[k - 1]
+            cvar[i] = -tail_means[k - 1]
+        return var, cvar
+
+
+def simulate(holdings, dates, symbols, prices, confidence_levels=risk_engine.DEFAULT_CONFIDENCE_LEVELS,
+             horizon=1, paths=DEFAULT_PATHS, seed=None, shrinkage=None,
+             chunk_size=DEFAULT_CHUNK_SIZE, workers=None):
+    """Runs a Monte Carlo VaR simulation, yielding running estimates after each chunk.
+
+    Chunks are seeded from ``np.random.SeedSequence(seed).spawn(...)`` and
+    consumed in order, so results only depend on ``seed`` and ``chunk_size``,
+    never on the number of worker processes. Chunks run on the shared
+    process pool, at most ``workers`` of them at a time.
+    """
+    if len(dates) < 3:
+        raise ValueError("Not enough price history to run a simulation")
+    if paths < 1 or chunk_size < 1:
+        raise ValueError("paths and chunk_size must be positive")
+    account_ids, exposures, unpriced = risk_engine.exposure_matrix(holdings, symbols, prices[-1])
+    returns = risk_engine.horizon_returns(prices, 1)
+    covariance, shrinkage_used = estimate_covariance(returns, shrinkage)
+    chol = cholesky_factor(covariance)
+    mu = returns.mean(axis=0)
+
+    seed_sequence = np.random.SeedSequence(seed)
+    sizes = [chunk_size] * (paths // chunk_size)
+    if paths % chunk_size:
+        sizes.append(paths % chunk_size)
+    tasks = list(zip(seed_sequence.spawn(len(sizes)), sizes))
+    accumulator = TailAccumulator(len(account_ids), confidence_levels, paths)
+    workers = MAX_WORKERS if workers is None else min(workers, MAX_WORKERS)
+    inputs = (chol, mu, exposures, horizon)
+
+    def report(final):
+        var, cvar = accumulator.estimates()
+        rows = []
+        for col, account_id in enumerate(account_ids):
+            for i, level in enumerate(confidence_levels):
+                rows.append({
+                    'account_id': account_id,
+                    'method': 'monte_carlo',
+                    'confidence': level,
+                    'horizon_days': horizon,
+                    'var': round(float(var[i, col]), 4),
+                    'cvar': round(float(cvar[i, col]), 4),
+                    'portfolio_value': round(float(exposures[col].sum()), 4),
+                    'paths': accumulator.paths,
+                    'seed': seed_sequence.entropy,
+                    'shrinkage': round(shrinkage_used, 6),
+                    'as_of': str(dates[-1]),
+                    'unpriced_symbols': unpriced.get(account_id, []),
+                })
+        return {'paths_done': accumulator.paths, 'paths_total': paths, 'final': final, 'results': rows}
+
+    if workers <= 1 or len(tasks) == 1:
+        for i, task in enumerate(tasks):
+            accumulator.add(_simulate_chunk(inputs, *task))
+            yield report(i == len(tasks) - 1)
+        return
+
+    pool = _get_pool()
+    queued = iter(tasks)
+    pending = deque()
+    try:
+        for task in queued:
+            pending.append(pool.submit(_simulate_chunk, inputs, *task))
+            if len(pending) == workers:
+                break
+        for i in range(len(tasks)):
+            pnl = pending.popleft().result()
+            task = next(queued, None)
+            if task is not None:
+                pending.append(pool.submit(_simulate_chunk, inputs, *task))
+            accumulator.add(pnl)
+            yield report(i == len(tasks) - 1)
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        raise
+    finally:
+        # A client that stops reading a stream leaves chunks it no longer needs
+        for future in pending:
+            future.cancel()
+
+
+def simulate_var(connection, account_ids=None, confidence_levels=risk_engine.DEFAULT_CONFIDENCE_LEVELS,
+                 horizon=1, lookback=risk_engine.DEFAULT_LOOKBACK_DAYS, as_of=None, **options):
+    """Loads holdings and prices, then returns a generator of running Monte Carlo estimates."""
+    holdings = risk_engine.load_holdings(connection, account_ids)
+    if not holdings:
+        return iter(())
+    symbols = {ticker for positions in holdings.values() for ticker in positions}
+    dates, symbols, prices = risk_engine.load_price_matrix(connection, symbols, end=as_of)
+    if lookback:
+        prices = prices[-(lookback + 1):]
+        dates = dates[-(lookback + 1):]
+    return simulate(holdings, dates, symbols, prices, confidence_levels, horizon, **options)
+
+
+def final_results(progress):
+    """Drains a ``simulate`` generator and returns its final result rows."""
+    last = None
+    for last in progress:
+        pass
+    return last['results'] if last else []
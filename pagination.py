@@ -0,0 +1,139 @@
+import base64
+import json
+
+import pymysql
+
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+
+
+class ListQuery:
+    """A keyset-paginated list query.
+
+    ``columns`` maps output field names to SQL expressions and ``key`` is the
+    unique, indexed expression the list is ordered and paged by.
+    """
+
+    def __init__(self, from_sql, key, columns, default_fields, where=None, params=()):
+        self.from_sql = from_sql
+        self.key = key
+        self.columns = columns
+        self.default_fields = tuple(default_fields)
+        self.where = where
+        self.params = tuple(params)
+
+    def parse_fields(self, raw):
+        """Validates a comma-separated ``fields=`` value against the known columns."""
+        if not raw:
+            return self.default_fields
+        fields = tuple(dict.fromkeys(f.strip() for f in raw.split(',') if f.strip()))
+        unknown = [f for f in fields if f not in self.columns]
+        if unknown or not fields:
+            raise ValueError(f"Unknown fields: {', '.join(unknown) or raw}")
+        return fields
+
+    def sql(self, fields, after=None, limit=None):
+        select = ', '.join(f"{self.columns[f]} AS {f}" for f in fields)
+        sql = f"SELECT {select}, {self.key} AS _cursor_key FROM {self.from_sql}"
+        params = list(self.params)
+        conditions = [self.where] if self.where else []
+        if after is not None:
+            conditions.append(f"{self.key} > %s")
+            params.append(after)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += f" ORDER BY {self.key}"
+        if limit is not None:
+            sql += " LIMIT %s"
+            params.append(limit)
+        return sql, params
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+
+def page_query(query, fields, after=None, limit=None):
+    """(sql, params, limit) for one page; one extra row is fetched to detect a next page."""
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    sql, params = query.sql(fields, after, None if limit is None else limit + 1)
+    return sql, params, limit
+
+
+def finish_page(rows, limit):
+    """Trims the look-ahead row and returns (rows, next_cursor)."""
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(_plain(rows[-1]['_cursor_key']))
+    for row in rows:
+        row.pop('_cursor_key', None)
+    return rows, next_cursor
+
+
+def fetch_page(connection, query, fields, after=None, limit=None):
+    """Returns (rows, next_cursor) for one page; next_cursor is None on the last page."""
+    sql, params, limit = page_query(query, fields, after, limit)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = list(cursor.fetchall())
+    return finish_page(rows, limit)
+
+
+def stream_rows(get_connection, query, fields, dumps, fmt='ndjson', after=None):
+    """Yields the whole list as NDJSON lines or as one incrementally written JSON array.
+
+    Rows come from an unbuffered server-side cursor, so memory stays flat no
+    matter how large the table is. The connection is held until the
+    generator finishes; a generator closed early discards it.
+    """
+    sql, params = query.sql(fields, after)
+    with get_connection() as connection:
+        cursor = connection.cursor(pymysql.cursors.SSDictCursor)
+        try:
+            cursor.execute(sql, params)
+            if fmt == 'json':
+                yield '['
+            first = True
+            while True:
+                rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+                if not rows:
+                    break
+                chunk, first = encode_rows(rows, dumps, fmt, first)
+                yield chunk
+            if fmt == 'json':
+                yield ']'
+        except BaseException:
+            # A client that stops reading (or a failed fetch) leaves an unread
+            # result; closing the cursor would drain it, so drop the connection
+            connection.close(broken=True)
+            raise
+        cursor.close()
+
+
+def encode_rows(rows, dumps, fmt, first):
+    """Serializes a batch of streamed rows; returns (text, first) for the next batch."""
+    chunk = []
+    for row in rows:
+        row.pop('_cursor_key', None)
+        if fmt == 'json':
+            chunk.append(('' if first else ',') + dumps(row))
+        else:
+            chunk.append(dumps(row) + '\n')
+        first = False
+    return ''.join(chunk), first
+
+
+def _plain(value):
+    # Cursor keys must survive a JSON round trip
+    if isinstance(value, (int, float, str)) or value is None:
+        return value
+    return str(value)
@@ -0,0 +1,237 @@
+import datetime
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import risk_engine
+
+TRADING_DAYS = 252
+DEFAULT_WINDOWS = (30, 90, 252)
+# Re-read a few days before the newest cached bar so bars ingested late
+# (behind the other symbols, or corrected) still reach the returns
+REFRESH_OVERLAP_DAYS = 7
+
+
+class ReturnsSnapshot:
+    """One consistent, read-only view of the cached history.
+
+    ``prices`` and ``index_levels`` are the forward-filled closes the
+    returns were computed from, kept so a refresh can recompute its
+    overlap window. Refreshes build a new snapshot instead of changing
+    this one, so readers never see arrays from two different refreshes.
+    """
+
+    def __init__(self, dates, symbols, prices, returns, index_levels, index_returns):
+        self.dates = dates
+        self.symbols = tuple(symbols)
+        self.prices = prices
+        self.returns = returns
+        self.index_levels = index_levels
+        self.index_returns = index_returns
+        self.columns = {symbol: i for i, symbol in enumerate(self.symbols)}
+        for array in (dates, prices, returns, index_levels, index_returns):
+            array.flags.writeable = False
+
+    @property
+    def last_prices(self):
+        return self.prices[-1] if len(self.prices) else np.empty(0)
+
+    def weights(self, holdings):
+        """Value weights of each account's holdings as a (symbols x accounts) matrix."""
+        account_ids, exposures, unpriced = risk_engine.exposure_matrix(holdings, list(self.symbols), self.last_prices)
+        totals = exposures.sum(axis=1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = np.where(totals != 0, exposures / totals, 0.0)
+        return account_ids, weights.T, unpriced
+
+
+EMPTY_SNAPSHOT = ReturnsSnapshot(np.array([], dtype='datetime64[D]'), [], np.empty((0, 0)), np.empty((0, 0)),
+                                 np.empty(0), np.empty(0))
+
+
+class ReturnsCache:
+    """In-memory daily log returns for every symbol and for the S&P 500 index.
+
+    The first ``refresh`` loads the full history; later refreshes re-read
+    the last ``REFRESH_OVERLAP_DAYS`` before the newest cached date and
+    rebuild the history from there, so account metrics never re-read the
+    whole price history. Refreshes are throttled to once per ``max_age``
+    seconds. Readers take ``snapshot`` once and use only that object.
+    """
+
+    def __init__(self, max_age=60.0):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._checked_at = None
+        self.snapshot = EMPTY_SNAPSHOT
+
+    def refresh(self, connection, force=False):
+        """Merges bars from the overlap window onward into a new snapshot."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._checked_at is not None and now - self._checked_at < self.max_age:
+                return False
+            self._checked_at = now
+            current = self.snapshot
+            start = None
+            if len(current.dates):
+                start = current.dates[-1] - np.timedelta64(REFRESH_OVERLAP_DAYS, 'D')
+            dates, symbols, prices = risk_engine.load_price_matrix(
+                connection, start=None if start is None else str(start))
+            if len(dates) == 0:
+                return False
+            index_values = self._load_index(connection, dates)
+            self.snapshot = self._merge(current, dates, symbols, prices, index_values)
+            return True
+
+    def _load_index(self, connection, dates):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT date, sp500_value FROM sp500_index WHERE date >= %s AND date <= %s",
+                           (str(dates[0] - np.timedelta64(7, 'D')), str(dates[-1])))
+            rows = cursor.fetchall()
+        index = pd.DataFrame.from_records(rows, columns=['date', 'sp500_value'])
+        if index.empty:
+            return np.full(len(dates), np.nan)
+        index['date'] = pd.to_datetime(index['date'])
+        series = index.set_index('date')['sp500_value'].astype(float).sort_index()
+        return series.reindex(pd.to_datetime(dates), method='ffill').to_numpy()
+
+    @staticmethod
+    def _merge(current, dates, symbols, prices, index_values):
+        """Replaces the cached rows from ``dates[0]`` onward with the loaded block."""
+        # Line the loaded block up with the cached columns, adding new symbols
+        all_symbols = list(current.symbols) + [s for s in symbols if s not in current.columns]
+        columns = {symbol: i for i, symbol in enumerate(all_symbols)}
+        width = len(all_symbols)
+        block = np.full((len(dates), width), np.nan)
+        block[:, [columns[s] for s in symbols]] = prices
+
+        cut = int(np.searchsorted(current.dates, dates[0], side='left'))
+        kept_prices = np.full((cut, width), np.nan)
+        kept_prices[:, :current.prices.shape[1]] = current.prices[:cut]
+        kept_returns = np.zeros((cut, width))
+        kept_returns[:, :current.returns.shape[1]] = current.returns[:cut]
+        previous = kept_prices[-1] if cut else np.full(width, np.nan)
+        previous_index = current.index_levels[cut - 1] if cut else np.nan
+
+        block = pd.DataFrame(np.vstack([previous, block])).ffill().to_numpy()
+        index_block = pd.Series(np.concatenate([[previous_index], index_values])).ffill().to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_returns = np.nan_to_num(np.log(block[1:] / block[:-1]), nan=0.0, posinf=0.0, neginf=0.0)
+            new_index = np.nan_to_num(np.log(index_block[1:] / index_block[:-1]), nan=0.0, posinf=0.0, neginf=0.0)
+
+        return ReturnsSnapshot(
+            np.concatenate([current.dates[:cut], dates]),
+            all_symbols,
+            np.vstack([kept_prices, block[1:]]),
+            np.vstack([kept_returns, new_returns]),
+            np.concatenate([current.index_levels[:cut], index_block[1:]]),
+            np.concatenate([current.index_returns[:cut], new_index]),
+        )
+
+
+def _ratio(numerator, denominator):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = numerator / denominator
+    return np.where(np.isfinite(out), out, np.nan)
+
+
+def _window_metrics(sums, n, risk_free):
+    """Sharpe, Sortino, beta and alpha from windowed sums of return moments."""
+    mean_p = sums['p'] / n
+    mean_m = sums['m'] / n
+    var_p = (sums['pp'] - n * mean_p ** 2) / (n - 1)
+    var_m = (sums['mm'] - n * mean_m ** 2) / (n - 1)
+    cov = (sums['pm'] - n * mean_p * mean_m) / (n - 1)
+    excess = mean_p - risk_free
+    beta = _ratio(cov, var_m)
+    return {
+        'sharpe': _ratio(excess, np.sqrt(np.maximum(var_p, 0))) * np.sqrt(TRADING_DAYS),
+        'sortino': _ratio(excess, np.sqrt(sums['down'] / n)) * np.sqrt(TRADING_DAYS),
+        'beta': beta,
+        'alpha': (excess - beta * (mean_m - risk_free)) * TRADING_DAYS,
+        'annual_return': mean_p * TRADING_DAYS,
+        'annual_volatility': np.sqrt(np.maximum(var_p, 0) * TRADING_DAYS),
+    }
+
+
+def _moments(portfolio, market, risk_free):
+    shortfall = np.minimum(portfolio - risk_free, 0.0)
+    return {
+        'p': portfolio,
+        'm': market[:, None],
+        'pp': portfolio ** 2,
+        'mm': (market ** 2)[:, None],
+        'pm': portfolio * market[:, None],
+        'down': shortfall ** 2,
+    }
+
+
+def compute_performance(cache, holdings, lookback=TRADING_DAYS, windows=DEFAULT_WINDOWS,
+                        risk_free_rate=0.0, include_series=False):
+    """Computes Sharpe, Sortino, beta and alpha vs the S&P 500 for many accounts.
+
+    Each account's daily returns are one column of ``returns @ weights``.
+    Full-period statistics cover the last ``lookback`` days; rolling
+    statistics span the whole cached history and come from cumulative sums.
+    """
+    snapshot = cache.snapshot
+    account_ids, weights, unpriced = snapshot.weights(holdings)
+    # The first cached row has no prior bar to return from
+    returns, market, dates = snapshot.returns[1:], snapshot.index_returns[1:], snapshot.dates[1:]
+    if len(returns) < 2:
+        raise ValueError("Not enough price history to compute performance metrics")
+
+    risk_free = risk_free_rate / TRADING_DAYS
+    moments = _moments(returns @ weights, market, risk_free)
+    recent = {k: v[-lookback:] if lookback else v for k, v in moments.items()}
+    observations = len(recent['p'])
+    overall = _window_metrics({k: v.sum(axis=0) for k, v in recent.items()}, observations, risk_free)
+
+    rolling = {}
+    cumulative = {k: np.vstack([np.zeros((1, v.shape[1])), np.cumsum(v, axis=0)]) for k, v in moments.items()}
+    for window in windows:
+        if window < 2 or window > len(returns):
+            continue
+        sums = {k: v[window:] - v[:-window] for k, v in cumulative.items()}
+        rolling[window] = _window_metrics(sums, window, risk_free)
+
+    def clean(value):
+        value = float(value)
+        return round(value, 6) if np.isfinite(value) else None
+
+    results = []
+    for col, account_id in enumerate(account_ids):
+        result = {
+            'account_id': account_id,
+            'start': str(dates[-observations]),
+            'end': str(dates[-1]),
+            'observations': observations,
+            'unpriced_symbols': unpriced.get(account_id, []),
+        }
+        result.update({name: clean(values[col]) for name, values in overall.items()})
+        result['rolling'] = {}
+        for window, metrics in rolling.items():
+            latest = {name: clean(values[-1, col]) for name, values in metrics.items()}
+            if include_series:
+                window_dates = dates[window - 1:]
+                latest['series'] = [
+                    dict({'date': str(d)}, **{name: clean(metrics[name][t, col]) for name in ('sharpe', 'sortino', 'beta', 'alpha')})
+                    for t, d in enumerate(window_dates)
+                ]
+            result['rolling'][str(window)] = latest
+        results.append(result)
+    return results
+
+
+def save_sharpe_results(connection, results, calc_date=None):
+    """Persists each account's Sharpe ratio to risk_metric."""
+    rows = [(r['account_id'], r['sharpe'], calc_date or datetime.date.today()) for r in results]
+    if not rows:
+        return 0
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            "INSERT INTO risk_metric (account_id, Sharpe_ratio, calc_date) VALUES (%s, %s, %s)", rows)
+    return len(rows)
@@ -1,85 +1,406 @@
-import pymysql
-from decouple import config
-from sqlalchemy import create_engine
-import pandas as pd
+import argparse
+import math
 import random
-from datetime import datetime, timedelta
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pymysql
+
+import load_data
+import portfolio_summary
+import risk_engine
+
+INSERT_CHUNK_SIZE = 20000
+WORKERS = 4
+TRADING_DAYS = 252
+# Drift and volatility for securities without enough price history
+DEFAULT_MU = 0.07
+DEFAULT_SIGMA = 0.3
+# InnoDB deadlock and lock wait timeout; the chunk is retried
+RETRYABLE_ERRORS = (1213, 1205)
+MAX_RETRIES = 5
+SECTORS = {
+    'Technology': ['Software', 'Semiconductors', 'Consumer Electronics'],
+    'Healthcare': ['Biotechnology', 'Medical Devices'],
+    'Financial Services': ['Banks', 'Asset Management'],
+    'Energy': ['Oil & Gas'],
+    'Industrials': ['Aerospace & Defense', 'Railroads'],
+}
+# One random stream per table (and per chunk), so the rows depend only on
+# the seed, not on the worker count or the order chunks finish in
+STREAMS = {'companies': 1, 'stock_prices': 2, 'sp500_index': 3, 'broker_account': 4,
+           'anchor_price': 5, 'price_snapshot': 6, 'portfolio_holding': 7, 'risk_metric': 8}
+
+
+class Generator:
+    """Seeded NumPy random streams, one per (table, chunk)."""
+
+    def __init__(self, seed=None):
+        self.entropy = np.random.SeedSequence(seed).entropy
+
+    def rng(self, table, chunk=0):
+        return np.random.default_rng(np.random.SeedSequence(self.entropy, spawn_key=(STREAMS[table], chunk)))
+
+
+def insert_rows(cursor, table, columns, rows, method='executemany'):
+    """Plain multi-row INSERT (pymysql batches executemany), or LOAD DATA LOCAL INFILE."""
+    if method == 'infile':
+        return load_data.infile_rows(cursor, table, columns, rows)
+    cursor.executemany("INSERT INTO {} ({}) VALUES ({})".format(
+        table, ', '.join(columns), ', '.join(['%s'] * len(columns))), rows)
+    return len(rows)
+
+
+def bulk_insert(table, n_chunks, make_chunk, workers=WORKERS, method='executemany', summary_scope=None):
+    """Inserts the frames returned by ``make_chunk(i)`` for i < ``n_chunks`` over parallel connections.
 
-# Database configuration
-DB_USER = config('DB_USER')
-DB_PASS = config('DB_PASS')
-DB_HOST = 'localhost'
-DB_NAME = 'track1_stage3'
+    Chunks are generated inside the workers, so memory stays at one chunk
+    per worker however many rows are written, and each chunk commits on
+    its own. With a ``summary_scope`` the summary triggers only mark
+    accounts dirty, each worker under its own ``<scope>:<worker>`` so the
+    workers never contend on the marks; ``flush_load_summaries(scope)``
+    recomputes them once after the load.
+    """
+    started = time.monotonic()
+    workers = max(1, min(workers, n_chunks))
 
-# Create a database engine
-engine = create_engine(f'mysql+pymysql://{DB_USER}:{DB_PASS}@{DB_HOST}/{DB_NAME}')
+    def load(worker):
+        connection = load_data.get_connection()
+        written = 0
+        try:
+            with connection.cursor() as cursor:
+                if summary_scope:
+                    cursor.execute("SET @defer_portfolio_summary = 1, @portfolio_summary_scope = %s",
+                                   (f"{summary_scope}:{worker}",))
+                for i in range(worker, n_chunks, workers):
+                    frame = make_chunk(i)
+                    columns = list(frame.columns)
+                    rows = list(zip(*(frame[c].tolist() for c in columns)))
+                    written += _insert_chunk(connection, cursor, table, columns, rows, method)
+        finally:
+            connection.close()
+        return written
 
-def populate_data():
-    """Populates the new tables with sample data."""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        total = sum(pool.map(load, range(workers)))
+    elapsed = max(time.monotonic() - started, 1e-9)
+    print(f"Successfully loaded {total:,} rows into '{table}' ({total / elapsed:,.0f} rows/sec).")
+    return total
+
+
+def _insert_chunk(connection, cursor, table, columns, rows, method):
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            written = insert_rows(cursor, table, columns, rows, method)
+            connection.commit()
+            return written
+        except pymysql.err.OperationalError as e:
+            connection.rollback()
+            if e.args[0] not in RETRYABLE_ERRORS or attempt > MAX_RETRIES:
+                raise
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+
+def flush_load_summaries(scope):
+    """Merges the per-worker dirty marks of one load and recomputes each account once."""
+    connection = load_data.get_connection()
     try:
-        # Create Users
-        users_data = [{'username': f'user_{i}'} for i in range(1, 11)]
-        users_df = pd.DataFrame(users_data)
-        users_df.to_sql('user', con=engine, if_exists='append', index=False)
-        print(f"Successfully loaded {len(users_df)} rows into 'user'.")
-
-        # Create BrokerAccounts
-        accounts_data = [{'user_id': i, 'account_type': random.choice(['taxable', 'ira']), 'provider_ref': f'ref_{i}'} for i in range(1, 11)]
-        accounts_df = pd.DataFrame(accounts_data)
-        accounts_df.to_sql('broker_account', con=engine, if_exists='append', index=False)
-        print(f"Successfully loaded {len(accounts_df)} rows into 'broker_account'.")
-
-        # Create Securities from existing companies
-        companies_df = pd.read_sql('SELECT symbol FROM companies', con=engine)
-        securities_data = [{'ticker': symbol, 'asset_class': 'stock'} for symbol in companies_df['symbol']]
-        securities_df = pd.DataFrame(securities_data)
-        securities_df.to_sql('security', con=engine, if_exists='append', index=False)
-        print(f"Successfully loaded {len(securities_df)} rows into 'security'.")
-
-        # Get security_ids
-        security_ids = pd.read_sql('SELECT security_id FROM security', con=engine)['security_id'].tolist()
-
-        # Create PortfolioHoldings
-        holdings_data = []
-        for i in range(1, 1001):
-            holdings_data.append({
-                'account_id': random.randint(1, 10),
-                'security_id': random.choice(security_ids),
-                'quantity': random.uniform(1, 1000),
-                'book_cost': random.uniform(10, 5000)
-            })
-        holdings_df = pd.DataFrame(holdings_data)
-        holdings_df.to_sql('portfolio_holding', con=engine, if_exists='append', index=False)
-        print(f"Successfully loaded {len(holdings_df)} rows into 'portfolio_holding'.")
-
-        # Create PriceSnapshots
-        snapshots_data = []
-        for security_id in security_ids:
-            for i in range(5): # 5 snapshots per security
-                snapshots_data.append({
-                    'security_id': security_id,
-                    'price': random.uniform(50, 500),
-                    'snapshot_ts': datetime.now() - timedelta(days=i)
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT IGNORE INTO portfolio_summary_dirty (scope, account_id)
+                SELECT %s, account_id FROM portfolio_summary_dirty WHERE scope LIKE %s
+            """, (scope, scope + ':%'))
+            cursor.execute("DELETE FROM portfolio_summary_dirty WHERE scope LIKE %s", (scope + ':%',))
+        portfolio_summary.flush_summaries(connection, scope)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+def insert_frame(table, frame, chunksize=INSERT_CHUNK_SIZE, **options):
+    """bulk_insert over an in-memory frame."""
+    n_chunks = math.ceil(len(frame) / chunksize)
+    if not n_chunks:
+        print(f"No new rows for '{table}'.")
+        return 0
+    return bulk_insert(table, n_chunks, lambda i: frame.iloc[i * chunksize:(i + 1) * chunksize], **options)
+
+
+def gbm_paths(rng, start, mu, sigma, steps, dt):
+    """(len(start) x steps) geometric Brownian motion paths; column 0 is one step after ``start``.
+
+    ``mu`` and ``sigma`` are annualized per path and ``dt`` is in years.
+    """
+    shocks = rng.standard_normal((len(start), steps))
+    drift = ((mu - sigma ** 2 / 2) * dt)[:, None]
+    return start[:, None] * np.exp(np.cumsum(drift + (sigma * math.sqrt(dt))[:, None] * shocks, axis=1))
+
+
+def price_history_stats(connection, symbols, days=TRADING_DAYS):
+    """Annualized drift and volatility and the latest close per symbol, from its last ``days`` bars.
+
+    Symbols with fewer than 20 returns get DEFAULT_MU/DEFAULT_SIGMA and a NaN close.
+    """
+    stats = pd.DataFrame({'mu': DEFAULT_MU, 'sigma': DEFAULT_SIGMA, 'last': np.nan}, index=pd.Index(symbols, dtype=object))
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT MAX(date) FROM stock_prices")
+        latest = cursor.fetchone()[0]
+    if latest is None or not symbols:
+        return stats
+    start = pd.Timestamp(latest) - pd.Timedelta(days=int(days * 365 / TRADING_DAYS) + 7)
+    _, names, prices = risk_engine.load_price_matrix(connection, symbols=symbols, start=start.date(), end=latest)
+    if not names:
+        return stats
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = np.diff(np.log(prices), axis=0)
+    enough = (~np.isnan(returns)).sum(axis=0) >= 20
+    names = np.asarray(names, dtype=object)[enough]
+    returns = returns[:, enough]
+    stats.loc[names, 'mu'] = np.nanmean(returns, axis=0) * TRADING_DAYS
+    stats.loc[names, 'sigma'] = np.nanstd(returns, axis=0) * math.sqrt(TRADING_DAYS)
+    stats.loc[names, 'last'] = prices[-1, enough]
+    return stats
+
+
+def populate_market_data(companies, years, generator, chunksize=INSERT_CHUNK_SIZE, **options):
+    """Adds synthetic companies with ``years`` of daily bars, plus S&P 500 index values for the same days."""
+    connection = load_data.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM companies WHERE symbol LIKE 'SYN%'")
+            first = cursor.fetchone()[0]
+            cursor.execute("SELECT date FROM sp500_index")
+            known_index_days = {str(row[0]) for row in cursor.fetchall()}
+    finally:
+        connection.close()
+
+    rng = generator.rng('companies')
+    symbols = np.array([f'SYN{i:05d}' for i in range(first + 1, first + companies + 1)], dtype=object)
+    sectors = np.array(list(SECTORS), dtype=object)[rng.integers(0, len(SECTORS), companies)]
+    industries = np.array([SECTORS[s][i % len(SECTORS[s])] for s, i in zip(sectors, rng.integers(0, 6, companies))],
+                          dtype=object)
+    market_cap = (10 ** rng.uniform(9, 12, companies)).astype(np.int64)
+    current_price = rng.uniform(10, 500, companies).round(2)
+    companies_df = pd.DataFrame({
+        'exchange': 'NYQ', 'symbol': symbols,
+        'short_name': 'Synthetic ' + symbols, 'long_name': 'Synthetic ' + symbols + ' Inc.',
+        'sector': sectors, 'industry': industries,
+        'current_price': current_price, 'market_cap': market_cap,
+        'ebitda': (market_cap * rng.uniform(0.02, 0.3, companies)).astype(np.int64),
+        'revenue_growth': rng.uniform(-0.2, 0.5, companies).round(3),
+        'country': 'United States', 'full_time_employees': rng.integers(100, 200000, companies),
+        'weight': market_cap / 5e13,
+    })
+    # LOAD DATA ... REPLACE deletes parent rows, so companies always use INSERT
+    insert_frame('companies', companies_df, chunksize, **dict(options, method='executemany'))
+    if not years:
+        return
+
+    days = pd.bdate_range(end=date.today(), periods=years * TRADING_DAYS).strftime('%Y-%m-%d').to_numpy()
+    mu = rng.uniform(-0.05, 0.2, companies)
+    sigma = rng.uniform(0.15, 0.6, companies)
+    # Start each walk so that it ends near the company's current price
+    start = current_price / np.exp(mu * years)
+    per_chunk = max(1, chunksize // len(days))
+
+    def bars(i):
+        block = slice(i * per_chunk, (i + 1) * per_chunk)
+        chunk_rng = generator.rng('stock_prices', i)
+        close = gbm_paths(chunk_rng, start[block], mu[block], sigma[block], len(days), 1 / TRADING_DAYS)
+        spread = close * chunk_rng.uniform(0, 0.03, close.shape)
+        return pd.DataFrame({
+            'date': np.tile(days, len(close)),
+            'symbol': np.repeat(symbols[block], len(days)),
+            'adj_close': close.ravel().round(2), 'close': close.ravel().round(2),
+            'high': (close + spread).ravel().round(2), 'low': (close - spread).ravel().round(2),
+            'open': (close + chunk_rng.uniform(-1, 1, close.shape) * spread).ravel().round(2),
+            'volume': chunk_rng.integers(10 ** 5, 10 ** 7, close.size),
+        })
+    bulk_insert('stock_prices', math.ceil(companies / per_chunk), bars, **options)
+
+    # Index values only for days the table doesn't have yet
+    values = gbm_paths(generator.rng('sp500_index'), np.array([3000.0]), np.array([DEFAULT_MU]), np.array([0.18]),
+                       len(days), 1 / TRADING_DAYS)[0]
+    index_df = pd.DataFrame({'date': days, 'sp500_value': values.round(2)})
+    insert_frame('sp500_index', index_df[~index_df['date'].isin(known_index_days)], chunksize, **options)
+
+
+def check_options(users, accounts, holdings, snapshots, companies, years, snapshot_interval, workers, chunksize):
+    """Raises ValueError for scale options that can't produce a consistent data set."""
+    counts = {'users': users, 'accounts': accounts, 'holdings': holdings, 'snapshots': snapshots,
+              'companies': companies, 'years': years}
+    for name, value in counts.items():
+        if value < 0:
+            raise ValueError(f"{name} must not be negative")
+    for name, value in {'workers': workers, 'chunksize': chunksize, 'snapshot_interval': snapshot_interval}.items():
+        if value <= 0:
+            raise ValueError(f"{name} must be positive")
+    # Accounts go to the new users and holdings to the new accounts
+    if accounts and not users:
+        raise ValueError("accounts need at least one user")
+    if holdings and not accounts:
+        raise ValueError("holdings need at least one account")
+    if years and not companies:
+        raise ValueError("years needs companies to add bars for")
+
+
+def populate_data(users=10, accounts=10, holdings=1000, snapshots=5, companies=0, years=0, seed=None,
+                  snapshot_interval=24.0, workers=WORKERS, chunksize=INSERT_CHUNK_SIZE, method='executemany'):
+    """Populates the new tables with synthetic data at the given scale.
+
+    Rows come from seeded NumPy streams and are written in parallel
+    chunks. Price snapshots follow geometric Brownian motion from each
+    security's latest close, with the drift and volatility of its last
+    year of stock_prices, one every ``snapshot_interval`` hours up to now.
+    With ``companies`` set, synthetic companies (and ``years`` of daily
+    bars) are added first, so an empty database can be seeded end to end.
+    Users and accounts are appended after any existing ones, and
+    securities are only created for companies that don't have one yet.
+    """
+    check_options(users, accounts, holdings, snapshots, companies, years, snapshot_interval, workers, chunksize)
+    generator = Generator(seed)
+    options = {'workers': workers, 'method': method}
+    try:
+        if companies:
+            populate_market_data(companies, years, generator, chunksize, **options)
+
+        connection = load_data.get_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT COALESCE(MAX(user_id), 0) FROM user")
+                first_user = cursor.fetchone()[0]
+                cursor.execute("SELECT COALESCE(MAX(account_id), 0) FROM broker_account")
+                first_account = cursor.fetchone()[0]
+
+            # Create Users
+            usernames = [f'user_{first_user + i}' for i in range(1, users + 1)]
+            insert_frame('user', pd.DataFrame({'username': usernames}, columns=['username']), chunksize, **options)
+            user_ids = _ids(connection, "SELECT user_id FROM user WHERE user_id > %s ORDER BY user_id", first_user)
+
+            # Create BrokerAccounts, spread round-robin over the new users
+            rng = generator.rng('broker_account')
+            insert_frame('broker_account', pd.DataFrame({
+                'user_id': user_ids[np.arange(accounts) % len(user_ids)],
+                'account_type': np.array(['taxable', 'ira'], dtype=object)[rng.integers(0, 2, accounts)],
+                'provider_ref': [f'ref_{i}' for i in range(1, accounts + 1)],
+            }), chunksize, **options)
+            account_ids = _ids(connection, "SELECT account_id FROM broker_account WHERE account_id > %s ORDER BY account_id",
+                               first_account)
+
+            # Create Securities from existing companies
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT symbol FROM companies WHERE symbol NOT IN (SELECT ticker FROM security) ORDER BY symbol")
+                new_tickers = [row[0] for row in cursor.fetchall()]
+            insert_frame('security', pd.DataFrame({'ticker': new_tickers, 'asset_class': 'stock'},
+                                                  columns=['ticker', 'asset_class']), chunksize, **options)
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT security_id, ticker FROM security ORDER BY security_id")
+                securities = cursor.fetchall()
+            security_ids = np.array([row[0] for row in securities])
+            stats = price_history_stats(connection, [row[1] for row in securities])
+        finally:
+            connection.close()
+
+        # Latest close per security, or a random price for tickers without history
+        anchor = stats['last'].to_numpy(dtype=float, copy=True)
+        missing = np.isnan(anchor)
+        anchor[missing] = generator.rng('anchor_price').uniform(50, 500, missing.sum())
+        mu, sigma = stats['mu'].to_numpy(dtype=float), stats['sigma'].to_numpy(dtype=float)
+
+        # Dirty summary marks of this load; worker connections mark under <scope>:<worker>
+        summary_scope = f"load:{uuid.uuid4().hex}"
+
+        # Create PriceSnapshots; whole securities per chunk so each series is written in time order
+        if snapshots and len(security_ids):
+            dt = snapshot_interval / 24 / 365.25
+            offsets = ((snapshots - 1 - np.arange(snapshots)) * snapshot_interval * 3600).astype('timedelta64[s]')
+            times = np.char.replace(np.datetime_as_string(np.datetime64('now', 's') - offsets, unit='s'), 'T', ' ')
+            per_chunk = max(1, chunksize // snapshots)
+
+            def snapshot_chunk(i):
+                block = slice(i * per_chunk, (i + 1) * per_chunk)
+                paths = gbm_paths(generator.rng('price_snapshot', i), anchor[block], mu[block], sigma[block], snapshots, dt)
+                return pd.DataFrame({
+                    'security_id': np.repeat(security_ids[block], snapshots),
+                    'price': paths.ravel().round(4),
+                    'snapshot_ts': np.tile(times, len(paths)).astype(object),
+                })
+            bulk_insert('price_snapshot', math.ceil(len(security_ids) / per_chunk), snapshot_chunk,
+                        summary_scope=summary_scope, **options)
+
+        # Create PortfolioHoldings; book cost is the position at a noisy entry price
+        if holdings and len(security_ids):
+            def holdings_chunk(i):
+                n = min(chunksize, holdings - i * chunksize)
+                rng = generator.rng('portfolio_holding', i)
+                picks = rng.integers(0, len(security_ids), n)
+                quantity = np.exp(rng.uniform(0, math.log(1000), n))
+                frame = pd.DataFrame({
+                    'account_id': account_ids[rng.integers(0, len(account_ids), n)],
+                    'security_id': security_ids[picks],
+                    'quantity': quantity.round(8),
+                    'book_cost': (quantity * anchor[picks] * rng.lognormal(0, 0.2, n)).round(2),
                 })
-        snapshots_df = pd.DataFrame(snapshots_data)
-        snapshots_df.to_sql('price_snapshot', con=engine, if_exists='append', index=False)
-        print(f"Successfully loaded {len(snapshots_df)} rows into 'price_snapshot'.")
+                # Account order keeps a chunk's row locks and dirty marks together
+                return frame.sort_values('account_id', kind='stable')
+            bulk_insert('portfolio_holding', math.ceil(holdings / chunksize), holdings_chunk,
+                        summary_scope=summary_scope, **options)
+
+        # Recompute each touched account's summary once, after every worker is done
+        flush_load_summaries(summary_scope)
+        print("Recomputed 'portfolio_summary' for all touched accounts.")
 
         # Create RiskMetrics
-        risk_data = []
-        for i in range(1, 11):
-            risk_data.append({
-                'account_id': i,
-                'VaR': random.uniform(0.01, 0.1),
-                'Sharpe_ratio': random.uniform(0.5, 2.5),
-                'calc_date': datetime.now().date()
-            })
-        risk_df = pd.DataFrame(risk_data)
-        risk_df.to_sql('risk_metric', con=engine, if_exists='append', index=False)
-        print(f"Successfully loaded {len(risk_df)} rows into 'risk_metric'.")
+        rng = generator.rng('risk_metric')
+        insert_frame('risk_metric', pd.DataFrame({
+            'account_id': account_ids,
+            'VaR': rng.uniform(0.01, 0.1, len(account_ids)).round(4),
+            'Sharpe_ratio': rng.uniform(0.5, 2.5, len(account_ids)).round(4),
+            'calc_date': date.today().isoformat(),
+        }), chunksize, **options)
 
     except Exception as e:
         print(f"Error populating data: {e}")
+        raise
+
+
+def _ids(connection, sql, after):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, (after,))
+        return np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Populate the portfolio tables with synthetic data.")
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--accounts', type=int, default=10)
+    parser.add_argument('--holdings', type=int, default=1000)
+    parser.add_argument('--snapshots', type=int, default=5, help="price snapshots per security")
+    parser.add_argument('--snapshot-interval', type=float, default=24.0, help="hours between snapshots")
+    parser.add_argument('--companies', type=int, default=0, help="synthetic companies to add first")
+    parser.add_argument('--years', type=int, default=0, help="years of daily bars for the synthetic companies")
+    parser.add_argument('--seed', type=int, help="random seed for a reproducible data set")
+    parser.add_argument('--workers', type=int, default=WORKERS, help="parallel insert connections")
+    parser.add_argument('--chunksize', type=int, default=INSERT_CHUNK_SIZE, help="rows per committed chunk")
+    parser.add_argument('--method', choices=['executemany', 'infile'], default='executemany',
+                        help="multi-row INSERT, or LOAD DATA LOCAL INFILE")
+    args = parser.parse_args()
+    options = vars(args)
+    try:
+        check_options(**{k: v for k, v in options.items() if k not in ('seed', 'method')})
+    except ValueError as e:
+        parser.error(str(e))
+    populate_data(**options)
+
 
 if __name__ == "__main__":
-    populate_data() 
\ No newline at end of file
+    main()
@@ -0,0 +1,59 @@
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def deferred_summary(connection, scope=None, flush=True):
+    """Defers portfolio_summary maintenance for bulk writes on ``connection``.
+
+    While the block runs, the holding and price triggers only record which
+    accounts they touched. Marks are private to the connection unless a
+    ``scope`` is given, which connections loading in parallel can share so
+    that one ``flush_summaries(connection, scope)`` recomputes them all.
+    With ``flush`` each touched account is recomputed once when the block
+    exits, also after an error, so writes committed before it are not left
+    with a stale summary.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SET @defer_portfolio_summary = 1, @portfolio_summary_scope = %s", (scope,))
+    try:
+        yield connection
+    except BaseException:
+        if flush:
+            try:
+                flush_summaries(connection, scope)
+            except Exception:
+                logger.exception("Could not flush deferred portfolio summaries")
+        raise
+    else:
+        if flush:
+            flush_summaries(connection, scope)
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute("SET @defer_portfolio_summary = NULL, @portfolio_summary_scope = NULL")
+
+
+def flush_summaries(connection, scope=None):
+    """Recomputes the accounts marked dirty in ``scope`` (default: this connection)."""
+    with connection.cursor() as cursor:
+        cursor.execute("SET @defer_portfolio_summary = NULL, @portfolio_summary_scope = %s", (scope,))
+        try:
+            cursor.execute("CALL FlushPortfolioSummary()")
+        finally:
+            cursor.execute("SET @portfolio_summary_scope = NULL")
+
+
+def rebuild_summaries(connection, account_ids=None):
+    """Recomputes portfolio_summary from scratch for the given (or all) accounts."""
+    with connection.cursor() as cursor:
+        cursor.execute("SET @portfolio_summary_scope = NULL")
+        if account_ids is None:
+            cursor.execute("INSERT IGNORE INTO portfolio_summary_dirty (scope, account_id) "
+                           "SELECT PortfolioSummaryScope(), account_id FROM broker_account")
+        else:
+            cursor.executemany("INSERT IGNORE INTO portfolio_summary_dirty (scope, account_id) "
+                               "VALUES (PortfolioSummaryScope(), %s)",
+                               [(account_id,) for account_id in account_ids])
+        cursor.execute("CALL FlushPortfolioSummary()")
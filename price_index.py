@@ -0,0 +1,184 @@
+import datetime
+import re
+import threading
+import time
+import zoneinfo
+
+import numpy as np
+import pandas as pd
+
+# Snapshot ids are allocated at insert but become visible at commit, so a
+# refresh re-reads this many ids below the highest one seen
+REFRESH_OVERLAP_IDS = 10000
+
+
+def parse_timestamp(value, tz=None):
+    """Parses an ISO date/time into a second-resolution datetime64 in ``tz``.
+
+    Naive values are taken as already in ``tz``; aware ones are converted
+    to it (to UTC when ``tz`` is None) and made naive.
+    """
+    ts = pd.Timestamp(value)
+    if ts.tzinfo is not None:
+        ts = ts.tz_convert(tz or 'UTC').tz_localize(None)
+    return np.datetime64(ts.to_datetime64(), 's')
+
+
+def session_time_zone(connection):
+    """The time zone the connection's session reads TIMESTAMP values in."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT @@session.time_zone AS tz, @@system_time_zone AS system_tz, "
+                       "TIMESTAMPDIFF(SECOND, UTC_TIMESTAMP(), NOW()) AS offset")
+        row = cursor.fetchone()
+    for name in (row['tz'], row['system_tz'] if row['tz'] == 'SYSTEM' else None):
+        if not name or name == 'SYSTEM':
+            continue
+        match = re.fullmatch(r'([+-])(\d{1,2}):(\d{2})', name)
+        if match:
+            sign = -1 if match.group(1) == '-' else 1
+            return datetime.timezone(sign * datetime.timedelta(hours=int(match.group(2)), minutes=int(match.group(3))))
+        try:
+            return zoneinfo.ZoneInfo(name)
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            pass
+    # e.g. a system zone reported as an abbreviation such as CEST
+    return datetime.timezone(datetime.timedelta(seconds=int(row['offset'])))
+
+
+class PriceIndex:
+    """In-memory as-of price lookup over price_snapshot.
+
+    Each security keeps its snapshot timestamps and prices in sorted NumPy
+    arrays, so "price of X at time T" is one binary search. Refreshes read
+    snapshots from ``REFRESH_OVERLAP_IDS`` below the highest snapshot_id
+    seen, so rows committed out of id order are not missed, and skip ids
+    already merged. They are throttled to once per ``max_age`` seconds;
+    ``reload`` starts over. Timestamps are kept in the database session's
+    time zone, and aware ``as_of`` values are converted to it.
+    """
+
+    def __init__(self, max_age=5.0):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._checked_at = None
+        self._last_id = 0
+        self._seen = np.empty(0, dtype=np.int64)
+        self._series = {}
+        self.time_zone = None
+
+    def refresh(self, connection, force=False):
+        """Merges snapshots inserted since the last refresh."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._checked_at is not None and now - self._checked_at < self.max_age:
+                return False
+            self._checked_at = now
+            if self.time_zone is None:
+                self.time_zone = session_time_zone(connection)
+            floor = max(self._last_id - REFRESH_OVERLAP_IDS, 0)
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    SELECT snapshot_id, security_id, price, snapshot_ts
+                    FROM price_snapshot
+                    WHERE snapshot_id > %s AND snapshot_ts IS NOT NULL
+                    ORDER BY snapshot_id
+                """, (floor,))
+                rows = cursor.fetchall()
+            frame = pd.DataFrame.from_records(rows, columns=['snapshot_id', 'security_id', 'price', 'snapshot_ts'])
+            ids = frame['snapshot_id'].to_numpy(dtype=np.int64)
+            # Keep the ids inside the next overlap window to skip them next time
+            self._last_id = max(self._last_id, int(ids.max()) if len(ids) else 0)
+            seen = self._seen
+            self._seen = np.union1d(seen, ids)
+            self._seen = self._seen[self._seen > self._last_id - REFRESH_OVERLAP_IDS]
+            frame = frame[~np.isin(ids, seen)].copy()
+            if frame.empty:
+                return False
+            frame['snapshot_ts'] = pd.to_datetime(frame['snapshot_ts']).to_numpy().astype('datetime64[s]')
+            frame['price'] = frame['price'].astype(float)
+            for security_id, group in frame.groupby('security_id'):
+                self._merge(int(security_id), group['snapshot_ts'].to_numpy(),
+                            group['price'].to_numpy(), group['snapshot_id'].to_numpy())
+            return True
+
+    def reload(self, connection):
+        with self._lock:
+            self._series = {}
+            self._last_id = 0
+            self._seen = np.empty(0, dtype=np.int64)
+            self.time_zone = None
+        return self.refresh(connection, force=True)
+
+    def _merge(self, security_id, timestamps, prices, ids):
+        current = self._series.get(security_id)
+        if current is not None:
+            timestamps = np.concatenate([current[0], timestamps])
+            prices = np.concatenate([current[1], prices])
+            ids = np.concatenate([current[2], ids])
+        # Order by time, then by insertion so the later of two equal timestamps wins
+        order = np.lexsort((ids, timestamps))
+        self._series[security_id] = (timestamps[order], prices[order], ids[order])
+
+    def __len__(self):
+        return len(self._series)
+
+    def as_of(self, security_id, ts=None):
+        """(price, snapshot_ts) of the last snapshot at or before ``ts`` (latest if None), or None."""
+        series = self._series.get(security_id)
+        if series is None:
+            return None
+        timestamps, prices, _ = series
+        if ts is None:
+            i = len(timestamps) - 1
+        else:
+            i = int(np.searchsorted(timestamps, parse_timestamp(ts, self.time_zone), side='right')) - 1
+        if i < 0:
+            return None
+        return float(prices[i]), pd.Timestamp(timestamps[i]).isoformat()
+
+
+def load_positions(connection, account_id):
+    """Net quantity and book cost per security held by ``account_id``."""
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT ph.security_id, s.ticker, SUM(ph.quantity) AS quantity, SUM(ph.book_cost) AS book_cost
+            FROM portfolio_holding ph
+            JOIN security s ON ph.security_id = s.security_id
+            WHERE ph.account_id = %s
+            GROUP BY ph.security_id, s.ticker
+            ORDER BY ph.security_id
+        """, (account_id,))
+        return cursor.fetchall()
+
+
+def value_positions(index, positions, as_of=None):
+    """Values positions at their as-of prices; O(holdings x log snapshots)."""
+    holdings, unpriced = [], []
+    total_value = total_book_cost = 0.0
+    for position in positions:
+        quantity = float(position['quantity'] or 0)
+        book_cost = float(position['book_cost'] or 0)
+        found = index.as_of(position['security_id'], as_of)
+        if found is None:
+            unpriced.append(position['ticker'])
+            price = snapshot_ts = value = None
+        else:
+            price, snapshot_ts = found
+            value = quantity * price
+            total_value += value
+        total_book_cost += book_cost
+        holdings.append({
+            'security_id': position['security_id'],
+            'ticker': position['ticker'],
+            'quantity': quantity,
+            'price': price,
+            'snapshot_ts': snapshot_ts,
+            'value': value,
+            'book_cost': book_cost,
+        })
+    return {
+        'total_value': total_value,
+        'total_book_cost': total_book_cost,
+        'holdings': holdings,
+        'unpriced': unpriced,
+    }
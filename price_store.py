@@ -0,0 +1,346 @@
+import argparse
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import pymysql
+
+FIELDS = ('adj_close', 'close', 'high', 'low', 'open', 'volume')
+SYNC_BATCH_SIZE = 100000
+# Re-read this many days up to the last stored date on every sync, so
+# bars that arrive late or are corrected still reach the store
+SYNC_OVERLAP_DAYS = 7
+META_FILE = 'meta.json'
+DATES_FILE = 'dates.i64'
+
+
+class StoreView:
+    """One consistent set of maps of the store files.
+
+    ``PriceStore.open`` builds a new view and swaps it in with a single
+    assignment, so a reader that captures ``store.view`` once never mixes
+    dates, symbols and columns from two different syncs.
+    """
+
+    def __init__(self, dates, symbols, fields):
+        self.dates = dates
+        self.symbols = tuple(symbols)
+        self.fields = fields
+        self.columns = {symbol: i for i, symbol in enumerate(self.symbols)}
+
+    def date_range(self, start=None, end=None):
+        lo = 0 if start is None else int(np.searchsorted(self.dates, np.datetime64(str(start)[:10], 'D'), side='left'))
+        hi = len(self.dates) if end is None else int(np.searchsorted(self.dates, np.datetime64(str(end)[:10], 'D'), side='right'))
+        return lo, hi
+
+    def window(self, start=None, end=None, field='adj_close'):
+        lo, hi = self.date_range(start, end)
+        return self.dates[lo:hi], self.fields[field][lo:hi]
+
+    def column(self, symbol, start=None, end=None, field='adj_close'):
+        j = self.columns.get(symbol)
+        if j is None:
+            return None
+        lo, hi = self.date_range(start, end)
+        return self.dates[lo:hi], self.fields[field][lo:hi, j]
+
+    def load_price_matrix(self, symbols=None, start=None, end=None, field='adj_close'):
+        dates, matrix = self.window(start, end, field)
+        names = sorted(self.symbols if symbols is None else set(symbols) & self.columns.keys())
+        matrix = matrix[:, [self.columns[s] for s in names]]
+        if not names or len(dates) == 0:
+            return np.array([], dtype='datetime64[D]'), [], np.empty((0, 0))
+        # Keep only dates where a selected symbol traded, then fill gaps
+        traded = ~np.isnan(matrix).all(axis=1)
+        wide = pd.DataFrame(matrix[traded]).ffill()
+        keep = wide.notna().any(axis=0).to_numpy()
+        return dates[traded], [s for s, k in zip(names, keep) if k], wide.to_numpy(dtype=np.float64)[:, keep]
+
+
+EMPTY_VIEW = StoreView(np.array([], dtype='datetime64[D]'), [], {f: np.empty((0, 0)) for f in FIELDS})
+
+
+class PriceStore:
+    """Columnar, memory-mapped copy of stock_prices.
+
+    The directory holds ``meta.json`` (symbols and row count), ``dates.i64``
+    (days since the epoch) and one ``<field>.f64`` file per price field,
+    each a date-major (dates x symbols) float64 matrix with NaN gaps. A date
+    range of the universe is a contiguous zero-copy view and a single symbol
+    is a strided view.
+
+    ``sync`` appends dates newer than the last stored one, so new days only
+    add rows at the end of each file; a new symbol rewrites the files once.
+    It also re-reads the last ``SYNC_OVERLAP_DAYS`` stored dates and patches
+    bars that changed there in place. Older history changed in MySQL (e.g.
+    re-loaded) needs ``rebuild``. ``sync`` and ``rebuild`` hold an exclusive
+    ``flock`` on the store directory, so several processes can share it.
+    """
+
+    def __init__(self, path, max_age=60.0):
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._checked_at = None
+        self.view = EMPTY_VIEW
+        if self.exists():
+            self.open()
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, META_FILE))
+
+    def open(self):
+        """(Re)maps the files as they are on disk into a new view; earlier views stay valid."""
+        meta = self._read_meta()
+        n_dates, symbols = meta['n_dates'], meta['symbols']
+        shape = (n_dates, len(symbols))
+        if n_dates:
+            days = np.memmap(self._file(DATES_FILE), dtype=np.int64, mode='r', shape=(n_dates,))
+            fields = {f: np.memmap(self._file(f + '.f64'), dtype=np.float64, mode='r', shape=shape) for f in FIELDS}
+        else:
+            days = np.empty(0, dtype=np.int64)
+            fields = {f: np.empty(shape) for f in FIELDS}
+        self.view = StoreView(days.view('datetime64[D]'), symbols, fields)
+
+    @property
+    def dates(self):
+        return self.view.dates
+
+    @property
+    def symbols(self):
+        return self.view.symbols
+
+    def field(self, name='adj_close'):
+        """The full (dates x symbols) matrix for ``name`` as a read-only memmap."""
+        return self.view.fields[name]
+
+    def window(self, start=None, end=None, field='adj_close'):
+        """(dates, matrix) for a date range over every symbol, without copying."""
+        return self.view.window(start, end, field)
+
+    def column(self, symbol, start=None, end=None, field='adj_close'):
+        """(dates, prices) for one symbol as a strided view, or None if the symbol is not stored."""
+        return self.view.column(symbol, start, end, field)
+
+    def load_price_matrix(self, symbols=None, start=None, end=None, field='adj_close'):
+        """Same contract as risk_engine.load_price_matrix, sliced from the store."""
+        return self.view.load_price_matrix(symbols, start, end, field)
+
+    def sync(self, connection, force=False):
+        """Appends new stock_prices bars and patches the overlap window; throttled to once per ``max_age`` seconds."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._checked_at is not None and now - self._checked_at < self.max_age:
+                return None
+            self._checked_at = now
+            with self._exclusive():
+                return self._sync(connection)
+
+    def rebuild(self, connection):
+        """Rewrites the store from scratch."""
+        with self._lock, self._exclusive():
+            # Unlink rather than truncate: readers may still map the old files
+            for name in [f + '.f64' for f in FIELDS] + [DATES_FILE]:
+                if os.path.exists(self._file(name)):
+                    os.remove(self._file(name))
+            self._write_meta({'symbols': [], 'n_dates': 0})
+            self._checked_at = time.monotonic()
+            return self._sync(connection)
+
+    @contextmanager
+    def _exclusive(self):
+        """Holds an exclusive lock on the store directory, across processes."""
+        os.makedirs(self.path, exist_ok=True)
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _sync(self, connection):
+        if not self.exists():
+            self._write_meta({'symbols': [], 'n_dates': 0})
+        self.open()
+        last = self.dates[-1] if len(self.dates) else None
+        after = None if last is None else str(last - np.timedelta64(SYNC_OVERLAP_DAYS, 'D'))
+        summary = {'dates': 0, 'rows': 0, 'new_symbols': 0, 'patched': 0}
+        for frame in self._read_bars(connection, after):
+            if last is not None:
+                stored = frame['date'] <= last
+                if stored.any():
+                    self._patch(frame[stored], summary)
+                frame = frame[~stored]
+            if not frame.empty:
+                self._append(frame, summary)
+        self.open()
+        return summary
+
+    def _read_bars(self, connection, after):
+        """Yields DataFrames of bars after ``after``, each holding whole dates."""
+        sql = "SELECT date, symbol, {} FROM stock_prices".format(', '.join(FIELDS))
+        params = ()
+        if after is not None:
+            sql += " WHERE date > %s"
+            params = (after,)
+        sql += " ORDER BY date"
+        columns = ['date', 'symbol'] + list(FIELDS)
+        carry = None
+        # Unbuffered, so a full export never holds the whole table in memory
+        with connection.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(SYNC_BATCH_SIZE)
+                if not rows:
+                    break
+                frame = pd.DataFrame.from_records(
+                    [tuple(r.values()) if isinstance(r, dict) else r for r in rows], columns=columns)
+                frame['date'] = pd.to_datetime(frame['date']).values.astype('datetime64[D]')
+                if carry is not None:
+                    frame = pd.concat([carry, frame], ignore_index=True)
+                # The last date may continue in the next batch
+                last = frame['date'].iloc[-1]
+                carry = frame[frame['date'] == last]
+                frame = frame[frame['date'] != last]
+                if not frame.empty:
+                    yield frame
+        if carry is not None and not carry.empty:
+            yield carry
+
+    def _add_symbols(self, frame, summary):
+        meta = self._read_meta()
+        symbols, n_dates = meta['symbols'], meta['n_dates']
+        new_symbols = sorted(set(frame['symbol']) - set(symbols))
+        if new_symbols:
+            self._widen(symbols, n_dates, symbols + new_symbols)
+            symbols = symbols + new_symbols
+            summary['new_symbols'] += len(new_symbols)
+        return symbols, n_dates
+
+    def _patch(self, frame, summary):
+        """Writes re-read bars for dates already in the store over the stored values."""
+        symbols, n_dates = self._add_symbols(frame, summary)
+        self._truncate(n_dates, len(symbols))
+        days = np.fromfile(self._file(DATES_FILE), dtype=np.int64, count=n_dates).view('datetime64[D]')
+        dates = frame['date'].to_numpy().astype('datetime64[D]')
+        missing = np.setdiff1d(dates, days)
+        if len(missing):
+            # A date no bar had before: splice in empty rows by rewriting the files
+            days = self._insert_dates(symbols, days, missing)
+            n_dates = len(days)
+        row = np.searchsorted(days, dates)
+        col = frame['symbol'].map({s: i for i, s in enumerate(symbols)}).to_numpy()
+        changed = np.zeros(len(frame), dtype=bool)
+        for field in FIELDS:
+            matrix = np.memmap(self._file(field + '.f64'), dtype=np.float64, mode='r+', shape=(n_dates, len(symbols)))
+            values = frame[field].astype(float).to_numpy()
+            old = matrix[row, col]
+            differs = ~((old == values) | (np.isnan(old) & np.isnan(values)))
+            if differs.any():
+                matrix[row[differs], col[differs]] = values[differs]
+                matrix.flush()
+            changed |= differs
+            del matrix
+        summary['patched'] += int(changed.sum())
+
+    def _insert_dates(self, symbols, days, missing):
+        """Rewrites every file with NaN rows for ``missing`` dates and swaps them in atomically."""
+        merged = np.union1d(days, missing)
+        rows = np.searchsorted(merged, days)
+        for field in FIELDS:
+            matrix = np.full((len(merged), len(symbols)), np.nan)
+            matrix[rows] = np.fromfile(self._file(field + '.f64'), dtype=np.float64,
+                                       count=len(days) * len(symbols)).reshape(len(days), len(symbols))
+            tmp = self._file(field + '.f64.tmp')
+            matrix.tofile(tmp)
+            os.replace(tmp, self._file(field + '.f64'))
+        tmp = self._file(DATES_FILE + '.tmp')
+        merged.astype(np.int64).tofile(tmp)
+        os.replace(tmp, self._file(DATES_FILE))
+        self._write_meta({'symbols': symbols, 'n_dates': len(merged)})
+        return merged
+
+    def _append(self, frame, summary):
+        symbols, n_dates = self._add_symbols(frame, summary)
+
+        dates = np.unique(frame['date'].to_numpy())
+        row = np.searchsorted(dates, frame['date'].to_numpy())
+        col = frame['symbol'].map({s: i for i, s in enumerate(symbols)}).to_numpy()
+        self._truncate(n_dates, len(symbols))
+        for field in FIELDS:
+            block = np.full((len(dates), len(symbols)), np.nan)
+            block[row, col] = frame[field].astype(float).to_numpy()
+            with open(self._file(field + '.f64'), 'ab') as handle:
+                handle.write(block.tobytes())
+        with open(self._file(DATES_FILE), 'ab') as handle:
+            handle.write(dates.astype('datetime64[D]').astype(np.int64).tobytes())
+        # meta.json is written last, so a crash mid-append leaves the store at the previous length
+        self._write_meta({'symbols': symbols, 'n_dates': n_dates + len(dates)})
+        summary['dates'] += len(dates)
+        summary['rows'] += len(frame)
+
+    def _widen(self, symbols, n_dates, new_order):
+        """Rewrites every field file with extra symbol columns and swaps it in atomically."""
+        width = len(new_order)
+        for field in FIELDS:
+            matrix = np.full((n_dates, width), np.nan)
+            if n_dates and symbols:
+                old = np.fromfile(self._file(field + '.f64'), dtype=np.float64,
+                                  count=n_dates * len(symbols)).reshape(n_dates, len(symbols))
+                matrix[:, :len(symbols)] = old
+            tmp = self._file(field + '.f64.tmp')
+            matrix.tofile(tmp)
+            os.replace(tmp, self._file(field + '.f64'))
+        self._write_meta({'symbols': new_order, 'n_dates': n_dates})
+
+    def _truncate(self, n_dates, width):
+        # Drop any tail left by an interrupted append
+        for name, size in [(f + '.f64', n_dates * width * 8) for f in FIELDS] + [(DATES_FILE, n_dates * 8)]:
+            path = self._file(name)
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+            elif os.path.getsize(path) != size:
+                with open(path, 'r+b') as handle:
+                    handle.truncate(size)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _read_meta(self):
+        with open(self._file(META_FILE)) as handle:
+            return json.load(handle)
+
+    def _write_meta(self, meta):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self._file(META_FILE + '.tmp')
+        with open(tmp, 'w') as handle:
+            json.dump(dict(meta, fields=list(FIELDS)), handle)
+        os.replace(tmp, self._file(META_FILE))
+
+
+def main():
+    import load_data
+
+    parser = argparse.ArgumentParser(description="Sync stock_prices into the columnar price store.")
+    parser.add_argument('--path', default='data/price_store')
+    parser.add_argument('--rebuild', action='store_true', help="rewrite the store from scratch")
+    args = parser.parse_args()
+
+    store = PriceStore(args.path)
+    connection = load_data.get_connection()
+    try:
+        started = time.monotonic()
+        summary = store.rebuild(connection) if args.rebuild else store.sync(connection, force=True)
+    finally:
+        connection.close()
+    print(f"Appended {summary['dates']:,} dates ({summary['rows']:,} bars, {summary['new_symbols']} new symbols), "
+          f"patched {summary['patched']:,} bars in {time.monotonic() - started:.2f}s; store holds {len(store.dates):,} dates x {len(store.symbols)} symbols.")
+
+
+if __name__ == "__main__":
+    main()
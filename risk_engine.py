@@ -0,0 +1,218 @@
+import datetime
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+import price_store
+
+DEFAULT_CONFIDENCE_LEVELS = (0.95, 0.99)
+DEFAULT_LOOKBACK_DAYS = 2520  # ~10 years of trading days
+METHODS = ('historical', 'parametric')
+
+# Optional price_store.PriceStore that price matrices are read from
+PRICE_STORE = None
+
+
+def load_holdings(connection, account_ids=None):
+    """Returns {account_id: {ticker: quantity}} for the given (or all) accounts."""
+    sql = """
+        SELECT ph.account_id, s.ticker, SUM(ph.quantity) AS quantity
+        FROM portfolio_holding ph
+        JOIN security s ON ph.security_id = s.security_id
+    """
+    params = ()
+    if account_ids is not None:
+        account_ids = list(account_ids)
+        if not account_ids:
+            return {}
+        sql += " WHERE ph.account_id IN (%s)" % ', '.join(['%s'] * len(account_ids))
+        params = tuple(account_ids)
+    sql += " GROUP BY ph.account_id, s.ticker"
+
+    holdings = {}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        for row in cursor.fetchall():
+            holdings.setdefault(row['account_id'], {})[row['ticker']] = float(row['quantity'])
+    return holdings
+
+
+def load_price_matrix(connection, symbols=None, start=None, end=None, field='adj_close'):
+    """Loads a (dates x symbols) price matrix from stock_prices.
+
+    Returns (dates, symbols, prices) where ``prices`` is a float64 array with
+    gaps forward-filled; symbols without any price data are dropped. Passing
+    ``symbols=None`` loads the whole universe. When PRICE_STORE is set the
+    matrix is sliced from its memory-mapped arrays after an incremental sync.
+    """
+    if PRICE_STORE is not None and field in price_store.FIELDS:
+        PRICE_STORE.sync(connection)
+        return PRICE_STORE.load_price_matrix(symbols, start, end, field)
+
+    sql = "SELECT date, symbol, %s AS price FROM stock_prices WHERE 1 = 1" % field
+    params = []
+    if symbols is not None:
+        symbols = sorted(set(symbols))
+        if not symbols:
+            return np.array([], dtype='datetime64[D]'), [], np.empty((0, 0))
+        sql += " AND symbol IN (%s)" % ', '.join(['%s'] * len(symbols))
+        params += symbols
+    if start is not None:
+        sql += " AND date >= %s"
+        params.append(start)
+    if end is not None:
+        sql += " AND date <= %s"
+        params.append(end)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    df = pd.DataFrame.from_records(rows, columns=['date', 'symbol', 'price'])
+    if df.empty:
+        return np.array([], dtype='datetime64[D]'), [], np.empty((0, 0))
+    df['price'] = df['price'].astype(float)
+    wide = df.pivot(index='date', columns='symbol', values='price').sort_index().ffill()
+    wide = wide.dropna(axis=1, how='all')
+    dates = pd.to_datetime(wide.index).values.astype('datetime64[D]')
+    return dates, list(wide.columns), wide.to_numpy(dtype=np.float64)
+
+
+def quantity_matrix(holdings, symbols):
+    """Builds an (accounts x symbols) matrix of held quantities.
+
+    Returns (account_ids, quantities, unpriced) where ``unpriced`` maps an
+    account to held tickers missing from ``symbols``.
+    """
+    account_ids = sorted(holdings)
+    column = {symbol: i for i, symbol in enumerate(symbols)}
+    quantities = np.zeros((len(account_ids), len(symbols)))
+    unpriced = {}
+    for row, account_id in enumerate(account_ids):
+        for ticker, quantity in holdings[account_id].items():
+            col = column.get(ticker)
+            if col is None:
+                unpriced.setdefault(account_id, []).append(ticker)
+            else:
+                quantities[row, col] = quantity
+    return account_ids, quantities, unpriced
+
+
+def exposure_matrix(holdings, symbols, last_prices):
+    """Builds an (accounts x symbols) matrix of dollar exposures at the last price."""
+    account_ids, quantities, unpriced = quantity_matrix(holdings, symbols)
+    return account_ids, quantities * np.nan_to_num(last_prices), unpriced
+
+
+def horizon_returns(prices, horizon=1):
+    """Overlapping ``horizon``-day simple returns; missing prices give zero return."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = prices[horizon:] / prices[:-horizon] - 1.0
+    return np.nan_to_num(returns, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def tail_count(level, n):
+    """Scenarios in the ``1 - level`` tail of ``n``; rounded first so (1 - 0.95) * 100 counts 5, not 6."""
+    return max(1, int(np.ceil(round((1.0 - level) * n, 9))))
+
+
+def historical_var(pnl, confidence_levels):
+    """Historical VaR/CVaR for each column of a (scenarios x portfolios) P&L matrix.
+
+    Returns two (levels x portfolios) arrays of positive loss amounts.
+    """
+    n = pnl.shape[0]
+    ordered = np.sort(pnl, axis=0)
+    tail_means = np.cumsum(ordered, axis=0) / np.arange(1, n + 1)[:, None]
+    var = np.empty((len(confidence_levels), pnl.shape[1]))
+    cvar = np.empty_like(var)
+    for i, level in enumerate(confidence_levels):
+        var[i] = -np.quantile(ordered, 1.0 - level, axis=0)
+        k = tail_count(level, n)
+        cvar[i] = -tail_means[k - 1]
+    return var, cvar
+
+
+def parametric_var(pnl, confidence_levels, horizon=1):
+    """Gaussian VaR/CVaR from daily P&L, scaled to ``horizon`` days."""
+    mu = pnl.mean(axis=0) * horizon
+    sigma = pnl.std(axis=0, ddof=1) * np.sqrt(horizon)
+    normal = NormalDist()
+    var = np.empty((len(confidence_levels), pnl.shape[1]))
+    cvar = np.empty_like(var)
+    for i, level in enumerate(confidence_levels):
+        z = normal.inv_cdf(1.0 - level)
+        var[i] = -(mu + z * sigma)
+        cvar[i] = -(mu - sigma * normal.pdf(z) / (1.0 - level))
+    return var, cvar
+
+
+def compute_var(connection, account_ids=None, confidence_levels=DEFAULT_CONFIDENCE_LEVELS,
+                horizon=1, lookback=DEFAULT_LOOKBACK_DAYS, methods=METHODS, as_of=None):
+    """Computes VaR and CVaR for many accounts in one batched pass.
+
+    Loads every held symbol's price history once, builds a single returns
+    matrix and prices all accounts against it with one matrix product.
+    """
+    holdings = load_holdings(connection, account_ids)
+    if not holdings:
+        return []
+    symbols = {ticker for positions in holdings.values() for ticker in positions}
+    dates, symbols, prices = load_price_matrix(connection, symbols, end=as_of)
+    if lookback:
+        prices = prices[-(lookback + horizon):]
+        dates = dates[-(lookback + horizon):]
+    return value_at_risk(holdings, dates, symbols, prices, confidence_levels, horizon, methods)
+
+
+def value_at_risk(holdings, dates, symbols, prices, confidence_levels=DEFAULT_CONFIDENCE_LEVELS,
+                  horizon=1, methods=METHODS):
+    """Computes VaR/CVaR rows for ``holdings`` against an already loaded price matrix."""
+    if len(dates) <= horizon:
+        raise ValueError("Not enough price history to compute VaR")
+    account_ids, exposures, unpriced = exposure_matrix(holdings, symbols, prices[-1])
+
+    results = []
+    for method in methods:
+        if method == 'historical':
+            pnl = horizon_returns(prices, horizon) @ exposures.T
+            var, cvar = historical_var(pnl, confidence_levels)
+        elif method == 'parametric':
+            pnl = horizon_returns(prices, 1) @ exposures.T
+            var, cvar = parametric_var(pnl, confidence_levels, horizon)
+        else:
+            raise ValueError(f"Unknown VaR method: {method}")
+
+        for col, account_id in enumerate(account_ids):
+            for i, level in enumerate(confidence_levels):
+                results.append({
+                    'account_id': account_id,
+                    'method': method,
+                    'confidence': level,
+                    'horizon_days': horizon,
+                    'var': round(float(var[i, col]), 4),
+                    'cvar': round(float(cvar[i, col]), 4),
+                    'portfolio_value': round(float(exposures[col].sum()), 4),
+                    'observations': int(pnl.shape[0]),
+                    'as_of': str(dates[-1]),
+                    'unpriced_symbols': unpriced.get(account_id, []),
+                })
+    return results
+
+
+def save_var_results(connection, results, calc_date=None):
+    """Persists VaR/CVaR rows to risk_metric in a single executemany."""
+    if not results:
+        return 0
+    calc_date = calc_date or datetime.date.today()
+    rows = [
+        (r['account_id'], r['var'], r['cvar'], r['method'], r['confidence'], r['horizon_days'], calc_date)
+        for r in results
+    ]
+    with connection.cursor() as cursor:
+        cursor.executemany("""
+            INSERT INTO risk_metric (account_id, VaR, CVaR, method, confidence, horizon_days, calc_date)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """, rows)
+    return len(rows)
@@ -0,0 +1,283 @@
+-- =================================================================
+-- Apply after schema.sql, schema_updates.sql and advanced_features.sql
+-- =================================================================
+
+-- =================================================================
+-- 1. RISK ENGINE RESULTS
+-- =================================================================
+
+-- The in-process risk engine (risk_engine.py) replaces the RAND()
+-- placeholder in CalculateVaR and stores one row per account, method
+-- and confidence level.
+ALTER TABLE risk_metric
+    MODIFY VaR DECIMAL(20, 4),
+    ADD COLUMN CVaR DECIMAL(20, 4) AFTER VaR,
+    ADD COLUMN method VARCHAR(20) AFTER CVaR,
+    ADD COLUMN confidence DECIMAL(5, 4) AFTER method,
+    ADD COLUMN horizon_days INT AFTER confidence;
+
+CREATE INDEX idx_risk_metric_account_date ON risk_metric(account_id, calc_date);
+
+
+-- =================================================================
+-- 2. INCREMENTAL PORTFOLIO SUMMARY MAINTENANCE
+-- =================================================================
+
+-- Latest price per security, maintained from price_snapshot inserts so
+-- valuations never scan the full snapshot history.
+CREATE TABLE IF NOT EXISTS latest_price (
+    security_id INT PRIMARY KEY,
+    price DECIMAL(12, 4) NOT NULL,
+    snapshot_ts TIMESTAMP NULL,
+    FOREIGN KEY (security_id) REFERENCES security(security_id) ON DELETE CASCADE
+);
+
+INSERT INTO latest_price (security_id, price, snapshot_ts)
+SELECT ps.security_id, ps.price, ps.snapshot_ts
+FROM price_snapshot ps
+JOIN (
+    SELECT security_id, MAX(snapshot_ts) AS snapshot_ts
+    FROM price_snapshot
+    GROUP BY security_id
+) latest ON ps.security_id = latest.security_id AND ps.snapshot_ts = latest.snapshot_ts
+ON DUPLICATE KEY UPDATE price = VALUES(price), snapshot_ts = VALUES(snapshot_ts);
+
+-- Accounts whose summary must be recomputed when a deferred session
+-- (SET @defer_portfolio_summary = 1) calls FlushPortfolioSummary().
+-- Rows belong to the session that marked them, so concurrent deferred
+-- sessions neither flush nor lock each other's accounts. Parallel
+-- loaders that should share one flush set the same
+-- @portfolio_summary_scope on every connection.
+CREATE TABLE IF NOT EXISTS portfolio_summary_dirty (
+    scope VARCHAR(64) NOT NULL,
+    account_id INT NOT NULL,
+    PRIMARY KEY (scope, account_id)
+);
+
+DROP FUNCTION IF EXISTS PortfolioSummaryScope;
+DROP PROCEDURE IF EXISTS ApplyHoldingDelta;
+DROP PROCEDURE IF EXISTS FlushPortfolioSummary;
+DROP TRIGGER IF EXISTS after_holding_insert;
+DROP TRIGGER IF EXISTS after_holding_update;
+DROP TRIGGER IF EXISTS after_holding_delete;
+DROP PROCEDURE IF EXISTS UpdatePortfolioSummary;
+DROP TRIGGER IF EXISTS after_price_snapshot_insert;
+
+-- The dirty-set scope of the current session
+DELIMITER //
+CREATE FUNCTION PortfolioSummaryScope() RETURNS VARCHAR(64)
+NOT DETERMINISTIC NO SQL
+BEGIN
+    RETURN COALESCE(@portfolio_summary_scope, CONCAT('connection:', CONNECTION_ID()));
+END //
+DELIMITER ;
+
+-- Full recalculation of one account, valued at the latest price only
+DELIMITER //
+CREATE PROCEDURE UpdatePortfolioSummary(IN p_account_id INT)
+BEGIN
+    INSERT INTO portfolio_summary (account_id, total_value, total_book_cost, unique_assets)
+    SELECT
+        p_account_id,
+        COALESCE(SUM(ph.quantity * lp.price), 0),
+        COALESCE(SUM(ph.book_cost), 0),
+        COUNT(DISTINCT ph.security_id)
+    FROM
+        portfolio_holding ph
+    LEFT JOIN
+        latest_price lp ON ph.security_id = lp.security_id
+    WHERE
+        ph.account_id = p_account_id
+    ON DUPLICATE KEY UPDATE
+        total_value = VALUES(total_value),
+        total_book_cost = VALUES(total_book_cost),
+        unique_assets = VALUES(unique_assets);
+END //
+DELIMITER ;
+
+-- Applies a +/- change to one account's summary, or marks the account
+-- dirty when summary maintenance is deferred for the session.
+DELIMITER //
+CREATE PROCEDURE ApplyHoldingDelta(
+    IN p_account_id INT,
+    IN p_security_id INT,
+    IN p_quantity DECIMAL(18, 8),
+    IN p_book_cost DECIMAL(12, 2),
+    IN p_assets INT)
+BEGIN
+    IF @defer_portfolio_summary = 1 THEN
+        INSERT IGNORE INTO portfolio_summary_dirty (scope, account_id) VALUES (PortfolioSummaryScope(), p_account_id);
+    ELSE
+        INSERT INTO portfolio_summary (account_id, total_value, total_book_cost, unique_assets)
+        VALUES (
+            p_account_id,
+            COALESCE(p_quantity, 0) * COALESCE((SELECT price FROM latest_price WHERE security_id = p_security_id), 0),
+            COALESCE(p_book_cost, 0),
+            p_assets)
+        ON DUPLICATE KEY UPDATE
+            total_value = total_value + VALUES(total_value),
+            total_book_cost = total_book_cost + VALUES(total_book_cost),
+            unique_assets = unique_assets + VALUES(unique_assets);
+    END IF;
+END //
+DELIMITER ;
+
+-- Recomputes each account this session (or scope) marked dirty once, in a
+-- single set-based statement, and clears only those marks
+DELIMITER //
+CREATE PROCEDURE FlushPortfolioSummary()
+BEGIN
+    DECLARE v_scope VARCHAR(64) DEFAULT PortfolioSummaryScope();
+
+    INSERT INTO portfolio_summary (account_id, total_value, total_book_cost, unique_assets)
+    SELECT
+        d.account_id,
+        COALESCE(SUM(ph.quantity * lp.price), 0),
+        COALESCE(SUM(ph.book_cost), 0),
+        COUNT(DISTINCT ph.security_id)
+    FROM
+        portfolio_summary_dirty d
+    LEFT JOIN
+        portfolio_holding ph ON ph.account_id = d.account_id
+    LEFT JOIN
+        latest_price lp ON ph.security_id = lp.security_id
+    WHERE
+        d.scope = v_scope
+    GROUP BY
+        d.account_id
+    ON DUPLICATE KEY UPDATE
+        total_value = VALUES(total_value),
+        total_book_cost = VALUES(total_book_cost),
+        unique_assets = VALUES(unique_assets);
+
+    DELETE FROM portfolio_summary_dirty WHERE scope = v_scope;
+END //
+DELIMITER ;
+
+DELIMITER //
+CREATE TRIGGER after_holding_insert
+AFTER INSERT ON portfolio_holding
+FOR EACH ROW
+BEGIN
+    CALL ApplyHoldingDelta(
+        NEW.account_id, NEW.security_id, NEW.quantity, NEW.book_cost,
+        IF(EXISTS(SELECT 1 FROM portfolio_holding
+                  WHERE account_id = NEW.account_id AND security_id = NEW.security_id
+                    AND holding_id <> NEW.holding_id), 0, 1));
+END; //
+
+CREATE TRIGGER after_holding_update
+AFTER UPDATE ON portfolio_holding
+FOR EACH ROW
+BEGIN
+    IF OLD.account_id = NEW.account_id AND OLD.security_id = NEW.security_id THEN
+        CALL ApplyHoldingDelta(
+            NEW.account_id, NEW.security_id,
+            NEW.quantity - OLD.quantity, NEW.book_cost - OLD.book_cost, 0);
+    ELSE
+        CALL ApplyHoldingDelta(
+            OLD.account_id, OLD.security_id, -OLD.quantity, -OLD.book_cost,
+            IF(EXISTS(SELECT 1 FROM portfolio_holding
+                      WHERE account_id = OLD.account_id AND security_id = OLD.security_id), 0, -1));
+        CALL ApplyHoldingDelta(
+            NEW.account_id, NEW.security_id, NEW.quantity, NEW.book_cost,
+            IF(EXISTS(SELECT 1 FROM portfolio_holding
+                      WHERE account_id = NEW.account_id AND security_id = NEW.security_id
+                        AND holding_id <> NEW.holding_id), 0, 1));
+    END IF;
+END; //
+
+CREATE TRIGGER after_holding_delete
+AFTER DELETE ON portfolio_holding
+FOR EACH ROW
+BEGIN
+    CALL ApplyHoldingDelta(
+        OLD.account_id, OLD.security_id, -OLD.quantity, -OLD.book_cost,
+        IF(EXISTS(SELECT 1 FROM portfolio_holding
+                  WHERE account_id = OLD.account_id AND security_id = OLD.security_id), 0, -1));
+END; //
+
+-- A newer snapshot moves latest_price and revalues every holder by
+-- quantity x (new price - old price).
+CREATE TRIGGER after_price_snapshot_insert
+AFTER INSERT ON price_snapshot
+FOR EACH ROW
+BEGIN
+    DECLARE v_old_price DECIMAL(12, 4) DEFAULT NULL;
+    DECLARE v_old_ts TIMESTAMP DEFAULT NULL;
+    DECLARE v_found INT DEFAULT 0;
+    DECLARE CONTINUE HANDLER FOR NOT FOUND SET v_found = 0;
+
+    SELECT price, snapshot_ts, 1 INTO v_old_price, v_old_ts, v_found
+    FROM latest_price WHERE security_id = NEW.security_id;
+
+    IF v_found = 0 OR v_old_ts IS NULL OR NEW.snapshot_ts >= v_old_ts THEN
+        INSERT INTO latest_price (security_id, price, snapshot_ts)
+        VALUES (NEW.security_id, NEW.price, NEW.snapshot_ts)
+        ON DUPLICATE KEY UPDATE price = VALUES(price), snapshot_ts = VALUES(snapshot_ts);
+
+        IF @defer_portfolio_summary = 1 THEN
+            INSERT IGNORE INTO portfolio_summary_dirty (scope, account_id)
+            SELECT DISTINCT PortfolioSummaryScope(), account_id FROM portfolio_holding WHERE security_id = NEW.security_id;
+        ELSE
+            UPDATE portfolio_summary ps
+            JOIN (
+                SELECT account_id, SUM(quantity) AS quantity
+                FROM portfolio_holding
+                WHERE security_id = NEW.security_id
+                GROUP BY account_id
+            ) h ON ps.account_id = h.account_id
+            SET ps.total_value = ps.total_value + h.quantity * (NEW.price - COALESCE(v_old_price, 0));
+        END IF;
+    END IF;
+END; //
+DELIMITER ;
+
+-- Rebuild every summary once, discarding totals inflated by the old
+-- per-snapshot join.
+INSERT IGNORE INTO portfolio_summary_dirty (scope, account_id)
+SELECT PortfolioSummaryScope(), account_id FROM broker_account;
+CALL FlushPortfolioSummary();
+
+
+-- =================================================================
+-- 3. PRICE LOOKUPS
+-- =================================================================
+
+-- Latest and as-of price lookups seek one security's snapshots in time
+-- order instead of scanning every snapshot.
+CREATE INDEX idx_price_snapshot_security_ts ON price_snapshot(security_id, snapshot_ts);
+
+
+-- =================================================================
+-- 4. BACKGROUND RISK JOBS
+-- =================================================================
+
+-- Persistent queue behind jobs.py (needs MySQL 8.0 for SKIP LOCKED).
+-- dedupe_key is set while a job is queued, so repeating a request for
+-- the same account and options returns the queued job; it is cleared
+-- when a worker claims the job and restored from queue_key when the job
+-- is queued again. account_id NULL means every account.
+CREATE TABLE IF NOT EXISTS risk_job (
+    job_id BIGINT PRIMARY KEY AUTO_INCREMENT,
+    kind VARCHAR(20) NOT NULL,
+    account_id INT NULL,
+    options JSON NOT NULL,
+    options_key CHAR(16) NOT NULL,
+    queue_key VARCHAR(64) NOT NULL,
+    dedupe_key VARCHAR(64) NULL,
+    status ENUM('queued', 'running', 'done', 'failed') NOT NULL DEFAULT 'queued',
+    attempts INT NOT NULL DEFAULT 0,
+    result JSON NULL,
+    error TEXT NULL,
+    worker VARCHAR(64) NULL,
+    run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_until TIMESTAMP NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP NULL,
+    finished_at TIMESTAMP NULL,
+    UNIQUE KEY uq_risk_job_dedupe (dedupe_key),
+    INDEX idx_risk_job_status (status, run_after),
+    INDEX idx_risk_job_batch (status, kind, options_key, job_id),
+    INDEX idx_risk_job_finished (finished_at)
+);
@@ -0,0 +1,351 @@
+import datetime
+import decimal
+import threading
+import time
+from collections import deque
+
+import pandas as pd
+
+WINDOW_DAYS = 365
+# Re-read a few days before the newest cached bar so symbols ingested
+# behind the others still get their bars
+REFRESH_OVERLAP_DAYS = 7
+# Re-read every company row this often, to pick up fundamentals changed
+# outside the API (between full reads only new symbols and symbols with
+# new bars are re-read)
+COMPANY_RELOAD_SECONDS = 3600.0
+COMPANY_FIELDS = ('symbol', 'long_name', 'sector', 'industry', 'market_cap', 'current_price', 'ebitda', 'revenue_growth')
+MAX_LIMIT = 500
+
+
+class RollingWindow:
+    """Trailing high, low and average close over a daily series.
+
+    Monotonic deques give the window low and high, and a running sum gives
+    the average, so each new bar costs O(1) amortized. Corrections to bars
+    already in the window go through ``revise``, which rebuilds it.
+    """
+
+    def __init__(self, days=WINDOW_DAYS):
+        self.days = days
+        self._reset()
+
+    def _reset(self):
+        self.last_day = None
+        self.last_close = None
+        self._bars = deque()
+        self._lows = deque()
+        self._highs = deque()
+        self._sum = 0.0
+
+    def push(self, day, low, high, close):
+        """Adds one bar; ``day`` is an ordinal day number. Bars not after the last one are ignored."""
+        if self.last_day is not None and day <= self.last_day:
+            return False
+        self._bars.append((day, low, high, close))
+        self._sum += close
+        while self._lows and self._lows[-1][1] >= low:
+            self._lows.pop()
+        self._lows.append((day, low))
+        while self._highs and self._highs[-1][1] <= high:
+            self._highs.pop()
+        self._highs.append((day, high))
+        self.last_day, self.last_close = day, close
+
+        start = day - self.days
+        while self._bars[0][0] < start:
+            self._sum -= self._bars.popleft()[3]
+        while self._lows[0][0] < start:
+            self._lows.popleft()
+        while self._highs[0][0] < start:
+            self._highs.popleft()
+        return True
+
+    def revise(self, bars):
+        """Applies re-read (day, low, high, close) bars up to ``last_day``; rebuilds the window if any differ."""
+        stored = {bar[0]: bar for bar in self._bars}
+        changed = {bar[0]: bar for bar in bars if stored.get(bar[0]) != bar}
+        if not changed:
+            return False
+        stored.update(changed)
+        self._reset()
+        for bar in sorted(stored.values()):
+            self.push(*bar)
+        return True
+
+    @property
+    def low(self):
+        return self._lows[0][1] if self._lows else None
+
+    @property
+    def high(self):
+        return self._highs[0][1] if self._highs else None
+
+    @property
+    def average(self):
+        return self._sum / len(self._bars) if self._bars else None
+
+
+class ScreenEngine:
+    """Incrementally maintained aggregates behind the stock screens.
+
+    Keeps company fundamentals with a running market-cap sum and count per
+    industry, and a 52-week RollingWindow per symbol and for the S&P 500.
+    ``refresh`` reads only bars newer than those cached (the first load
+    reads one window of history), so a screen is a pass over the companies
+    rather than over price history. Bars re-read in the overlap that differ
+    from the cached ones rebuild that symbol's window. The company write
+    routes keep the fundamentals current through
+    ``upsert_company``/``remove_company``; a refresh re-reads only new
+    symbols and symbols with new bars, plus every company once per
+    ``company_reload`` seconds.
+    """
+
+    def __init__(self, window_days=WINDOW_DAYS, max_age=60.0, company_reload=COMPANY_RELOAD_SECONDS):
+        self.window_days = window_days
+        self.max_age = max_age
+        self.company_reload = company_reload
+        self._lock = threading.RLock()
+        self._checked_at = None
+        self._companies_read_at = None
+        self.companies = {}
+        self._industries = {}
+        self.windows = {}
+        self.index_window = RollingWindow(window_days)
+        self._last_day = None
+
+    def refresh(self, connection, force=False):
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._checked_at is not None and now - self._checked_at < self.max_age:
+                return False
+            self._checked_at = now
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT symbol FROM companies")
+                present = {_first(row) for row in cursor.fetchall()}
+                start = self._start_date(cursor)
+                cursor.execute("""
+                    SELECT symbol, date, low, high, close FROM stock_prices
+                    WHERE date >= %s AND close IS NOT NULL ORDER BY date
+                """, (start,))
+                bars = cursor.fetchall()
+                cursor.execute("""
+                    SELECT date, sp500_value FROM sp500_index
+                    WHERE date >= %s AND sp500_value IS NOT NULL ORDER BY date
+                """, (start,))
+                index_bars = cursor.fetchall()
+
+                touched = self._apply_bars(bars)
+                index = pd.DataFrame.from_records([_record(b, ('date', 'sp500_value')) for b in index_bars],
+                                                  columns=['date', 'sp500_value'])
+                if not index.empty:
+                    values = index['sp500_value'].astype(float)
+                    self._update_window(self.index_window, [(day, value, value, value) for day, value
+                                                            in zip(_ordinal_days(index['date']), values)])
+
+                for symbol in set(self.companies) - present:
+                    self.remove_company(symbol)
+                sql = "SELECT {} FROM companies".format(', '.join(COMPANY_FIELDS))
+                if self._companies_read_at is None or now - self._companies_read_at >= self.company_reload:
+                    cursor.execute(sql)
+                    self._companies_read_at = now
+                else:
+                    changed = sorted((present - set(self.companies)) | (touched & present))
+                    if not changed:
+                        return True
+                    cursor.execute(sql + " WHERE symbol IN (%s)" % ', '.join(['%s'] * len(changed)), changed)
+                rows = cursor.fetchall()
+            for row in rows:
+                self.upsert_company(_record(row, COMPANY_FIELDS))
+            return True
+
+    def _apply_bars(self, bars):
+        """Feeds stock_prices rows into the per-symbol windows; returns the symbols whose window changed."""
+        frame = pd.DataFrame.from_records([_record(b, ('symbol', 'date', 'low', 'high', 'close')) for b in bars],
+                                          columns=['symbol', 'date', 'low', 'high', 'close'])
+        if frame.empty:
+            return set()
+        frame['day'] = _ordinal_days(frame['date'])
+        close = frame['close'].astype(float)
+        frame['low'] = frame['low'].astype(float).fillna(close)
+        frame['high'] = frame['high'].astype(float).fillna(close)
+        frame['close'] = close
+        touched = set()
+        for symbol, group in frame.groupby('symbol', sort=False):
+            window = self.windows.get(symbol)
+            if window is None:
+                window = self.windows[symbol] = RollingWindow(self.window_days)
+            rows = list(group[['day', 'low', 'high', 'close']].itertuples(index=False, name=None))
+            if self._update_window(window, rows):
+                touched.add(symbol)
+        self._last_day = max(self._last_day or 0, int(frame['day'].max()))
+        return touched
+
+    @staticmethod
+    def _update_window(window, rows):
+        """Revises ``window`` with the rows it already covers and pushes the newer ones; True if anything changed."""
+        last = window.last_day
+        changed = False
+        if last is not None:
+            changed = window.revise([row for row in rows if row[0] <= last])
+            rows = [row for row in rows if row[0] > last]
+        for row in rows:
+            changed = window.push(*row) or changed
+        return changed
+
+    def _start_date(self, cursor):
+        if self._last_day is not None:
+            day = self._last_day - REFRESH_OVERLAP_DAYS
+        else:
+            # First load: one window back from the newest bar
+            cursor.execute("SELECT MAX(date) FROM stock_prices")
+            latest = _first(cursor.fetchone())
+            cursor.execute("SELECT MAX(date) FROM sp500_index")
+            latest_index = _first(cursor.fetchone())
+            days = [int(_ordinal_days(pd.Series([d]))[0]) for d in (latest, latest_index) if d is not None]
+            day = max(days) - self.window_days if days else 0
+        return datetime.date.fromordinal(max(day, 1)).isoformat()
+
+    def upsert_company(self, row):
+        with self._lock:
+            row = {field: row.get(field) for field in COMPANY_FIELDS}
+            for field in ('market_cap', 'current_price', 'ebitda', 'revenue_growth'):
+                if isinstance(row[field], decimal.Decimal):
+                    row[field] = float(row[field])
+            self._remove_from_industry(self.companies.get(row['symbol']))
+            self.companies[row['symbol']] = row
+            if row['industry'] is not None and row['market_cap'] is not None:
+                totals = self._industries.setdefault(row['industry'], [0.0, 0])
+                totals[0] += row['market_cap']
+                totals[1] += 1
+
+    def remove_company(self, symbol):
+        with self._lock:
+            self._remove_from_industry(self.companies.pop(symbol, None))
+
+    def _remove_from_industry(self, row):
+        if row is None or row['industry'] is None or row['market_cap'] is None:
+            return
+        totals = self._industries[row['industry']]
+        totals[0] -= row['market_cap']
+        totals[1] -= 1
+        if totals[1] == 0:
+            del self._industries[row['industry']]
+
+    def industry_average(self, industry):
+        totals = self._industries.get(industry)
+        return totals[0] / totals[1] if totals else None
+
+    def run(self, name, args):
+        """Runs a registered screen with thresholds parsed from ``args``; raises KeyError for unknown names."""
+        screen, defaults = SCREENS[name]
+        params = parse_params(defaults, args)
+        with self._lock:
+            return screen(self, **params)
+
+
+def parse_params(defaults, args):
+    """Casts ``args`` to the types of ``defaults``; unknown parameters are ignored."""
+    params = {}
+    for key, default in defaults.items():
+        raw = args.get(key)
+        if raw is None:
+            params[key] = default
+            continue
+        try:
+            params[key] = type(default)(raw)
+        except ValueError:
+            raise ValueError(f"Invalid value for {key}: {raw}")
+    if 'limit' in params:
+        params['limit'] = max(1, min(params['limit'], MAX_LIMIT))
+    return params
+
+
+def tech_leaders(engine, sector='Technology', limit=15):
+    """Companies in ``sector`` whose market cap beats their industry average."""
+    rows = []
+    for row in engine.companies.values():
+        if row['sector'] != sector or row['market_cap'] is None:
+            continue
+        average = engine.industry_average(row['industry'])
+        if average is not None and row['market_cap'] > average:
+            rows.append(dict(_project(row, 'long_name', 'symbol', 'industry', 'market_cap'),
+                             industry_avg_market_cap=average))
+    rows.sort(key=lambda r: (r['industry'], -r['market_cap']))
+    return rows[:limit]
+
+
+def high_momentum(engine, min_ratio=1.5, limit=15):
+    """Stocks trading at least ``min_ratio`` times their 52-week low."""
+    rows = []
+    for symbol, row in engine.companies.items():
+        window = engine.windows.get(symbol)
+        price = row['current_price']
+        if window is None or window.low is None or window.low <= 0 or price is None:
+            continue
+        ratio = price / window.low
+        if ratio >= min_ratio:
+            rows.append(dict(_project(row, 'long_name', 'symbol', 'current_price'),
+                             low_52_week=window.low, high_52_week=window.high, ratio=ratio))
+    rows.sort(key=lambda r: -r['ratio'])
+    return rows[:limit]
+
+
+def undervalued(engine, max_ebitda_multiple=5.0, min_revenue_growth=0.0, limit=15):
+    """Companies valued under ``max_ebitda_multiple`` x EBITDA with revenue growth above the minimum."""
+    rows = []
+    for row in engine.companies.values():
+        market_cap, ebitda, growth = row['market_cap'], row['ebitda'], row['revenue_growth']
+        if market_cap is None or not ebitda or growth is None:
+            continue
+        if market_cap < max_ebitda_multiple * ebitda and growth > min_revenue_growth:
+            rows.append(dict(_project(row, 'long_name', 'symbol', 'market_cap', 'ebitda', 'revenue_growth'),
+                             ebitda_multiple=market_cap / ebitda))
+    rows.sort(key=lambda r: r['ebitda_multiple'])
+    return rows[:limit]
+
+
+def sp500_vs_52w(engine):
+    """Latest S&P 500 value against its 52-week average, high and low."""
+    window = engine.index_window
+    if window.last_day is None:
+        return None
+    current, average = window.last_close, window.average
+    return {
+        'as_of': datetime.date.fromordinal(window.last_day).isoformat(),
+        'current_sp500': current,
+        'avg_sp500_52_week': average,
+        'high_sp500_52_week': window.high,
+        'low_sp500_52_week': window.low,
+        'pct_vs_avg': (current / average - 1.0) if average else None,
+    }
+
+
+# name -> (screen, default parameters)
+SCREENS = {
+    'tech-leaders': (tech_leaders, {'sector': 'Technology', 'limit': 15}),
+    'high-momentum': (high_momentum, {'min_ratio': 1.5, 'limit': 15}),
+    'undervalued': (undervalued, {'max_ebitda_multiple': 5.0, 'min_revenue_growth': 0.0, 'limit': 15}),
+    'sp500-vs-52w': (sp500_vs_52w, {}),
+}
+
+
+def _project(row, *fields):
+    return {field: row[field] for field in fields}
+
+
+def _record(row, columns):
+    # Works with both tuple and dict cursors
+    return dict(row) if isinstance(row, dict) else dict(zip(columns, row))
+
+
+def _first(row):
+    if row is None:
+        return None
+    return next(iter(row.values())) if isinstance(row, dict) else row[0]
+
+
+def _ordinal_days(dates):
+    # datetime64 days since the epoch shifted to proleptic Gregorian ordinals
+    epoch = datetime.date(1970, 1, 1).toordinal()
+    return pd.to_datetime(dates).to_numpy().astype('datetime64[D]').astype('int64') + epoch
@@ -0,0 +1,177 @@
+import heapq
+import math
+import re
+import threading
+from bisect import bisect_left
+
+# Relevance weight of a match in each indexed field
+FIELD_WEIGHTS = {
+    'symbol': 8.0,
+    'short_name': 4.0,
+    'long_name': 4.0,
+    'sector': 2.0,
+    'industry': 2.0,
+    'long_business_summary': 1.0,
+}
+DEFAULT_FIELDS = ('symbol', 'short_name', 'long_name', 'sector', 'industry', 'market_cap', 'current_price')
+# Fields that change with prices; they are not cached in the index but
+# read from the database for each result page (see live_query)
+VOLATILE_FIELDS = ('market_cap', 'current_price')
+# Completions tried for a prefix term; short prefixes keep the most common
+# tokens rather than the alphabetically first ones
+MAX_PREFIX_EXPANSIONS = 64
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(str(text).lower()) if text else []
+
+
+def live_query(ranked, fields):
+    """(sql, params) reading the volatile ``fields`` of ranked results, or None if none are requested."""
+    columns = [field for field in fields if field in VOLATILE_FIELDS]
+    if not columns or not ranked:
+        return None
+    symbols = [symbol for symbol, _ in ranked]
+    sql = "SELECT symbol, %s FROM companies WHERE symbol IN (%s)" % (', '.join(columns), ', '.join(['%s'] * len(symbols)))
+    return sql, symbols
+
+
+class CompanySearchIndex:
+    """In-memory inverted index over company symbols, names, sector, industry and summary.
+
+    Postings map each token to ``{symbol: weight}``. The last query term is
+    matched as a prefix against the sorted vocabulary for typeahead (the
+    ``MAX_PREFIX_EXPANSIONS`` completions found in most documents), results
+    are ranked by idf-weighted field scores, and documents are added,
+    replaced or removed individually as companies change. Documents leave
+    out ``VOLATILE_FIELDS``, which callers join in at query time.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings = {}
+        self._doc_tokens = {}
+        self._docs = {}
+        self._vocabulary = []
+        self._vocabulary_dirty = False
+        self.built = False
+
+    def build(self, rows):
+        """Replaces the index contents with ``rows``."""
+        with self._lock:
+            self._postings, self._doc_tokens, self._docs = {}, {}, {}
+            for row in rows:
+                self._add(row)
+            self.built = True
+
+    def add(self, row):
+        """Indexes a company row, replacing any previous version of it."""
+        with self._lock:
+            self._remove(row['symbol'])
+            self._add(row)
+
+    def remove(self, symbol):
+        with self._lock:
+            self._remove(symbol)
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _add(self, row):
+        symbol = row['symbol']
+        weights = {}
+        for field, field_weight in FIELD_WEIGHTS.items():
+            tokens = tokenize(row.get(field))
+            if not tokens:
+                continue
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            # Damp term frequency and long fields such as the business summary
+            norm = 1.0 + math.log(len(tokens))
+            for token, count in counts.items():
+                weights[token] = weights.get(token, 0.0) + field_weight * (1.0 + math.log(count)) / norm
+        for token, weight in weights.items():
+            self._postings.setdefault(token, {})[symbol] = weight
+        self._doc_tokens[symbol] = set(weights)
+        self._docs[symbol] = {field: value for field, value in row.items() if field not in VOLATILE_FIELDS}
+        self._vocabulary_dirty = True
+
+    def _remove(self, symbol):
+        for token in self._doc_tokens.pop(symbol, ()):
+            posting = self._postings.get(token)
+            if posting is not None:
+                posting.pop(symbol, None)
+                if not posting:
+                    del self._postings[token]
+                    self._vocabulary_dirty = True
+        self._docs.pop(symbol, None)
+
+    def _expand(self, prefix):
+        if self._vocabulary_dirty:
+            self._vocabulary = sorted(self._postings)
+            self._vocabulary_dirty = False
+        # Tokens only hold [a-z0-9], which all sort below '{'
+        matches = self._vocabulary[bisect_left(self._vocabulary, prefix):bisect_left(self._vocabulary, prefix + '{')]
+        if len(matches) > MAX_PREFIX_EXPANSIONS:
+            matches = heapq.nlargest(MAX_PREFIX_EXPANSIONS, matches, key=lambda token: len(self._postings[token]))
+        return matches
+
+    def search(self, query, limit=20, fields=DEFAULT_FIELDS, prefix=True, live=None):
+        """Returns up to ``limit`` ranked company rows projected to ``fields``.
+
+        Volatile fields are taken from ``live`` ({symbol: row}, e.g. the
+        rows of ``live_query``) and are None without it.
+        """
+        return self.project(self.rank(query, limit, prefix), fields, live)
+
+    def project(self, ranked, fields=DEFAULT_FIELDS, live=None):
+        """Company rows for ``rank`` results, with volatile fields from ``live``."""
+        live = live or {}
+        results = []
+        with self._lock:
+            for symbol, score in ranked:
+                doc, current = self._docs.get(symbol, {}), live.get(symbol, {})
+                row = {field: (current if field in VOLATILE_FIELDS else doc).get(field) for field in fields}
+                results.append(dict(row, score=round(score, 4)))
+        return results
+
+    def rank(self, query, limit=20, prefix=True):
+        """Returns up to ``limit`` (symbol, score) pairs, best first.
+
+        Every query term must match; with ``prefix`` the last term also
+        matches any indexed token it starts. A query without terms matches
+        every company, in symbol order, as the old ``LIKE '%%'`` search did.
+        """
+        terms = tokenize(query)
+        with self._lock:
+            if not terms:
+                return [(symbol, 0.0) for symbol in sorted(self._docs)[:limit]]
+            n_docs = max(len(self._docs), 1)
+            scores = None
+            for i, term in enumerate(terms):
+                candidates = self._expand(term) if prefix and i == len(terms) - 1 else [term]
+                term_scores = {}
+                for token in candidates:
+                    posting = self._postings.get(token, {})
+                    if not posting:
+                        continue
+                    idf = math.log(1.0 + n_docs / len(posting))
+                    # Exact matches outrank prefix completions
+                    boost = 1.0 if token == term else 0.5
+                    for symbol, weight in posting.items():
+                        score = weight * idf * boost
+                        if score > term_scores.get(symbol, 0.0):
+                            term_scores[symbol] = score
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {s: scores[s] + v for s, v in term_scores.items() if s in scores}
+                if not scores:
+                    return []
+
+            upper = query.strip().upper()
+            if upper in scores:
+                scores[upper] *= 2.0
+            return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
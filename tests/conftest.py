@@ -0,0 +1,59 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# app.py reads its database settings at import time; no test connects with them
+os.environ.setdefault('DB_USER', 'test')
+os.environ.setdefault('DB_PASS', 'test')
+os.environ.setdefault('JOB_WORKERS', '0')
+
+
+class FakeCursor:
+    """DictCursor stand-in that records statements and answers from ``connection.respond``."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=()):
+        self.connection.executed.append((' '.join(sql.split()), params))
+        self.rows = list(self.connection.respond(sql, params))
+        self.rowcount = len(self.rows)
+        return self.rowcount
+
+    def executemany(self, sql, seq):
+        seq = list(seq)
+        self.connection.executed.append((' '.join(sql.split()), seq))
+        self.rowcount = len(seq)
+        return self.rowcount
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchmany(self, size=1):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, respond=None):
+        self.respond = respond or (lambda sql, params: [])
+        self.executed = []
+        self.commits = 0
+
+    def cursor(self, *args):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
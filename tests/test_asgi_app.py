@@ -0,0 +1,147 @@
+import asyncio
+
+import pytest
+
+import asgi_app
+
+
+class FakeAsyncCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, sql, params=()):
+        self.connection.executed.append((sql, params))
+        await self.connection.gate.wait()
+
+    async def fetchall(self):
+        return self.connection.rows
+
+
+class FakeAsyncConnection:
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.executed = []
+        self.closed = False
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    def cursor(self, *args):
+        return FakeAsyncCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool:
+    def __init__(self, connection):
+        self.connection = connection
+        self.released = []
+
+    async def acquire(self):
+        return self.connection
+
+    def release(self, connection):
+        self.released.append(connection)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = FakePool(FakeAsyncConnection())
+    monkeypatch.setattr(asgi_app, 'db_pool', pool)
+    return pool
+
+
+def test_fetch_all_closes_connection_when_cancelled(pool):
+    async def scenario():
+        pool.connection.gate.clear()
+        task = asyncio.create_task(asgi_app.fetch_all("SELECT 1"))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assert pool.connection.closed
+    assert pool.released == [pool.connection]
+
+
+def test_fetch_all_keeps_connection_on_success(pool):
+    pool.connection.rows = [{'n': 1}]
+    assert asyncio.run(asgi_app.fetch_all("SELECT 1 AS n")) == [{'n': 1}]
+    assert not pool.connection.closed
+    assert pool.released == [pool.connection]
+
+
+def test_abandoned_stream_releases_its_slot(monkeypatch):
+    monkeypatch.setattr(asgi_app, 'limiter', asyncio.Semaphore(1))
+    monkeypatch.setattr(asgi_app, 'in_flight', 0)
+    closed = []
+
+    async def body():
+        try:
+            while True:
+                yield 'row\n'
+        finally:
+            closed.append(True)
+
+    async def scenario():
+        await asgi_app.limiter.acquire()
+        asgi_app.in_flight += 1
+        stream = asgi_app.resume('[', asgi_app.hold_slot(body(), timeout=5))
+        assert await stream.__anext__() == '['
+        assert await stream.__anext__() == 'row\n'
+        # The client goes away after two chunks
+        await stream.aclose()
+
+    asyncio.run(scenario())
+    assert closed == [True]
+    assert asgi_app.in_flight == 0
+    assert not asgi_app.limiter.locked()
+
+
+def test_stalled_stream_is_cut_off_and_releases_its_slot(monkeypatch):
+    monkeypatch.setattr(asgi_app, 'limiter', asyncio.Semaphore(1))
+    monkeypatch.setattr(asgi_app, 'in_flight', 0)
+
+    async def body():
+        yield 'row\n'
+        await asyncio.sleep(60)
+        yield 'never\n'
+
+    async def scenario():
+        await asgi_app.limiter.acquire()
+        asgi_app.in_flight += 1
+        return [chunk async for chunk in asgi_app.hold_slot(body(), timeout=0.05)]
+
+    assert asyncio.run(scenario()) == ['row\n']
+    assert asgi_app.in_flight == 0
+    assert not asgi_app.limiter.locked()
+
+
+def test_summary_route_through_test_client(pool, monkeypatch):
+    monkeypatch.setattr(asgi_app, 'limiter', asyncio.Semaphore(1))
+    asgi_app.flask_app.response_cache.invalidate('account:41')
+    pool.connection.rows = [{'account_id': 41, 'total_value': 1250.5}]
+
+    async def scenario():
+        client = asgi_app.app.test_client()
+        first = await client.get('/api/portfolio/summary/41')
+        body = await first.get_json()
+        second = await client.get('/api/portfolio/summary/41',
+                                  headers={'If-None-Match': first.headers['ETag']})
+        return first, body, second
+
+    first, body, second = asyncio.run(scenario())
+    assert first.status_code == 200
+    assert body == {'account_id': 41, 'total_value': 1250.5}
+    assert first.headers['X-Cache'] == 'MISS'
+    assert second.status_code == 304
+    assert pool.connection.executed == [
+        ("SELECT * FROM portfolio_summary WHERE account_id = %s", (41,))]
+    assert asgi_app.in_flight == 0
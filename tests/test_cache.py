@@ -0,0 +1,118 @@
+import json
+
+import pytest
+
+import app
+import cache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, 'monotonic', clock)
+    return clock
+
+
+def test_ttl_cache_expires_entries(clock):
+    store = cache.TTLCache(ttl=10)
+    store.set('a', 1)
+    store.set('b', 2, ttl=30)
+    clock.now += 11
+    assert store.get('a') is None
+    assert store.get('b') == 2
+    assert store.stats() == {
+        'backend': 'memory', 'size': 1, 'maxsize': 1024, 'hits': 1, 'misses': 1, 'evictions': 1}
+
+
+def test_ttl_cache_evicts_least_recently_used(clock):
+    store = cache.TTLCache(maxsize=2)
+    store.set('a', 1)
+    store.set('b', 2)
+    store.get('a')
+    store.set('c', 3)
+    assert store.get('b') is None
+    assert (store.get('a'), store.get('c')) == (1, 3)
+    assert store.evictions == 1
+
+
+def test_ttl_cache_counters_outlive_entries(clock):
+    store = cache.TTLCache(ttl=1)
+    assert store.incr('gen:x') == 1
+    clock.now += 100
+    assert store.counter('gen:x') == 1
+
+
+@pytest.fixture
+def responses():
+    return cache.ResponseCache(cache.TTLCache())
+
+
+def test_invalidating_a_tag_changes_the_key(responses):
+    key = responses.key('summary:1', ['account:1', 'companies'])
+    responses.set(key, {'body': 'old'})
+    other = responses.key('summary:2', ['account:2'])
+    responses.invalidate('account:1')
+    assert responses.key('summary:1', ['account:1', 'companies']) != key
+    assert responses.key('summary:2', ['account:2']) == other
+    assert responses.get(responses.key('summary:1', ['account:1', 'companies'])) is None
+
+
+def test_a_read_keyed_before_a_write_cannot_serve_stale_data(responses):
+    # The reader takes its key, the write invalidates, then the reader stores
+    stale_key = responses.key('companies', ['companies'])
+    responses.invalidate('companies')
+    responses.set(stale_key, {'body': 'stale'})
+    assert responses.get(responses.key('companies', ['companies'])) is None
+
+
+@pytest.fixture
+def flask_cache(monkeypatch):
+    monkeypatch.setattr(app, 'response_cache', cache.ResponseCache(cache.TTLCache()))
+    return app.response_cache
+
+
+def test_cached_response_serves_hits_and_304s(flask_cache):
+    builds = []
+
+    def build():
+        builds.append(1)
+        return app.jsonify({'value': 42})
+
+    with app.app.test_request_context('/x'):
+        first = app.cached_response('x', ['tag'], build)
+    with app.app.test_request_context('/x'):
+        second = app.cached_response('x', ['tag'], build)
+    etag = first.headers['ETag']
+    with app.app.test_request_context('/x', headers={'If-None-Match': etag}):
+        revalidated = app.cached_response('x', ['tag'], build)
+
+    assert (first.headers['X-Cache'], second.headers['X-Cache']) == ('MISS', 'HIT')
+    assert json.loads(second.get_data()) == {'value': 42}
+    assert second.headers['ETag'] == etag
+    assert revalidated.status_code == 304
+    assert len(builds) == 1
+
+    flask_cache.invalidate('tag')
+    with app.app.test_request_context('/x', headers={'If-None-Match': etag}):
+        rebuilt = app.cached_response('x', ['tag'], build)
+    # Same body, so the ETag still matches after the rebuild
+    assert rebuilt.status_code == 304
+    assert rebuilt.headers['X-Cache'] == 'MISS'
+    assert len(builds) == 2
+
+
+def test_cached_response_does_not_store_errors(flask_cache):
+    def build():
+        return app.jsonify({'error': 'nope'}), 404
+
+    with app.app.test_request_context('/x'):
+        assert app.cached_response('x', [], build)[1] == 404
+    assert len(flask_cache.backend) == 0
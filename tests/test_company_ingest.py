@@ -0,0 +1,105 @@
+import threading
+
+import pytest
+
+import company_ingest
+from conftest import FakeConnection
+
+
+def info(symbol, **fields):
+    return dict({'symbol': symbol, 'shortName': f'{symbol} Inc', 'trailingPegRatio': 1.2}, **fields)
+
+
+class FakeProvider:
+    """Offline provider returning canned ``info`` dicts and counting lookups."""
+
+    def __init__(self, infos):
+        self.infos = infos
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def fetch_info(self, symbol):
+        with self._lock:
+            self.calls.append(symbol)
+        result = self.infos[symbol]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def test_company_row_maps_provider_keys_to_columns():
+    row = company_ingest.company_row(info('MSFT', marketCap=3_000_000, fullTimeEmployees=221000))
+    assert list(row) == company_ingest.COMPANY_COLUMNS
+    assert (row['symbol'], row['short_name'], row['market_cap'], row['full_time_employees']) == (
+        'MSFT', 'MSFT Inc', 3_000_000, 221000)
+    assert row['long_name'] is None
+
+
+@pytest.mark.parametrize('payload', [{}, None, {'symbol': 'X'}, {'trailingPegRatio': 1.0}])
+def test_company_row_rejects_unusable_info(payload):
+    with pytest.raises(company_ingest.TickerNotFound):
+        company_ingest.company_row(payload)
+
+
+def test_fetch_companies_collects_rows_and_errors():
+    provider = FakeProvider({
+        'AAPL': info('AAPL'),
+        'MSFT': info('MSFT'),
+        'NOPE': {'symbol': 'NOPE'},
+        'BOOM': RuntimeError("rate limited"),
+    })
+    rows, errors = company_ingest.fetch_companies(provider, ['aapl', ' MSFT ', 'msft', '', 'NOPE', 'BOOM'],
+                                                  max_workers=3)
+    assert [row['symbol'] for row in rows] == ['AAPL', 'MSFT']
+    assert errors == {'NOPE': "Could not find data for ticker: NOPE", 'BOOM': "rate limited"}
+    # Tickers are normalized and looked up once each
+    assert sorted(provider.calls) == ['AAPL', 'BOOM', 'MSFT', 'NOPE']
+
+
+def test_fetch_companies_waits_on_the_rate_limiter():
+    class CountingLimiter:
+        calls = 0
+
+        def acquire(self):
+            CountingLimiter.calls += 1
+
+    provider = FakeProvider({'A': info('A'), 'B': info('B')})
+    company_ingest.fetch_companies(provider, ['A', 'B'], rate_limiter=CountingLimiter())
+    assert CountingLimiter.calls == 2
+
+
+def test_cached_provider_skips_repeat_lookups():
+    provider = FakeProvider({'MSFT': info('MSFT')})
+    cached = company_ingest.CachedInfoProvider(provider, ttl=60)
+    assert cached.fetch_info('MSFT') is cached.fetch_info('msft')
+    assert provider.calls == ['MSFT']
+
+
+def test_rate_limiter_allows_bursts_then_sleeps(monkeypatch):
+    now = [100.0]
+    sleeps = []
+    monkeypatch.setattr(company_ingest.time, 'monotonic', lambda: now[0])
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(company_ingest.time, 'sleep', sleep)
+    limiter = company_ingest.RateLimiter(rate=2, burst=2)
+    for _ in range(3):
+        limiter.acquire()
+    assert sleeps == [pytest.approx(0.5)]
+
+
+def test_upsert_companies_batches_rows():
+    rows = [company_ingest.company_row(info(symbol)) for symbol in ('A', 'B', 'C')]
+    connection = FakeConnection()
+    with connection.cursor() as cursor:
+        assert company_ingest.upsert_companies(cursor, rows, batch_size=2) == 3
+    (first_sql, first_params), (_, second_params) = connection.executed
+    assert first_sql.startswith("INSERT INTO companies (exchange, symbol, short_name")
+    assert "ON DUPLICATE KEY UPDATE exchange=VALUES(exchange), short_name=VALUES(short_name)" in first_sql
+    assert "symbol=VALUES" not in first_sql
+    width = len(company_ingest.COMPANY_COLUMNS)
+    assert len(first_params) == 2 * width and len(second_params) == width
+    assert second_params[1] == 'C'
@@ -0,0 +1,119 @@
+import sqlite3
+import threading
+import time
+
+import pymysql
+import pytest
+
+import db_pool
+
+
+def sqlite_pool(**kwargs):
+    return db_pool.ConnectionPool(lambda: sqlite3.connect(':memory:', check_same_thread=False), **kwargs)
+
+
+def test_checkout_times_out_when_the_pool_is_exhausted():
+    pool = sqlite_pool(max_size=1)
+    held = pool.connection()
+    with pytest.raises(db_pool.PoolTimeout):
+        pool.connection(timeout=0.05)
+    held.close()
+    assert pool.stats()['timeouts'] == 1
+
+
+def test_checkout_blocks_until_a_connection_is_released():
+    pool = sqlite_pool(max_size=1)
+    held = pool.connection()
+    raw = held.raw
+    got = []
+
+    def waiter():
+        with pool.connection(timeout=5) as connection:
+            got.append(connection.raw)
+
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    time.sleep(0.1)
+    assert pool.stats()['waiters'] == 1
+    held.close()
+    thread.join(5)
+    stats = pool.stats()
+    assert got == [raw]
+    assert stats['created'] == 1
+    assert stats['wait_time_max'] >= 0.05
+    assert stats['in_use'] == 0 and stats['idle'] == 1
+
+
+def test_idle_connections_are_evicted():
+    pool = sqlite_pool(max_size=2, max_idle=0.05)
+    first, second = pool.connection(), pool.connection()
+    first.close()
+    second.close()
+    time.sleep(0.1)
+    pool.evict_idle()
+    stats = pool.stats()
+    assert stats['evicted'] == 2
+    assert stats['size'] == 0 and stats['idle'] == 0
+
+
+def test_stale_connections_are_health_checked_before_reuse():
+    pool = sqlite_pool(health_check_after=0)
+    with pool.connection() as connection:
+        raw = connection.raw
+    with pool.connection() as connection:
+        assert connection.raw is raw
+    # A connection the server dropped fails the ping and is replaced
+    raw.close()
+    with pool.connection() as connection:
+        assert connection.raw is not raw
+        assert connection.execute("SELECT 1").fetchone() == (1,)
+    stats = pool.stats()
+    assert stats['failed_health_checks'] == 1
+    assert stats['created'] == 2
+    assert stats['size'] == 1
+
+
+def test_health_check_pings_pymysql_style_connections():
+    class Pingable:
+        def __init__(self, alive):
+            self.alive = alive
+
+        def ping(self, reconnect=True):
+            assert reconnect is False
+            if not self.alive:
+                raise pymysql.err.OperationalError(2006, "MySQL server has gone away")
+
+    assert db_pool.default_health_check(Pingable(True))
+    assert not db_pool.default_health_check(Pingable(False))
+
+
+@pytest.mark.parametrize('error', [
+    pymysql.err.OperationalError(2013, "Lost connection to MySQL server during query"),
+    pymysql.err.InterfaceError(0, ""),
+    KeyboardInterrupt(),
+])
+def test_connections_are_discarded_after_connection_errors(error):
+    pool = sqlite_pool()
+    with pytest.raises(type(error)):
+        with pool.connection() as connection:
+            raw = connection.raw
+            raise error
+    stats = pool.stats()
+    assert stats['size'] == 0 and stats['idle'] == 0
+    with pool.connection() as connection:
+        assert connection.raw is not raw
+
+
+def test_connections_are_kept_after_ordinary_errors_with_the_transaction_rolled_back():
+    pool = sqlite_pool()
+    with pytest.raises(ValueError):
+        with pool.connection() as connection:
+            raw = connection.raw
+            connection.execute("CREATE TABLE t (x INTEGER)")
+            connection.commit()
+            connection.execute("INSERT INTO t VALUES (1)")
+            raise ValueError("bad input")
+    with pool.connection() as connection:
+        assert connection.raw is raw
+        assert connection.execute("SELECT COUNT(*) FROM t").fetchone() == (0,)
+    assert pool.stats()['size'] == 1
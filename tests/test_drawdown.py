@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+import drawdown
+
+
+def test_drawdown_stats_finds_peak_trough_and_recovery():
+    values = np.array([[100.0], [120.0], [90.0], [60.0], [100.0], [130.0], [125.0]])
+    stats = drawdown.drawdown_stats(values)
+    assert stats['max_drawdown'][0] == pytest.approx(60.0 / 120.0 - 1.0)
+    assert stats['peak'][0] == 1
+    assert stats['trough'][0] == 3
+    assert stats['recovery'][0] == 5
+    assert stats['duration'][0] == 4
+    assert stats['underwater'][6, 0] == pytest.approx(125.0 / 130.0 - 1.0)
+
+
+def test_drawdown_stats_without_recovery_runs_to_the_last_date():
+    values = np.array([[100.0], [80.0], [90.0]])
+    stats = drawdown.drawdown_stats(values)
+    assert stats['recovery'][0] == -1
+    assert stats['duration'][0] == 2
+    assert stats['longest_underwater'][0] == 2
+
+
+def test_drawdown_stats_of_a_rising_series_is_zero():
+    stats = drawdown.drawdown_stats(np.array([[1.0, 5.0], [2.0, 5.0], [3.0, 6.0]]))
+    assert (stats['max_drawdown'] == 0).all()
+    assert (stats['duration'] == 0).all()
+    assert (stats['recovery'] == -1).all()
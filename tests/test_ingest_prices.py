@@ -0,0 +1,90 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+import ingest_prices
+from conftest import FakeConnection
+
+STOCKS = """Date,Symbol,Adj Close,Close,High,Low,Open,Volume
+2024-01-02,AAA,10.0,10.0,10.5,9.5,9.8,100
+2024-01-03,AAA,11.0,11.0,11.5,10.5,10.8,110
+2024-01-02,BBB,20.0,20.0,20.5,19.5,19.8,200
+2024-01-04,AAA,12.0,12.0,12.5,11.5,11.8,120
+2024-01-03,ZZZ,1.0,1.0,1.0,1.0,1.0,1
+2024-01-03,NEW,5.0,5.0,5.0,5.0,5.0,5
+"""
+INDEX = """Date,S&P500
+2024-01-02,4700.5
+2024-01-03,4710.0
+2024-01-04,4720.25
+"""
+
+
+class Database(FakeConnection):
+    def __init__(self, latest, index_latest):
+        super().__init__(self.answer)
+        self.latest = latest
+        self.index_latest = index_latest
+        self.rollbacks = 0
+
+    def answer(self, sql, params):
+        if 'GROUP BY c.symbol' in sql:
+            return [(symbol, date) for symbol, date in self.latest.items()]
+        if sql.strip() == "SELECT MAX(date) FROM sp500_index":
+            return [{'MAX(date)': self.index_latest}]
+        return []
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def statements(self, prefix):
+        return [params for sql, params in self.executed if sql.startswith(prefix)]
+
+
+@pytest.fixture
+def provider(tmp_path):
+    stocks, index = tmp_path / 'stocks.csv', tmp_path / 'index.csv'
+    stocks.write_text(STOCKS)
+    index.write_text(INDEX)
+    return ingest_prices.CsvPriceProvider(str(stocks), str(index), chunksize=2)
+
+
+def test_newer_than_keeps_new_bars_and_unseen_symbols():
+    bars = pd.DataFrame({'date': ['2024-01-02', '2024-01-03', '2024-01-02'], 'symbol': ['AAA', 'AAA', 'NEW']})
+    kept = ingest_prices.newer_than(bars, {'AAA': datetime.date(2024, 1, 2), 'NEW': None})
+    assert kept.to_dict('records') == [{'date': '2024-01-03', 'symbol': 'AAA'},
+                                       {'date': '2024-01-02', 'symbol': 'NEW'}]
+
+
+def test_ingest_appends_only_new_bars_for_known_symbols(provider):
+    connection = Database({'AAA': datetime.date(2024, 1, 2), 'BBB': datetime.date(2024, 1, 2), 'NEW': None},
+                          index_latest=datetime.date(2024, 1, 2))
+    summary = ingest_prices.ingest(provider, connection, batch_size=2)
+
+    stock_rows = [row for rows in connection.statements("INSERT INTO stock_prices") for row in rows]
+    assert sorted((row[0], row[1]) for row in stock_rows) == [
+        ('2024-01-03', 'AAA'), ('2024-01-03', 'NEW'), ('2024-01-04', 'AAA')]
+    # current_price follows the newest bar per symbol, even across chunks
+    (prices,) = connection.statements("UPDATE companies SET current_price")
+    assert sorted(prices, key=lambda p: p[1]) == [(12.0, 'AAA'), (5.0, 'NEW')]
+    index_rows = [row for rows in connection.statements("INSERT INTO sp500_index") for row in rows]
+    assert index_rows == [('2024-01-03', 4710.0), ('2024-01-04', 4720.25)]
+    assert summary['stock_rows'] == 3 and summary['index_rows'] == 2
+    assert summary['symbols'] == ['AAA', 'NEW']
+    # One commit for the full batch, then the final one
+    assert connection.commits == 2
+
+
+def test_ingest_rolls_back_on_errors(provider):
+    class Broken(Database):
+        def answer(self, sql, params):
+            if 'sp500_index' in sql:
+                raise RuntimeError("lost connection")
+            return super().answer(sql, params)
+
+    connection = Broken({'AAA': None}, index_latest=None)
+    with pytest.raises(RuntimeError):
+        ingest_prices.ingest(provider, connection)
+    assert connection.rollbacks == 1
+    assert connection.commits == 0
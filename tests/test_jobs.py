@@ -0,0 +1,107 @@
+import datetime
+
+import pymysql
+import pytest
+
+import jobs
+from conftest import FakeConnection
+
+
+@pytest.fixture
+def handlers(monkeypatch):
+    monkeypatch.setattr(jobs, 'HANDLERS', {})
+    return jobs.HANDLERS
+
+
+def job(job_id, account_id, kind='test', attempts=1, worker='w1'):
+    return {'job_id': job_id, 'kind': kind, 'account_id': account_id, 'options': {},
+            'attempts': attempts, 'worker': worker}
+
+
+def test_execute_maps_batch_results_to_jobs(handlers):
+    calls = []
+
+    @jobs.register('test')
+    def handler(account_ids, options):
+        calls.append(account_ids)
+        return {account_id: account_id * 10 for account_id in account_ids if account_id != 3}
+
+    outcomes = jobs.execute([job(1, 2), job(2, 1), job(3, 3)])
+    assert calls == [[1, 2, 3]]
+    assert outcomes == {1: (20, None, False), 2: (10, None, False), 3: (None, jobs.NO_RESULT, False)}
+
+
+def test_execute_reruns_a_failed_batch_one_job_at_a_time(handlers):
+    @jobs.register('test')
+    def handler(account_ids, options):
+        if 2 in account_ids:
+            raise ValueError("bad account")
+        if 3 in account_ids:
+            raise RuntimeError("db down")
+        return {account_id: 'ok' for account_id in account_ids}
+
+    outcomes = jobs.execute([job(1, 1), job(2, 2), job(3, 3)])
+    assert outcomes[1] == ('ok', None, False)
+    # ValueError fails the job for good, other errors are retryable
+    assert outcomes[2] == (None, "bad account", False)
+    assert outcomes[3] == (None, "db down", True)
+
+
+def test_execute_retries_the_whole_batch_on_connection_errors(handlers):
+    calls = []
+
+    @jobs.register('test')
+    def handler(account_ids, options):
+        calls.append(account_ids)
+        raise pymysql.err.OperationalError(1205, "Lock wait timeout exceeded")
+
+    outcomes = jobs.execute([job(1, 1), job(2, 2), job(3, 3)])
+    assert calls == [[1, 2, 3]]
+    assert outcomes == {job_id: (None, "(1205, 'Lock wait timeout exceeded')", True) for job_id in (1, 2, 3)}
+
+
+def test_execute_runs_an_all_accounts_job_with_none(handlers):
+    jobs.register('test')(lambda account_ids, options: {'accounts': account_ids})
+    assert jobs.execute([job(1, None)]) == {1: ({'accounts': None}, None, False)}
+
+
+def test_execute_fails_unknown_kinds(handlers):
+    assert jobs.execute([job(1, 1, kind='nope')]) == {1: (None, "Unknown job kind: nope", False)}
+
+
+def test_record_outcomes_stores_retries_and_fails_for_the_owning_worker():
+    connection = FakeConnection()
+    batch = [job(1, 1), job(2, 2, attempts=2), job(3, 3, attempts=jobs.MAX_ATTEMPTS), job(4, 4)]
+    jobs.record_outcomes(connection, batch, {
+        1: ({'var': 1.5}, None, False),
+        2: (None, "db down", True),
+        3: (None, "db down", True),
+        4: (None, "bad account", False),
+    })
+    statements = dict(connection.executed)
+    done = next(params for sql, params in statements.items() if "status = 'done'" in sql)
+    retry = next(params for sql, params in statements.items() if "status = 'queued'" in sql)
+    failed = next(params for sql, params in statements.items() if "status = 'failed'" in sql)
+    assert done == [('{"var": 1.5}', 1, 'w1')]
+    # Second attempt waits twice the base backoff
+    assert retry == [("db down", int(jobs.RETRY_BACKOFF * 2), 2, 'w1')]
+    # Out of attempts and non-retryable fail; a retry whose key was taken fails as superseded
+    assert failed[:2] == [("db down", 3, 'w1'), ("bad account", 4, 'w1')]
+    assert failed[2] == ("db down (superseded by a queued duplicate)", 2, 'w1')
+    for sql in statements:
+        assert "status = 'running' AND worker = %s" in sql
+    assert connection.commits == 1
+
+
+@pytest.mark.parametrize('now, expected', [
+    (datetime.datetime(2024, 5, 1, 1, 0), datetime.datetime(2024, 5, 1, 2, 0)),
+    (datetime.datetime(2024, 5, 1, 2, 0), datetime.datetime(2024, 5, 2, 2, 0)),
+    (datetime.datetime(2024, 5, 31, 23, 59), datetime.datetime(2024, 6, 1, 2, 0)),
+])
+def test_next_run(now, expected):
+    assert jobs.next_run('02:00', now) == expected
+
+
+def test_next_run_defaults_to_the_current_time():
+    run = jobs.next_run('00:00')
+    assert datetime.datetime.now() < run <= datetime.datetime.now() + datetime.timedelta(days=1)
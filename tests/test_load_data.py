@@ -0,0 +1,96 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import load_data
+from conftest import FakeConnection
+
+CSV = """Date,Symbol,Adj Close,Close,High,Low,Open,Volume
+2024-01-02,AAA,1.5,1.5,1.6,1.4,1.45,1000.0
+2024-01-02,BBB,2.5,2.5,2.6,2.4,2.45,
+2024-01-03,AAA,1.7,1.7,1.8,1.6,1.5,1200.4
+2024-01-03,BBB,,,,,,
+2024-01-04,AAA,1.9,1.9,2.0,1.8,1.7,999.6
+"""
+
+
+class LoaderConnection(FakeConnection):
+    """Fake loader connection whose ``fail_on_commit``-th commit raises."""
+
+    def __init__(self, fail_on_commit=None):
+        super().__init__()
+        self.fail_on_commit = fail_on_commit
+        self.rollbacks = 0
+        self.closed = False
+
+    def commit(self):
+        super().commit()
+        if self.commits == self.fail_on_commit:
+            raise RuntimeError("connection lost")
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+    def loaded_rows(self):
+        return [row for sql, rows in self.executed if sql.startswith("INSERT INTO stock_prices") for row in rows]
+
+
+@pytest.fixture
+def csv_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(load_data, 'CHECKPOINT_FILE', str(tmp_path / 'progress.json'))
+    path = tmp_path / 'prices.csv'
+    path.write_text(CSV)
+    return str(path)
+
+
+def test_prepare_chunk_renames_and_converts_values():
+    frame = pd.DataFrame({'Date': ['2024-01-02'], 'Symbol': ['AAA'], 'Close': [1.5], 'Volume': [1200.6],
+                          'Adj Close': [np.nan], 'Unknown': ['dropped']})
+    columns, rows = load_data.prepare_chunk(frame, 'stock_prices')
+    assert columns == ['date', 'symbol', 'adj_close', 'close', 'volume']
+    assert rows == [('2024-01-02', 'AAA', None, 1.5, 1201)]
+    assert type(rows[0][4]) is int
+
+
+def test_upsert_sql_updates_non_key_columns():
+    assert load_data.upsert_sql('sp500_index', ['date', 'sp500_value'], ('date',)) == (
+        "INSERT INTO sp500_index (date, sp500_value) VALUES (%s, %s) "
+        "ON DUPLICATE KEY UPDATE sp500_value = VALUES(sp500_value)")
+    assert load_data.upsert_sql('t', ['a'], ('a',)).endswith("ON DUPLICATE KEY UPDATE a = a")
+
+
+def test_failed_load_resumes_after_the_last_committed_chunk(csv_file):
+    failing = LoaderConnection(fail_on_commit=2)
+    with pytest.raises(RuntimeError):
+        load_data.load_csv_to_table(csv_file, 'stock_prices', chunksize=2, rebuild_indexes=False,
+                                    connection=failing)
+    assert failing.rollbacks == 1
+    with open(load_data.CHECKPOINT_FILE) as handle:
+        assert list(json.load(handle).values()) == [{'rows': 2, 'dropped_indexes': {}}]
+
+    resumed = LoaderConnection()
+    assert load_data.load_csv_to_table(csv_file, 'stock_prices', chunksize=2, rebuild_indexes=False,
+                                       connection=resumed) == 5
+    rows = resumed.loaded_rows()
+    assert [(row[0], row[1]) for row in rows] == [('2024-01-03', 'AAA'), ('2024-01-03', 'BBB'),
+                                                 ('2024-01-04', 'AAA')]
+    assert rows[1][2:] == (None, None, None, None, None, None)
+    assert rows[2][-1] == 1000
+    # A finished load clears its checkpoint, and the caller's connection stays open
+    assert load_data.read_checkpoint() == {}
+    assert not resumed.closed
+
+
+def test_restart_ignores_the_checkpoint(csv_file):
+    with pytest.raises(RuntimeError):
+        load_data.load_csv_to_table(csv_file, 'stock_prices', chunksize=2, rebuild_indexes=False,
+                                    connection=LoaderConnection(fail_on_commit=2))
+    again = LoaderConnection()
+    load_data.load_csv_to_table(csv_file, 'stock_prices', chunksize=2, rebuild_indexes=False, restart=True,
+                                connection=again)
+    assert len(again.loaded_rows()) == 5
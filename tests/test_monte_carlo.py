@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from werkzeug.datastructures import MultiDict
+
+import app
+import monte_carlo
+import risk_engine
+
+
+def price_history(days=60, symbols=('AAA', 'BBB', 'CCC')):
+    rng = np.random.default_rng(7)
+    returns = rng.normal(0.0005, 0.01, size=(days, len(symbols)))
+    prices = 100 * np.exp(np.cumsum(returns, axis=0))
+    dates = np.arange('2024-01-01', days, dtype='datetime64[D]')[:days]
+    return dates, list(symbols), prices
+
+
+HOLDINGS = {1: {'AAA': 10, 'BBB': 5}, 2: {'CCC': 20}}
+
+
+def run(**options):
+    dates, symbols, prices = price_history()
+    return monte_carlo.final_results(monte_carlo.simulate(
+        HOLDINGS, dates, symbols, prices, (0.95, 0.99), paths=2000, chunk_size=300, **options))
+
+
+def test_same_seed_gives_the_same_results_for_any_worker_count(monkeypatch):
+    monkeypatch.setattr(monte_carlo, 'MAX_WORKERS', 4)
+    try:
+        serial = run(seed=42, workers=1)
+        parallel = run(seed=42, workers=4)
+    finally:
+        if monte_carlo._pool is not None:
+            monte_carlo._discard_pool(monte_carlo._pool)
+    assert serial == parallel
+    assert run(seed=43, workers=1) != serial
+
+
+def test_tail_accumulator_matches_historical_var():
+    # 101 scenarios put the 95% quantile on a scenario, where both engines agree
+    pnl = np.arange(-50.0, 51.0)
+    rng = np.random.default_rng(0)
+    shuffled = rng.permutation(pnl)[:, None]
+    accumulator = monte_carlo.TailAccumulator(1, (0.95, 0.99), len(pnl))
+    accumulator.add(shuffled)
+    var, cvar = accumulator.estimates()
+    expected_var, expected_cvar = risk_engine.historical_var(shuffled, (0.95, 0.99))
+    np.testing.assert_allclose(var, expected_var)
+    np.testing.assert_allclose(cvar, expected_cvar)
+    assert var[0, 0] == 45.0
+    assert cvar[0, 0] == 47.5
+
+
+def test_tail_accumulator_across_chunks_matches_one_chunk():
+    pnl = np.random.default_rng(1).normal(size=(1000, 2))
+    whole = monte_carlo.TailAccumulator(2, (0.95, 0.99), 1000)
+    whole.add(pnl)
+    chunked = monte_carlo.TailAccumulator(2, (0.95, 0.99), 1000)
+    for chunk in np.array_split(pnl, 7):
+        chunked.add(chunk)
+    for got, expected in zip(chunked.estimates(), whole.estimates()):
+        np.testing.assert_array_equal(got, expected)
+
+
+@pytest.mark.parametrize('name, value', [
+    ('paths', app.MC_MAX_PATHS + 1),
+    ('chunk_size', app.MC_MAX_CHUNK_SIZE + 1),
+    ('workers', app.MC_MAX_WORKERS + 1),
+    ('paths', 0),
+    ('workers', 0),
+])
+def test_simulation_options_outside_the_bounds_are_rejected(name, value):
+    with pytest.raises(ValueError, match=name):
+        app.parse_simulation_options(MultiDict({name: str(value)}))
+
+
+def test_simulation_options_within_the_bounds_pass():
+    options = app.parse_simulation_options(MultiDict({'paths': '5000', 'chunk_size': '500', 'seed': '9'}))
+    assert options == {'paths': 5000, 'chunk_size': 500, 'seed': 9, 'shrinkage': None, 'workers': None}
+
+
+def test_var_route_answers_400_above_the_bounds():
+    response = app.app.test_client().post(f'/api/risk/var/1?method=monte_carlo&paths={app.MC_MAX_PATHS + 1}')
+    assert response.status_code == 400
+    assert response.get_json() == {'error': f"paths must be between 1 and {app.MC_MAX_PATHS}"}
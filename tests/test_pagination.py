@@ -0,0 +1,86 @@
+import json
+
+import pytest
+
+import db_pool
+import pagination
+
+SECURITIES = pagination.ListQuery("security", key="security_id",
+                                  columns={'security_id': 'security_id', 'ticker': 'ticker'},
+                                  default_fields=['security_id', 'ticker'])
+
+
+@pytest.mark.parametrize('key', ['AAPL', 42, ['2024-01-02', 'MSFT'], 'naïve/+='])
+def test_cursor_round_trips(key):
+    token = pagination.encode_cursor(key)
+    assert '=' not in token
+    assert pagination.decode_cursor(token) == key
+
+
+@pytest.mark.parametrize('token', ['!!!', 'bm90IGpzb24', ''])
+def test_decode_cursor_rejects_garbage(token):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        pagination.decode_cursor(token)
+
+
+class StreamingCursor:
+    """Server-side cursor stand-in; ``close`` drains the rows the client never read."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def execute(self, sql, params=()):
+        self.rows = [{'security_id': i, 'ticker': f'T{i}', '_cursor_key': i} for i in range(1, 6)]
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+    def close(self):
+        self.connection.drained += len(self.rows)
+        self.rows = []
+
+
+class StreamingConnection:
+    server_status = 0
+
+    def __init__(self):
+        self.drained = 0
+        self.closed = False
+
+    def cursor(self, *args):
+        return StreamingCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(pagination, 'STREAM_BATCH_SIZE', 2)
+    return db_pool.ConnectionPool(StreamingConnection, max_size=1)
+
+
+def test_stream_rows_returns_the_connection_when_finished(pool):
+    chunks = list(pagination.stream_rows(pool.connection, SECURITIES, SECURITIES.default_fields, json.dumps, 'json'))
+    assert json.loads(''.join(chunks)) == [{'security_id': i, 'ticker': f'T{i}'} for i in range(1, 6)]
+    stats = pool.stats()
+    assert stats['idle'] == 1 and stats['in_use'] == 0
+
+
+def test_abandoned_stream_discards_the_connection_without_draining(pool):
+    raw = []
+
+    def checkout():
+        connection = pool.connection()
+        raw.append(connection.raw)
+        return connection
+
+    stream = pagination.stream_rows(checkout, SECURITIES, SECURITIES.default_fields, json.dumps)
+    assert next(stream) == '{"security_id": 1, "ticker": "T1"}\n{"security_id": 2, "ticker": "T2"}\n'
+    stream.close()
+    assert raw[0].closed
+    assert raw[0].drained == 0
+    stats = pool.stats()
+    assert stats['size'] == 0 and stats['in_use'] == 0
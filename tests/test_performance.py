@@ -0,0 +1,106 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import performance
+import risk_engine
+from conftest import FakeConnection
+
+
+class Market:
+    """stock_prices and sp500_index stand-ins for ReturnsCache.refresh."""
+
+    def __init__(self):
+        self.prices = {}
+        self.index = {}
+        self.loads = []
+
+    def load_price_matrix(self, connection, symbols=None, start=None, end=None, field='adj_close'):
+        self.loads.append(start)
+        rows = [(d, s, p) for (d, s), p in self.prices.items() if start is None or d >= np.datetime64(start)]
+        frame = pd.DataFrame(rows, columns=['date', 'symbol', 'price'])
+        wide = frame.pivot(index='date', columns='symbol', values='price').sort_index().ffill()
+        return wide.index.to_numpy().astype('datetime64[D]'), list(wide.columns), wide.to_numpy(dtype=float)
+
+    def respond(self, sql, params):
+        start, end = (np.datetime64(p) for p in params)
+        return [(datetime.date.fromisoformat(str(d)), v) for d, v in sorted(self.index.items()) if start <= d <= end]
+
+
+def day(n):
+    return np.datetime64('2024-01-01') + np.timedelta64(n, 'D')
+
+
+@pytest.fixture
+def market(monkeypatch):
+    market = Market()
+    for n in range(20):
+        market.prices[(day(n), 'AAA')] = 100.0 * 1.01 ** n
+        market.prices[(day(n), 'BBB')] = 50.0 - n * 0.5
+        market.index[day(n)] = 4000.0 + 10 * n
+    monkeypatch.setattr(risk_engine, 'load_price_matrix', market.load_price_matrix)
+    return market
+
+
+def refreshed(market):
+    cache = performance.ReturnsCache()
+    cache.refresh(FakeConnection(market.respond), force=True)
+    return cache
+
+
+def assert_same(snapshot, expected):
+    assert list(snapshot.dates) == list(expected.dates)
+    assert snapshot.symbols == expected.symbols
+    for name in ('prices', 'returns', 'index_levels', 'index_returns'):
+        np.testing.assert_allclose(getattr(snapshot, name), getattr(expected, name), err_msg=name)
+
+
+def test_incremental_refresh_matches_a_full_load(market):
+    cache = refreshed(market)
+    assert cache.snapshot.returns.shape == (20, 2)
+    # New days, a late bar inside the overlap, and a corrected bar
+    for n in range(20, 25):
+        market.prices[(day(n), 'AAA')] = 100.0 * 1.01 ** n
+        market.index[day(n)] = 4000.0 + 10 * n
+    for n in range(20, 24):
+        market.prices[(day(n), 'BBB')] = 40.0
+    market.prices[(day(17), 'AAA')] = 90.0
+    market.prices[(day(24), 'CCC')] = 7.0
+
+    assert cache.refresh(FakeConnection(market.respond), force=True)
+    assert market.loads[-1] == str(day(19 - performance.REFRESH_OVERLAP_DAYS))
+    assert_same(cache.snapshot, refreshed(market).snapshot)
+    assert cache.snapshot.symbols == ('AAA', 'BBB', 'CCC')
+
+
+def test_refresh_swaps_in_a_new_read_only_snapshot(market):
+    cache = refreshed(market)
+    before = cache.snapshot
+    prices = before.prices.copy()
+    market.prices[(day(20), 'AAA')] = 200.0
+    cache.refresh(FakeConnection(market.respond), force=True)
+    assert cache.snapshot is not before
+    assert len(before.dates) == 20
+    np.testing.assert_array_equal(before.prices, prices)
+    with pytest.raises(ValueError):
+        cache.snapshot.returns[0, 0] = 1.0
+
+
+def test_refresh_is_throttled(market):
+    cache = performance.ReturnsCache(max_age=3600)
+    connection = FakeConnection(market.respond)
+    assert cache.refresh(connection)
+    assert not cache.refresh(connection)
+    assert len(market.loads) == 1
+
+
+def test_weights_value_each_account_at_the_last_prices(market):
+    snapshot = refreshed(market).snapshot
+    account_ids, weights, unpriced = snapshot.weights({1: {'AAA': 1, 'BBB': 1}, 2: {'BBB': 2, 'ZZZ': 1}})
+    assert account_ids == [1, 2]
+    last = snapshot.last_prices
+    np.testing.assert_allclose(weights[:, 0], last / last.sum())
+    np.testing.assert_allclose(weights[:, 1], [0.0, 1.0])
+    assert unpriced == {2: ['ZZZ']}
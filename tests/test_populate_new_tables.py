@@ -0,0 +1,75 @@
+import math
+
+import numpy as np
+import pytest
+
+import load_data
+import populate_new_tables as populate
+
+OPTIONS = dict(users=2, accounts=3, holdings=10, snapshots=5, companies=0, years=0,
+               snapshot_interval=24.0, workers=2, chunksize=100)
+
+
+def test_generator_streams_depend_only_on_seed_table_and_chunk():
+    a, b = populate.Generator(7), populate.Generator(7)
+
+    assert np.array_equal(a.rng('portfolio_holding', 3).random(5), b.rng('portfolio_holding', 3).random(5))
+    # Drawing from one stream doesn't shift another
+    a.rng('risk_metric').random(100)
+    assert np.array_equal(a.rng('price_snapshot', 1).random(5), b.rng('price_snapshot', 1).random(5))
+    assert not np.array_equal(a.rng('price_snapshot', 0).random(5), a.rng('price_snapshot', 1).random(5))
+    assert not np.array_equal(a.rng('price_snapshot').random(5), populate.Generator(8).rng('price_snapshot').random(5))
+
+
+def test_gbm_paths_shape_and_statistics():
+    start = np.array([100.0, 50.0])
+    mu, sigma = np.array([0.1, 0.0]), np.array([0.2, 0.4])
+    dt = 1 / populate.TRADING_DAYS
+
+    paths = populate.gbm_paths(np.random.default_rng(0), start, mu, sigma, 20000, dt)
+
+    assert paths.shape == (2, 20000)
+    assert (paths > 0).all()
+    log_returns = np.diff(np.log(np.hstack([start[:, None], paths])), axis=1)
+    assert np.allclose(log_returns.std(axis=1) / math.sqrt(dt), sigma, rtol=0.02)
+    assert np.allclose(log_returns.mean(axis=1), (mu - sigma ** 2 / 2) * dt, atol=4 * sigma * math.sqrt(dt / 20000))
+
+
+def test_gbm_paths_without_volatility_grow_at_the_drift():
+    paths = populate.gbm_paths(np.random.default_rng(0), np.array([100.0]), np.array([0.05]), np.array([0.0]), 4, 0.5)
+
+    assert np.allclose(paths[0], 100 * np.exp(0.05 * 0.5 * np.arange(1, 5)))
+
+
+@pytest.mark.parametrize('changes, message', [
+    ({'users': 0}, "accounts need at least one user"),
+    ({'accounts': 0}, "holdings need at least one account"),
+    ({'years': 2}, "years needs companies"),
+    ({'holdings': -1}, "holdings must not be negative"),
+    ({'chunksize': 0}, "chunksize must be positive"),
+    ({'snapshot_interval': 0}, "snapshot_interval must be positive"),
+])
+def test_inconsistent_options_fail_before_touching_the_database(monkeypatch, changes, message):
+    def get_connection():
+        raise AssertionError("connected")
+    monkeypatch.setattr(load_data, 'get_connection', get_connection)
+
+    with pytest.raises(ValueError, match=message):
+        populate.populate_data(**dict(OPTIONS, **changes))
+
+
+def test_main_reports_inconsistent_options(monkeypatch, capsys):
+    monkeypatch.setattr('sys.argv', ['populate_new_tables.py', '--users', '0', '--accounts', '5'])
+    monkeypatch.setattr(populate, 'populate_data', lambda **options: pytest.fail("populated"))
+
+    with pytest.raises(SystemExit) as exit_info:
+        populate.main()
+
+    assert exit_info.value.code == 2
+    assert "accounts need at least one user" in capsys.readouterr().err
+
+
+def test_consistent_options_pass():
+    populate.check_options(**OPTIONS)
+    populate.check_options(**dict(OPTIONS, users=0, accounts=0, holdings=0))
+    populate.check_options(**dict(OPTIONS, companies=5, years=2))
@@ -0,0 +1,64 @@
+import datetime
+
+import pytest
+
+import price_index
+from conftest import FakeConnection
+
+
+def snapshot_db(rows, tz='+00:00'):
+    """A connection serving ``rows`` of (snapshot_id, security_id, price, snapshot_ts)."""
+    def respond(sql, params):
+        if '@@session.time_zone' in sql:
+            return [{'tz': tz, 'system_tz': 'UTC', 'offset': 0}]
+        return [dict(zip(('snapshot_id', 'security_id', 'price', 'snapshot_ts'), row))
+                for row in sorted(rows) if row[0] > params[0]]
+    return FakeConnection(respond)
+
+
+def test_as_of_returns_the_last_snapshot_at_or_before_the_time():
+    index = price_index.PriceIndex()
+    index.refresh(snapshot_db([
+        (1, 7, 10.0, datetime.datetime(2024, 1, 2, 10)),
+        (2, 7, 11.0, datetime.datetime(2024, 1, 2, 12)),
+        (3, 8, 50.0, datetime.datetime(2024, 1, 2, 9)),
+    ]))
+    assert index.as_of(7, '2024-01-02T11:00:00') == (10.0, '2024-01-02T10:00:00')
+    assert index.as_of(7, '2024-01-02T12:00:00') == (11.0, '2024-01-02T12:00:00')
+    assert index.as_of(7) == (11.0, '2024-01-02T12:00:00')
+    assert index.as_of(7, '2024-01-01') is None
+    assert index.as_of(99) is None
+
+
+def test_later_insert_wins_on_equal_timestamps():
+    ts = datetime.datetime(2024, 1, 2, 16)
+    index = price_index.PriceIndex()
+    index.refresh(snapshot_db([(1, 7, 10.0, ts), (2, 7, 12.0, ts)]))
+    assert index.as_of(7, ts.isoformat())[0] == 12.0
+
+
+def test_refresh_picks_up_rows_committed_out_of_id_order():
+    rows = [(10, 7, 10.0, datetime.datetime(2024, 1, 2, 10))]
+    connection = snapshot_db(rows)
+    index = price_index.PriceIndex()
+    index.refresh(connection)
+    # id 5 was allocated before id 10 but committed after the first refresh
+    rows.append((5, 7, 9.0, datetime.datetime(2024, 1, 2, 11)))
+    assert index.refresh(connection, force=True)
+    assert index.as_of(7, '2024-01-02T11:30:00')[0] == 9.0
+    # Re-reading the overlap does not merge a snapshot twice
+    assert not index.refresh(connection, force=True)
+    assert len(index._series[7][0]) == 2
+
+
+def test_aware_as_of_is_converted_to_the_session_time_zone():
+    index = price_index.PriceIndex()
+    index.refresh(snapshot_db([(1, 7, 10.0, datetime.datetime(2024, 1, 2, 10))], tz='+02:00'))
+    assert index.as_of(7, '2024-01-02T08:30:00Z')[0] == 10.0
+    assert index.as_of(7, '2024-01-02T07:30:00Z') is None
+    assert index.as_of(7, '2024-01-02T10:00:00') == (10.0, '2024-01-02T10:00:00')
+
+
+def test_parse_timestamp_rejects_garbage():
+    with pytest.raises(ValueError):
+        price_index.parse_timestamp('not a date')
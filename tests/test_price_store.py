@@ -0,0 +1,110 @@
+import datetime
+
+import numpy as np
+import pytest
+
+import price_store
+from conftest import FakeConnection
+
+
+class PriceTable:
+    """stock_prices rows keyed by (date, symbol), answering the store's range query."""
+
+    def __init__(self):
+        self.bars = {}
+
+    def put(self, day, symbol, price):
+        self.bars[(datetime.date(2024, 1, day), symbol)] = price
+
+    def respond(self, sql, params):
+        after = datetime.date.fromisoformat(params[0]) if params else None
+        return [(date, symbol) + (price,) * len(price_store.FIELDS)
+                for (date, symbol), price in sorted(self.bars.items())
+                if after is None or date > after]
+
+
+@pytest.fixture
+def table():
+    table = PriceTable()
+    for day in (2, 3, 4):
+        table.put(day, 'AAA', 10.0 + day)
+        table.put(day, 'BBB', 20.0 + day)
+    return table
+
+
+@pytest.fixture
+def store(tmp_path, table, monkeypatch):
+    monkeypatch.setattr(price_store, 'SYNC_BATCH_SIZE', 4)
+    store = price_store.PriceStore(str(tmp_path / 'store'))
+    store.sync(FakeConnection(table.respond), force=True)
+    return store
+
+
+def days(*values):
+    return [np.datetime64(f'2024-01-{day:02d}') for day in values]
+
+
+def test_initial_sync_builds_the_matrix(store):
+    assert list(store.dates) == days(2, 3, 4)
+    assert store.symbols == ('AAA', 'BBB')
+    np.testing.assert_array_equal(store.field()[:, 0], [12.0, 13.0, 14.0])
+    dates, prices = store.column('BBB', start='2024-01-03')
+    assert list(dates) == days(3, 4)
+    np.testing.assert_array_equal(prices, [23.0, 24.0])
+
+
+def test_sync_appends_new_dates(store, table):
+    table.put(5, 'AAA', 15.0)
+    table.put(8, 'BBB', 28.0)
+    summary = store.sync(FakeConnection(table.respond), force=True)
+    assert summary == {'dates': 2, 'rows': 2, 'new_symbols': 0, 'patched': 0}
+    assert list(store.dates) == days(2, 3, 4, 5, 8)
+    np.testing.assert_array_equal(store.field()[3:], [[15.0, np.nan], [np.nan, 28.0]])
+
+
+def test_sync_patches_changed_bars_in_the_overlap(store, table):
+    table.put(3, 'AAA', 99.0)
+    summary = store.sync(FakeConnection(table.respond), force=True)
+    assert summary['patched'] == 1
+    assert summary['dates'] == 0
+    assert store.field()[1, 0] == 99.0
+    assert store.field()[1, 1] == 23.0
+
+
+def test_sync_widens_for_new_symbols(store, table):
+    table.put(4, 'CCC', 30.0)
+    table.put(5, 'CCC', 31.0)
+    summary = store.sync(FakeConnection(table.respond), force=True)
+    assert summary['new_symbols'] == 1
+    assert store.symbols == ('AAA', 'BBB', 'CCC')
+    np.testing.assert_array_equal(store.field()[:, 2], [np.nan, np.nan, 30.0, 31.0])
+    np.testing.assert_array_equal(store.field()[:3, 0], [12.0, 13.0, 14.0])
+
+
+def test_reopen_sees_the_synced_files(store, table):
+    table.put(5, 'DDD', 40.0)
+    store.sync(FakeConnection(table.respond), force=True)
+    reopened = price_store.PriceStore(store.path)
+    assert list(reopened.dates) == list(store.dates)
+    assert reopened.symbols == store.symbols
+    np.testing.assert_array_equal(reopened.field(), store.field())
+
+
+def test_captured_view_is_unchanged_by_sync(store, table):
+    view = store.view
+    table.put(5, 'CCC', 31.0)
+    store.sync(FakeConnection(table.respond), force=True)
+    assert store.view is not view
+    assert len(view.dates) == 3
+    assert view.symbols == ('AAA', 'BBB')
+    assert view.fields['adj_close'].shape == (3, 2)
+    dates, symbols, prices = view.load_price_matrix(['AAA', 'CCC'])
+    assert symbols == ['AAA']
+    np.testing.assert_array_equal(prices[:, 0], [12.0, 13.0, 14.0])
+
+
+def test_sync_is_throttled(store, table):
+    table.put(5, 'AAA', 15.0)
+    store.max_age = 3600
+    assert store.sync(FakeConnection(table.respond)) is None
+    assert len(store.dates) == 3
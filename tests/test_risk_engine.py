@@ -0,0 +1,42 @@
+from statistics import NormalDist
+
+import numpy as np
+import pytest
+
+import risk_engine
+
+
+def test_historical_var_uses_the_loss_quantile_and_tail_mean():
+    pnl = np.arange(-50.0, 50.0).reshape(-1, 1)  # -50 .. 49, one portfolio
+    var, cvar = risk_engine.historical_var(pnl, (0.95, 0.99))
+    assert var[0, 0] == pytest.approx(-np.quantile(pnl, 0.05))
+    assert var[1, 0] == pytest.approx(-np.quantile(pnl, 0.01))
+    # CVaR averages the worst ceil(5% of 100) = 5 outcomes
+    assert cvar[0, 0] == pytest.approx(48.0)
+    assert cvar[1, 0] == pytest.approx(50.0)
+
+
+def test_historical_var_is_per_column_and_cvar_is_at_least_var():
+    rng = np.random.default_rng(0)
+    pnl = rng.normal(0, [1.0, 10.0], size=(5000, 2))
+    var, cvar = risk_engine.historical_var(pnl, (0.95,))
+    assert var.shape == cvar.shape == (1, 2)
+    assert var[0, 1] > 5 * var[0, 0]
+    assert (cvar >= var).all()
+
+
+def test_parametric_var_matches_the_normal_closed_form():
+    rng = np.random.default_rng(1)
+    pnl = rng.normal(2.0, 100.0, size=(1000, 1))
+    var, cvar = risk_engine.parametric_var(pnl, (0.99,), horizon=4)
+    mu, sigma = pnl.mean() * 4, pnl.std(ddof=1) * 2
+    z = NormalDist().inv_cdf(0.01)
+    assert var[0, 0] == pytest.approx(-(mu + z * sigma))
+    assert cvar[0, 0] == pytest.approx(-(mu - sigma * NormalDist().pdf(z) / 0.01))
+    assert cvar[0, 0] > var[0, 0] > 0
+
+
+def test_parametric_var_of_a_flat_portfolio_is_zero():
+    var, cvar = risk_engine.parametric_var(np.zeros((10, 1)), (0.95,))
+    assert var[0, 0] == pytest.approx(0.0)
+    assert cvar[0, 0] == pytest.approx(0.0)
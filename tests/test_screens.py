@@ -0,0 +1,132 @@
+import datetime
+
+import pytest
+
+import screens
+from conftest import FakeConnection
+
+
+def test_rolling_window_tracks_low_high_and_average():
+    window = screens.RollingWindow(days=2)
+    for day, close in enumerate([10.0, 8.0, 12.0, 11.0], start=1):
+        assert window.push(day, close, close, close)
+    # Days 2-4 are within two days of day 4
+    assert (window.low, window.high, window.average) == (8.0, 12.0, pytest.approx(31.0 / 3))
+    assert not window.push(4, 1.0, 1.0, 1.0)
+    window.push(5, 13.0, 13.0, 13.0)
+    assert window.low == 11.0
+
+
+def test_rolling_window_revise_rebuilds_on_corrections():
+    window = screens.RollingWindow(days=10)
+    for day, close in [(1, 10.0), (2, 8.0), (3, 12.0)]:
+        window.push(day, close, close, close)
+    assert not window.revise([(2, 8.0, 8.0, 8.0), (3, 12.0, 12.0, 12.0)])
+    assert window.revise([(2, 9.0, 9.0, 9.0)])
+    assert (window.low, window.average, window.last_day) == (9.0, pytest.approx(31.0 / 3), 3)
+    # A bar for a day that was missing is spliced in
+    assert window.revise([(0, 5.0, 5.0, 5.0)])
+    assert window.low == 5.0 and window.last_close == 12.0
+
+
+class Market:
+    """Answers the screen engine's queries from in-memory tables."""
+
+    def __init__(self):
+        self.companies = {
+            'AAA': {'symbol': 'AAA', 'long_name': 'Aaa Inc', 'sector': 'Technology', 'industry': 'Software',
+                    'market_cap': 300, 'current_price': 15.0, 'ebitda': 100, 'revenue_growth': 0.1},
+            'BBB': {'symbol': 'BBB', 'long_name': 'Bbb Inc', 'sector': 'Technology', 'industry': 'Software',
+                    'market_cap': 100, 'current_price': 20.0, 'ebitda': 10, 'revenue_growth': 0.2},
+        }
+        self.prices = {}
+        self.index = {}
+
+    def bar(self, day, symbol, close, low=None):
+        self.prices[(datetime.date(2024, 1, day), symbol)] = (low or close, close, close)
+
+    def respond(self, sql, params):
+        sql = ' '.join(sql.split())
+        if sql == "SELECT symbol FROM companies":
+            return [{'symbol': s} for s in self.companies]
+        if sql.startswith("SELECT symbol, long_name"):
+            symbols = params or list(self.companies)
+            return [dict(self.companies[s]) for s in symbols if s in self.companies]
+        if sql == "SELECT MAX(date) FROM stock_prices":
+            return [{'MAX(date)': max(d for d, _ in self.prices)}]
+        if sql == "SELECT MAX(date) FROM sp500_index":
+            return [{'MAX(date)': max(self.index, default=None)}]
+        if sql.startswith("SELECT symbol, date, low, high, close"):
+            start = datetime.date.fromisoformat(params[0])
+            return [{'symbol': s, 'date': d, 'low': low, 'high': high, 'close': close}
+                    for (d, s), (low, high, close) in sorted(self.prices.items()) if d >= start]
+        if sql.startswith("SELECT date, sp500_value"):
+            start = datetime.date.fromisoformat(params[0])
+            return [{'date': d, 'sp500_value': v} for d, v in sorted(self.index.items()) if d >= start]
+        raise AssertionError(sql)
+
+
+@pytest.fixture
+def market():
+    market = Market()
+    for day in range(1, 6):
+        market.bar(day, 'AAA', 10.0 + day)
+        market.bar(day, 'BBB', 20.0)
+        market.index[datetime.date(2024, 1, day)] = 4000.0 + day
+    return market
+
+
+def refresh(engine, market):
+    connection = FakeConnection(market.respond)
+    assert engine.refresh(connection, force=True)
+    return [(sql, params) for sql, params in connection.executed if sql.startswith("SELECT symbol, long_name")]
+
+
+def test_refresh_corrects_bars_in_the_overlap(market):
+    engine = screens.ScreenEngine()
+    refresh(engine, market)
+    assert engine.windows['AAA'].low == 11.0
+    market.bar(2, 'AAA', 12.0, low=6.0)
+    market.index[datetime.date(2024, 1, 3)] = 3000.0
+    refresh(engine, market)
+    assert engine.windows['AAA'].low == 6.0
+    assert engine.index_window.low == 3000.0
+
+
+def test_refresh_rereads_only_changed_companies(market):
+    engine = screens.ScreenEngine()
+    assert len(refresh(engine, market)) == 1
+    assert refresh(engine, market) == []
+
+    market.bar(6, 'AAA', 17.0)
+    market.companies['AAA']['current_price'] = 17.0
+    market.companies['BBB']['long_name'] = 'Renamed outside the API'
+    market.companies['CCC'] = dict(market.companies['BBB'], symbol='CCC', industry='Hardware')
+    reads = refresh(engine, market)
+    assert [params for _, params in reads] == [['AAA', 'CCC']]
+    assert engine.companies['AAA']['current_price'] == 17.0
+    assert engine.companies['BBB']['long_name'] == 'Bbb Inc'
+    assert engine.industry_average('Hardware') == 100
+
+    del market.companies['CCC']
+    refresh(engine, market)
+    assert 'CCC' not in engine.companies
+    assert engine.industry_average('Hardware') is None
+
+
+def test_refresh_rereads_every_company_after_the_reload_interval(market):
+    engine = screens.ScreenEngine(company_reload=0)
+    refresh(engine, market)
+    market.companies['BBB']['long_name'] = 'Renamed outside the API'
+    reads = refresh(engine, market)
+    assert reads[0][1] == ()
+    assert engine.companies['BBB']['long_name'] == 'Renamed outside the API'
+
+
+def test_screens_run_over_the_refreshed_aggregates(market):
+    engine = screens.ScreenEngine()
+    refresh(engine, market)
+    assert [row['symbol'] for row in engine.run('tech-leaders', {})] == ['AAA']
+    momentum = engine.run('high-momentum', {'min_ratio': '1.3'})
+    assert [(row['symbol'], row['low_52_week']) for row in momentum] == [('AAA', 11.0)]
+    assert engine.run('sp500-vs-52w', {})['current_sp500'] == 4005.0
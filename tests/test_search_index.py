@@ -0,0 +1,88 @@
+import pytest
+
+import search_index
+
+COMPANIES = [
+    {'symbol': 'MSFT', 'short_name': 'Microsoft Corporation', 'long_name': 'Microsoft Corporation',
+     'sector': 'Technology', 'industry': 'Software - Infrastructure',
+     'long_business_summary': 'Develops software, cloud services and devices.', 'current_price': 410.0},
+    {'symbol': 'MU', 'short_name': 'Micron Technology', 'long_name': 'Micron Technology, Inc.',
+     'sector': 'Technology', 'industry': 'Semiconductors',
+     'long_business_summary': 'Memory and storage products built on microchip fabrication.'},
+    {'symbol': 'AAPL', 'short_name': 'Apple Inc.', 'long_name': 'Apple Inc.',
+     'sector': 'Technology', 'industry': 'Consumer Electronics',
+     'long_business_summary': 'Designs smartphones, computers and software such as the Microsoft-compatible iWork suite.'},
+    {'symbol': 'JNJ', 'short_name': 'Johnson & Johnson', 'long_name': 'Johnson & Johnson',
+     'sector': 'Healthcare', 'industry': 'Drug Manufacturers', 'long_business_summary': 'Pharmaceuticals.'},
+]
+
+
+@pytest.fixture
+def index():
+    index = search_index.CompanySearchIndex()
+    index.build(COMPANIES)
+    return index
+
+
+def symbols(ranked):
+    return [symbol for symbol, _ in ranked]
+
+
+def test_name_matches_outrank_summary_mentions(index):
+    assert symbols(index.rank('microsoft')) == ['MSFT', 'AAPL']
+
+
+def test_symbol_query_ranks_that_company_first(index):
+    assert symbols(index.rank('mu'))[0] == 'MU'
+
+
+def test_every_term_must_match(index):
+    assert symbols(index.rank('technology software')) == ['MSFT', 'AAPL']
+    assert index.rank('healthcare software') == []
+
+
+def test_last_term_matches_as_a_prefix(index):
+    assert set(symbols(index.rank('micro'))) == {'MSFT', 'MU', 'AAPL'}
+    assert index.rank('micro', prefix=False) == []
+    # Earlier terms must match whole tokens
+    assert index.rank('micro technology') == []
+
+
+def test_exact_match_outranks_prefix_completion(index):
+    index.add({'symbol': 'SOFT', 'short_name': 'Soft Goods', 'sector': 'Consumer'})
+    assert symbols(index.rank('soft'))[0] == 'SOFT'
+
+
+def test_prefix_expansion_keeps_the_most_common_tokens(index, monkeypatch):
+    monkeypatch.setattr(search_index, 'MAX_PREFIX_EXPANSIONS', 1)
+    # 'microchip' sorts first but only MU mentions it; 'microsoft' is in two documents
+    assert index._expand('micro') == ['microsoft']
+    assert symbols(index.rank('micro')) == ['MSFT', 'AAPL']
+
+
+def test_empty_query_lists_companies_in_symbol_order(index):
+    assert index.rank('', limit=3) == [('AAPL', 0.0), ('JNJ', 0.0), ('MSFT', 0.0)]
+
+
+def test_add_replace_and_remove_refresh_the_index(index):
+    index.add({'symbol': 'NVDA', 'short_name': 'NVIDIA Corporation', 'sector': 'Technology'})
+    assert symbols(index.rank('nvidia')) == ['NVDA']
+    index.add({'symbol': 'NVDA', 'short_name': 'Nvidia Corp', 'sector': 'Technology'})
+    assert 'NVDA' not in symbols(index.rank('corporation', prefix=False))
+    index.remove('NVDA')
+    assert index.rank('nvidia') == []
+    assert len(index) == len(COMPANIES)
+    # Tokens only NVDA had are gone from prefix expansion too
+    assert index._expand('nvi') == []
+
+
+def test_volatile_fields_come_from_live_rows(index):
+    ranked = index.rank('microsoft', limit=1)
+    fields = ('symbol', 'current_price')
+    sql, params = search_index.live_query(ranked, fields)
+    assert sql == "SELECT symbol, current_price FROM companies WHERE symbol IN (%s)"
+    assert params == ['MSFT']
+    assert index.project(ranked, fields) == [{'symbol': 'MSFT', 'current_price': None, 'score': round(ranked[0][1], 4)}]
+    live = {'MSFT': {'symbol': 'MSFT', 'current_price': 415.5}}
+    assert index.project(ranked, fields, live)[0]['current_price'] == 415.5
+    assert search_index.live_query(ranked, ('symbol', 'long_name')) is None
@@ -0,0 +1,110 @@
+from decimal import Decimal
+
+import pymysql
+import pytest
+
+import transfers
+from conftest import FakeConnection
+
+
+class Holdings(FakeConnection):
+    """portfolio_holding rows keyed by holding_id, with begin/rollback counted."""
+
+    def __init__(self, holdings, accounts=(1, 2, 3), securities=(10, 20), failures=()):
+        super().__init__(self.answer)
+        self.holdings = holdings
+        self.accounts = set(accounts)
+        self.securities = set(securities)
+        self.failures = list(failures)
+        self.begins = 0
+        self.rollbacks = 0
+
+    def begin(self):
+        self.begins += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def answer(self, sql, params):
+        if sql.startswith("SELECT account_id FROM broker_account"):
+            return [(a,) for a in params if a in self.accounts]
+        if sql.startswith("SELECT security_id FROM security"):
+            return [(s,) for s in params if s in self.securities]
+        if "FOR UPDATE" in sql:
+            if self.failures:
+                raise self.failures.pop(0)
+            wanted = set(zip(params[::2], params[1::2]))
+            return sorted(((h, a, s, q) for h, (a, s, q) in self.holdings.items() if (a, s) in wanted),
+                          key=lambda row: (row[1], row[2], row[0]))
+        return []
+
+    def writes(self):
+        return [(sql.split()[0], params) for sql, params in self.executed if sql.startswith(('UPDATE', 'INSERT'))]
+
+
+def transfer(source, target, security, quantity):
+    return {'from_account': source, 'to_account': target, 'security_id': security, 'quantity': quantity}
+
+
+def test_positions_are_locked_in_key_order():
+    connection = Holdings({1: (2, 10, 5), 2: (1, 20, 5)})
+    transfers.apply_transfers(connection, [transfer(2, 1, 10, 1), transfer(1, 3, 20, 1)])
+    (lock_params,) = [params for sql, params in connection.executed if 'FOR UPDATE' in sql]
+    assert lock_params == [1, 10, 1, 20, 2, 10, 3, 20]
+
+
+def test_legs_beyond_the_held_quantity_are_rejected():
+    connection = Holdings({1: (1, 10, Decimal('10'))})
+    results, summary = transfers.apply_transfers(connection, [transfer(1, 2, 10, 6), transfer(1, 3, 10, 6)])
+    assert results[0] == {'index': 0, 'status': 'applied'}
+    assert results[1]['status'] == 'rejected'
+    assert results[1]['error'] == "Insufficient quantity to transfer: account 1 holds 4 of security 10"
+    assert summary == {'applied': 1, 'rejected': 1, 'invalid': 0, 'attempts': 1, 'accounts': [1, 2]}
+    assert connection.writes() == [
+        ('UPDATE', [1, Decimal('4'), 1]),
+        ('INSERT', [2, 10, Decimal('6')]),
+    ]
+    assert connection.commits == 1
+
+
+def test_atomic_batches_apply_nothing_when_a_leg_fails():
+    connection = Holdings({1: (1, 10, 10)})
+    legs = [transfer(1, 2, 10, 6), transfer(1, 3, 10, 6), {'account_id': 9, 'security_id': 10, 'quantity': 1}]
+    results, summary = transfers.apply_transfers(connection, legs, atomic=True)
+    assert [r['status'] for r in results] == ['rejected', 'rejected', 'invalid']
+    assert results[0]['error'] == "Batch rolled back: another leg failed"
+    assert results[2]['error'] == "Account not found: 9"
+    assert summary['applied'] == 0 and summary['accounts'] == []
+    assert connection.writes() == []
+
+
+def test_invalid_legs_do_not_block_the_rest_outside_atomic_mode():
+    connection = Holdings({1: (1, 10, 10)})
+    results, summary = transfers.apply_transfers(connection, [transfer(1, 1, 10, 1), transfer(1, 2, 10, 1)])
+    assert results[0] == {'index': 0, 'status': 'invalid', 'error': "from_account and to_account must differ"}
+    assert results[1]['status'] == 'applied'
+    assert summary['invalid'] == 1 and summary['applied'] == 1
+
+
+@pytest.mark.parametrize('code', [1213, 1205])
+def test_deadlocks_and_lock_timeouts_retry_the_batch(code, monkeypatch):
+    monkeypatch.setattr(transfers.time, 'sleep', lambda seconds: None)
+    connection = Holdings({1: (1, 10, 10)}, failures=[pymysql.err.OperationalError(code, "retry me")])
+    results, summary = transfers.apply_transfers(connection, [transfer(1, 2, 10, 4)])
+    assert results[0]['status'] == 'applied'
+    assert summary['attempts'] == 2
+    assert (connection.begins, connection.rollbacks, connection.commits) == (2, 1, 1)
+
+
+def test_other_errors_and_exhausted_retries_are_raised(monkeypatch):
+    monkeypatch.setattr(transfers.time, 'sleep', lambda seconds: None)
+    lost = Holdings({1: (1, 10, 10)}, failures=[pymysql.err.OperationalError(2013, "Lost connection")])
+    with pytest.raises(pymysql.err.OperationalError):
+        transfers.apply_transfers(lost, [transfer(1, 2, 10, 4)])
+    assert (lost.rollbacks, lost.commits) == (1, 0)
+
+    deadlocks = [pymysql.err.OperationalError(1213, "Deadlock")] * 3
+    stuck = Holdings({1: (1, 10, 10)}, failures=deadlocks)
+    with pytest.raises(pymysql.err.OperationalError):
+        transfers.apply_transfers(stuck, [transfer(1, 2, 10, 4)], max_retries=2)
+    assert (stuck.begins, stuck.rollbacks, stuck.commits) == (3, 3, 0)
@@ -0,0 +1,233 @@
+import random
+import time
+from contextlib import nullcontext
+from decimal import Decimal, InvalidOperation
+
+import pymysql
+
+from portfolio_summary import deferred_summary
+
+# InnoDB deadlock and lock wait timeout; the whole batch is retried
+RETRYABLE_ERRORS = (1213, 1205)
+MAX_RETRIES = 5
+LOCK_BATCH_SIZE = 1000
+WRITE_BATCH_SIZE = 1000
+# Batches touching fewer holdings than this keep the per-row summary triggers
+DEFER_SUMMARY_POSITIONS = 50
+
+
+def parse_leg(leg):
+    """Normalizes one request leg into a list of (account_id, security_id, delta) moves.
+
+    A transfer leg has ``from_account``, ``to_account``, ``security_id`` and a
+    positive ``quantity``; an adjustment leg has ``account_id``,
+    ``security_id`` and a signed ``quantity``.
+    """
+    if not isinstance(leg, dict):
+        raise ValueError("Leg must be an object")
+    try:
+        security_id = int(leg['security_id'])
+        quantity = Decimal(str(leg['quantity']))
+    except KeyError as e:
+        raise ValueError(f"Missing field: {e.args[0]}")
+    except (TypeError, ValueError, InvalidOperation):
+        raise ValueError("security_id and quantity must be numbers")
+    if not quantity.is_finite():
+        raise ValueError("quantity must be finite")
+
+    if 'from_account' in leg or 'to_account' in leg:
+        try:
+            from_account, to_account = int(leg['from_account']), int(leg['to_account'])
+        except KeyError as e:
+            raise ValueError(f"Missing field: {e.args[0]}")
+        except (TypeError, ValueError):
+            raise ValueError("Account ids must be integers")
+        if quantity <= 0:
+            raise ValueError("Transfer quantity must be positive")
+        if from_account == to_account:
+            raise ValueError("from_account and to_account must differ")
+        return [(from_account, security_id, -quantity), (to_account, security_id, quantity)]
+
+    try:
+        account_id = int(leg['account_id'])
+    except KeyError:
+        raise ValueError("Leg needs from_account/to_account or account_id")
+    except (TypeError, ValueError):
+        raise ValueError("Account ids must be integers")
+    if quantity == 0:
+        raise ValueError("Adjustment quantity must be non-zero")
+    return [(account_id, security_id, quantity)]
+
+
+def apply_transfers(connection, legs, atomic=False, max_retries=MAX_RETRIES):
+    """Applies many transfer/adjustment legs in one transaction.
+
+    Every portfolio_holding row involved is locked up front with SELECT ...
+    FOR UPDATE in (account_id, security_id, holding_id) order, so concurrent
+    batches acquire locks in the same order. Legs are checked in request
+    order against the locked balances, and the result is written with
+    multi-row UPDATE and INSERT statements. Batches touching at least
+    DEFER_SUMMARY_POSITIONS holdings defer summary maintenance to one
+    recomputation per account; smaller ones let the triggers apply each
+    row's delta. Deadlocks and lock wait timeouts retry the whole batch.
+
+    Returns (results, summary): one {index, status[, error]} dict per leg,
+    where status is 'applied', 'rejected' (insufficient quantity, or rolled
+    back because another leg failed in ``atomic`` mode) or 'invalid'.
+    """
+    results = [{'index': i, 'status': 'invalid'} for i in range(len(legs))]
+    moves = {}
+    for i, leg in enumerate(legs):
+        try:
+            moves[i] = parse_leg(leg)
+        except ValueError as e:
+            results[i]['error'] = str(e)
+
+    positions = {(account, security) for legs_moves in moves.values() for account, security, _ in legs_moves}
+    defer = len(positions) >= DEFER_SUMMARY_POSITIONS
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            connection.begin()
+            with deferred_summary(connection) if defer else nullcontext():
+                with connection.cursor() as cursor:
+                    applied, rejected = _apply(cursor, moves, results, atomic)
+            connection.commit()
+            break
+        except pymysql.err.OperationalError as e:
+            connection.rollback()
+            if e.args[0] not in RETRYABLE_ERRORS or attempt > max_retries:
+                raise
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+        except Exception:
+            connection.rollback()
+            raise
+
+    accounts = sorted({account for i in applied for account, _, _ in moves[i]})
+    return results, {
+        'applied': len(applied),
+        'rejected': rejected,
+        'invalid': sum(result['status'] == 'invalid' for result in results),
+        'attempts': attempt,
+        'accounts': accounts,
+    }
+
+
+def _apply(cursor, moves, results, atomic):
+    for i in moves:
+        results[i] = {'index': i, 'status': 'invalid'}
+    valid = _existing_references(cursor, moves, results)
+    positions = sorted({(account, security) for i in valid for account, security, _ in moves[i]})
+    rows = _lock_positions(cursor, positions)
+
+    balances = {position: sum(row[1] for row in rows.get(position, ())) for position in positions}
+    applied, rejected = [], 0
+    for i in valid:
+        legs_moves = moves[i]
+        short = [(a, s) for a, s, delta in legs_moves if balances[(a, s)] + delta < 0]
+        if short:
+            account, security = short[0]
+            results[i].update(status='rejected', error=(
+                f"Insufficient quantity to transfer: account {account} holds "
+                f"{balances[(account, security)]} of security {security}"))
+            rejected += 1
+            continue
+        for account, security, delta in legs_moves:
+            balances[(account, security)] += delta
+        results[i]['status'] = 'applied'
+        applied.append(i)
+
+    if atomic and (rejected or len(valid) < len(results)):
+        for i in applied:
+            results[i].update(status='rejected', error="Batch rolled back: another leg failed")
+        return [], rejected + len(applied)
+
+    net = {}
+    for i in applied:
+        for account, security, delta in moves[i]:
+            net[(account, security)] = net.get((account, security), 0) + delta
+    updates, inserts = [], []
+    for position, delta in sorted(net.items()):
+        if delta == 0:
+            continue
+        held = rows.get(position)
+        if not held:
+            inserts.append((position[0], position[1], delta))
+        elif delta > 0:
+            holding_id, quantity = held[0]
+            updates.append((holding_id, quantity + delta))
+        else:
+            # Debit duplicate rows in holding_id order
+            remaining = -delta
+            for holding_id, quantity in held:
+                if remaining <= 0:
+                    break
+                taken = min(quantity, remaining)
+                if taken > 0:
+                    updates.append((holding_id, quantity - taken))
+                    remaining -= taken
+
+    for start in range(0, len(updates), WRITE_BATCH_SIZE):
+        batch = updates[start:start + WRITE_BATCH_SIZE]
+        cursor.execute(
+            "UPDATE portfolio_holding SET quantity = CASE holding_id {} END WHERE holding_id IN ({})".format(
+                ' '.join(['WHEN %s THEN %s'] * len(batch)), ', '.join(['%s'] * len(batch))),
+            [value for row in batch for value in row] + [row[0] for row in batch])
+    for start in range(0, len(inserts), WRITE_BATCH_SIZE):
+        batch = inserts[start:start + WRITE_BATCH_SIZE]
+        cursor.execute(
+            "INSERT INTO portfolio_holding (account_id, security_id, quantity, book_cost) VALUES {}".format(
+                ', '.join(['(%s, %s, %s, 0)'] * len(batch))),
+            [value for row in batch for value in row])
+    return applied, rejected
+
+
+def _existing_references(cursor, moves, results):
+    """Marks legs naming unknown accounts or securities invalid; returns the rest in order."""
+    accounts = sorted({a for legs_moves in moves.values() for a, _, _ in legs_moves})
+    securities = sorted({s for legs_moves in moves.values() for _, s, _ in legs_moves})
+    known_accounts = _existing(cursor, "broker_account", "account_id", accounts)
+    known_securities = _existing(cursor, "security", "security_id", securities)
+    valid = []
+    for i in sorted(moves):
+        missing = [a for a, _, _ in moves[i] if a not in known_accounts]
+        if missing:
+            results[i]['error'] = f"Account not found: {missing[0]}"
+        elif moves[i][0][1] not in known_securities:
+            results[i]['error'] = f"Security not found: {moves[i][0][1]}"
+        else:
+            valid.append(i)
+    return valid
+
+
+def _existing(cursor, table, column, ids):
+    found = set()
+    for start in range(0, len(ids), LOCK_BATCH_SIZE):
+        batch = ids[start:start + LOCK_BATCH_SIZE]
+        cursor.execute("SELECT {0} FROM {1} WHERE {0} IN ({2})".format(
+            column, table, ', '.join(['%s'] * len(batch))), batch)
+        found.update(_first(row) for row in cursor.fetchall())
+    return found
+
+
+def _lock_positions(cursor, positions):
+    """Locks the holding rows of ``positions`` in key order; returns {position: [(holding_id, quantity)]}."""
+    rows = {}
+    for start in range(0, len(positions), LOCK_BATCH_SIZE):
+        batch = positions[start:start + LOCK_BATCH_SIZE]
+        cursor.execute(
+            "SELECT holding_id, account_id, security_id, quantity FROM portfolio_holding "
+            "WHERE (account_id, security_id) IN ({}) "
+            "ORDER BY account_id, security_id, holding_id FOR UPDATE".format(', '.join(['(%s, %s)'] * len(batch))),
+            [value for position in batch for value in position])
+        for row in cursor.fetchall():
+            if isinstance(row, dict):
+                row = (row['holding_id'], row['account_id'], row['security_id'], row['quantity'])
+            holding_id, account_id, security_id, quantity = row
+            rows.setdefault((account_id, security_id), []).append((holding_id, Decimal(str(quantity or 0))))
+    return rows
+
+
+def _first(row):
+    return next(iter(row.values())) if isinstance(row, dict) else row[0]